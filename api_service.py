@@ -1,9 +1,13 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, WebSocket, WebSocketDisconnect
 from pydantic import BaseModel
 from typing import Dict, List, Any
 import uvicorn
 from app import app
 from graph import parse_graph_data
+from persistent import json_default
+from progress import FULL, VERBOSITY_LEVELS, ProgressPipeline
+from run_pool import RunPool, RunRejected, RunTicket
+from runs import RunConnection, RunRegistry, SQLiteRunStore
 import json
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
@@ -11,13 +15,21 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
 from pathlib import Path
 import asyncio
-import threading
+import contextlib
 import traceback
 import logging
 import os
 
 api = FastAPI(title="Graph Execution API")
 
+# 保存正在执行的图任务的引用，避免被垃圾回收
+running_tasks: set[asyncio.Task] = set()
+
+# 限制同时执行的图的数量，参数由start_api_service设置
+run_pool = RunPool()
+# /api/runs和WebSocket连接启动的运行，以及结束的运行的结果，见runs模块
+run_registry = RunRegistry(app, run_pool)
+
 
 class GraphData(BaseModel):
     nodes: List[Dict[str, Any]]
@@ -25,58 +37,268 @@ class GraphData(BaseModel):
     route_edges: List[Dict[str, Any]]
 
 
+class BatchData(BaseModel):
+    graph: GraphData
+    # 每一行为节点id -> 引脚 -> 值
+    rows: List[Dict[str, Dict[str, Any]]]
+
+
+# 批量执行时同时执行的行数上限
+MAX_BATCH_CONCURRENCY = 64
+
+
+def _rejected(e: RunRejected) -> HTTPException:
+    return HTTPException(
+        status_code=e.status_code,
+        detail=str(e),
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+
+def _rejected_event(e: RunRejected) -> dict:
+    """已经开始发送SSE时，用事件代替HTTP状态报告RunRejected"""
+    return {
+        "event": "run_rejected",
+        "status_code": e.status_code,
+        "retry_after": e.retry_after,
+        "detail": str(e),
+    }
+
+
+def _reserve_run() -> RunTicket:
+    """运行太多时返回429"""
+    try:
+        return run_pool.reserve()
+    except RunRejected as e:
+        raise _rejected(e)
+
+
 @api.post("/api/execute-graph")
-async def execute_graph(graph_data: GraphData):
+async def execute_graph(graph_data: GraphData, profile: bool = False):
+    """profile为True时，返回每个节点和调度器的耗时统计
+
+    图在事件循环中异步执行，不会阻塞其它请求。queue_wait为排队等待的秒数
+    """
     try:
         graph = parse_graph_data(json.dumps(graph_data.model_dump()))
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
-    app.execute_graph(graph)
-    return {"status": "success"}
+    ticket = _reserve_run()
+    try:
+        try:
+            queue_wait = await ticket.acquire()
+        except RunRejected as e:
+            raise _rejected(e)
+        summary = await app.execute_graph_async(graph, profile=profile)
+    finally:
+        ticket.release()
+    if profile:
+        return {"status": "success", "queue_wait": queue_wait, "profile": summary}
+    return {"status": "success", "queue_wait": queue_wait}
 
 
 @api.post("/api/execute-graph-with-progress")
-async def execute_graph_with_progress(graph_data: GraphData):
+async def execute_graph_with_progress(
+    graph_data: GraphData, profile: bool = False, verbosity: str = FULL
+):
+    """profile为True时，finish事件中包含耗时统计
+
+    verbosity为none/summary/node/full，见progress模块。append事件会被合并，
+    事件按时间间隔批量写入，一次写入包含多个SSE消息
+
+    运行太多时返回429，开始执行前发送run_admitted事件，其中queue_wait为排队等待的秒数，
+    排队超时时发送run_rejected事件，其中包含status_code(503)和retry_after
+    """
+    if verbosity not in VERBOSITY_LEVELS:
+        raise HTTPException(status_code=400, detail=f"unknown verbosity {verbosity}")
     try:
         graph = parse_graph_data(json.dumps(graph_data.model_dump()))
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-    async def event_generator():
-        # 创建一个队列用于存储进度消息
-        queue = asyncio.Queue()
-
-        def progress_callback(progress_data):
-            # 将进度数据放入队列
-            queue.put_nowait(progress_data)
+    ticket = _reserve_run()
+    pipeline = ProgressPipeline(verbosity)
 
-        def execute():
-            try:
-                app.execute_graph(graph, progress_callback)
-            except Exception as e:
-                queue.put_nowait(e)
-            finally:
-                queue.put_nowait(None)
+    async def execute():
+        try:
+            queue_wait = await ticket.acquire()
+            pipeline.put({"event": "run_admitted", "queue_wait": queue_wait})
+            # 其它线程中的事件经过bridge批量放入管道，传输跟不上时节点等待
+            await app.execute_graph_async(graph, pipeline.bridge(), profile=profile)
+        except RunRejected as e:
+            pipeline.put(_rejected_event(e))
+        except Exception as e:
+            pipeline.close(e)
+        finally:
+            ticket.release()
+            pipeline.close()
 
-        # 在后台线程中执行图
-        thread = threading.Thread(target=execute)
-        thread.start()
+    # 在事件循环中执行图，客户端断开后继续执行到结束
+    task = asyncio.create_task(execute())
+    running_tasks.add(task)
+    task.add_done_callback(running_tasks.discard)
 
+    async def event_generator():
         try:
-            while True:
-                data = await queue.get()
-                if data is None:
-                    break
-                if isinstance(data, Exception):
-                    raise data
-                if isinstance(data, dict):
-                    data = json.dumps(data)
-                    yield f"data: {data}\n\n"
+            async for events in pipeline.batches():
+                yield "".join(
+                    f"data: {json.dumps(event, default=json_default)}\n\n"
+                    for event in events
+                )
         except Exception as e:
             logging.error(
                 "Execute graph with progress exception:\n%s", traceback.format_exc()
             )
             yield f"data: {json.dumps({'error': repr(e)})}\n\n"
+        finally:
+            # 客户端断开后不再暂停执行
+            pipeline.close()
+
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+        },
+    )
+
+
+@api.post("/api/execute-graph-batch")
+async def execute_graph_batch(batch_data: BatchData, max_concurrency: int = 4):
+    """对rows中的每一行替换节点的固定输入后执行同一个图，图只解析和构造一次
+
+    整个批次占用运行池中的一个名额，运行太多时返回429，排队超时时发送run_rejected事件。
+    以SSE发送run_admitted事件，之后每一行完成时发送一个row_result事件，其中包含行的下标、
+    状态和每个节点显示的内容，最后发送batch_finish事件。客户端断开后停止执行
+    """
+    if not 1 <= max_concurrency <= MAX_BATCH_CONCURRENCY:
+        raise HTTPException(
+            status_code=400,
+            detail=f"max_concurrency must be between 1 and {MAX_BATCH_CONCURRENCY}",
+        )
+    try:
+        graph = parse_graph_data(json.dumps(batch_data.graph.model_dump()))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    node_ids = {node.id for node in graph.nodes}
+    for row in batch_data.rows:
+        unknown = row.keys() - node_ids
+        if unknown:
+            raise HTTPException(
+                status_code=400, detail=f"unknown nodes {sorted(unknown)}"
+            )
+    ticket = _reserve_run()
+    pipeline = ProgressPipeline(FULL)
+
+    async def execute():
+        try:
+            queue_wait = await ticket.acquire()
+            pipeline.put({"event": "run_admitted", "queue_wait": queue_wait})
+            results = app.execute_graph_batch(
+                graph, batch_data.rows, max_concurrency=max_concurrency
+            )
+            async with contextlib.aclosing(results):
+                async for result in results:
+                    if "error" in result:
+                        result["error"] = repr(result["error"])
+                    # 客户端读取得慢时不再取下一行的结果，执行行的任务随之暂停
+                    await pipeline.wait_for_space()
+                    pipeline.put({"event": "row_result", **result})
+            pipeline.put({"event": "batch_finish", "rows": len(batch_data.rows)})
+        except RunRejected as e:
+            pipeline.put(_rejected_event(e))
+        except Exception as e:
+            pipeline.close(e)
+        finally:
+            ticket.release()
+            pipeline.close()
+
+    # 任务持有运行池的名额，即使响应没有开始发送也会释放
+    task = asyncio.create_task(execute())
+    running_tasks.add(task)
+    task.add_done_callback(running_tasks.discard)
+
+    async def event_generator():
+        try:
+            async for events in pipeline.batches():
+                yield "".join(
+                    f"data: {json.dumps(event, default=json_default)}\n\n"
+                    for event in events
+                )
+        except Exception as e:
+            logging.error("Execute graph batch exception:\n%s", traceback.format_exc())
+            yield f"data: {json.dumps({'error': repr(e)})}\n\n"
+        finally:
+            # 客户端断开后没有人接收结果，停止执行剩下的行
+            task.cancel()
+
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+        },
+    )
+
+
+@api.post("/api/runs", status_code=202)
+async def create_run(graph_data: GraphData, profile: bool = False):
+    """启动运行后立即返回run_id，之后用/api/runs/{run_id}查询结果，客户端不需要保持连接"""
+    try:
+        graph = parse_graph_data(json.dumps(graph_data.model_dump()))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        run = run_registry.start(graph, profile=profile)
+    except RunRejected as e:
+        raise _rejected(e)
+    return {"run_id": run.id, "status": run.status}
+
+
+@api.get("/api/runs/{run_id}")
+async def get_run(run_id: str):
+    """运行的状态、错误和每个节点显示的输出"""
+    status = run_registry.status(run_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="unknown run")
+    return status
+
+
+@api.delete("/api/runs/{run_id}")
+async def cancel_run(run_id: str):
+    if not run_registry.cancel(run_id):
+        raise HTTPException(status_code=404, detail="unknown or finished run")
+    return {"status": "success"}
+
+
+@api.get("/api/runs/{run_id}/events")
+async def get_run_events(
+    run_id: str,
+    since: int = 0,
+    stream: bool = False,
+    last_event_id: str | None = Header(default=None),
+):
+    """序号从since开始的事件
+
+    stream为False时返回已有的事件，next为下一次请求使用的since。
+    stream为True时以SSE发送已有的事件和之后的新事件，直到运行结束，每条消息的id为事件的序号，
+    断线重连时浏览器发送的Last-Event-ID优先于since
+    """
+    if run_registry.status(run_id) is None:
+        raise HTTPException(status_code=404, detail="unknown run")
+    if not stream:
+        return run_registry.events(run_id, since)
+    if last_event_id is not None and last_event_id.isdigit():
+        since = int(last_event_id) + 1
+
+    async def event_generator():
+        async for start, events in run_registry.follow(run_id, since):
+            yield "".join(
+                f"id: {start + index}\ndata: {json.dumps(event, default=json_default)}\n\n"
+                for index, event in enumerate(events)
+            )
 
     return StreamingResponse(
         event_generator(),
@@ -88,11 +310,30 @@ async def execute_graph_with_progress(graph_data: GraphData):
     )
 
 
+@api.websocket("/api/ws")
+async def run_socket(websocket: WebSocket):
+    """在一个连接上启动、订阅和取消多个运行，协议见runs模块"""
+    await websocket.accept()
+    connection = RunConnection(run_registry, websocket.send_text)
+    try:
+        while True:
+            text = await websocket.receive_text()
+            try:
+                message = json.loads(text)
+            except ValueError:
+                message = None
+            await connection.handle(message)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        connection.close()
+
+
 @api.get("/api/node-metas")
 async def get_node_metas():
     """获取所有可用节点的元数据"""
     node_metas = {}
-    for node_type, (_, node_meta) in app.node_defs.items():
+    for node_type, (_, node_meta, _) in app.node_defs.items():
         node_metas[node_type] = node_meta
     return {"status": "success", "data": node_metas}
 
@@ -104,7 +345,19 @@ if not os.path.exists(STATIC_DIR):
 api.mount("/", StaticFiles(directory=STATIC_DIR, html=True), name=STATIC_DIR)
 
 
-def start_api_service(dev_mode=False):
+def start_api_service(
+    dev_mode=False,
+    max_running_graphs: int = 4,
+    max_queued_graphs: int = 16,
+    max_queue_wait: float = 30.0,
+    run_store_path: str | None = None,
+):
+    """run_store_path不为None时，结束的运行保存在这个SQLite文件中，否则保存在内存中"""
+    run_pool.max_running = max_running_graphs
+    run_pool.max_queued = max_queued_graphs
+    run_pool.max_queue_wait = max_queue_wait
+    if run_store_path is not None:
+        run_registry.store = SQLiteRunStore(run_store_path)
     # 如果是开发环境，启用CORS
     if dev_mode:
         # 添加CORS中间件
@@ -1,9 +1,13 @@
-from graph import GraphData, GraphExecutor
+import asyncio
+from graph import CompiledGraph, GraphData, GraphExecutor, NodeSpec
+from progress import merge_output
 
 
 class App:
     def __init__(self):
         self.node_defs = {}
+        # 跨运行的节点结果缓存，见result_cache模块，None表示不缓存
+        self.result_cache = None
 
     def node_def(self, id: str):
         def decorator(node_class):
@@ -15,11 +19,111 @@ class App:
     def register_node(self, id: str, node_class):
         if not hasattr(node_class, "meta"):
             raise ValueError(f"Node type {id} is missing meta method")
-        self.node_defs[id] = (node_class, node_class.meta())
+        node_meta = node_class.meta()
+        self.node_defs[id] = (node_class, node_meta, NodeSpec.from_meta(node_meta))
 
-    def execute_graph(self, graph: GraphData, progress_callback=lambda x: None):
-        executor = GraphExecutor(self.node_defs, graph)
+    def execute_graph(
+        self,
+        graph: GraphData,
+        progress_callback=lambda x: None,
+        max_workers: int = 0,
+        vectorize_loops: bool = False,
+        use_compiler: bool = False,
+        checkpoint=None,
+        profile: bool = False,
+        release_outputs: bool = False,
+    ) -> dict[str, any] | None:
+        """执行图，profile为True时返回性能统计，即finish事件中的profile"""
+        executor = GraphExecutor(
+            self.node_defs,
+            graph,
+            max_workers=max_workers,
+            vectorize_loops=vectorize_loops,
+            use_compiler=use_compiler,
+            checkpoint=checkpoint,
+            result_cache=self.result_cache,
+            profile=profile,
+            release_outputs=release_outputs,
+        )
         executor.execute(progress_callback)
+        if executor.profiler is not None:
+            return executor.profiler.summary()
+
+    async def execute_graph_async(
+        self,
+        graph: GraphData,
+        progress_callback=lambda x: None,
+        checkpoint=None,
+        profile: bool = False,
+        release_outputs: bool = False,
+    ) -> dict[str, any] | None:
+        executor = GraphExecutor(
+            self.node_defs,
+            graph,
+            checkpoint=checkpoint,
+            result_cache=self.result_cache,
+            profile=profile,
+            release_outputs=release_outputs,
+        )
+        await executor.execute_async(progress_callback)
+        if executor.profiler is not None:
+            return executor.profiler.summary()
+
+    async def execute_graph_batch(
+        self,
+        graph: GraphData,
+        rows: list[dict[str, dict[str, any]]],
+        max_concurrency: int = 4,
+        progress_callback=lambda row, event: None,
+    ):
+        """用每一行替换节点的固定输入后执行图，按完成的顺序产生每一行的结果
+
+        rows中的每一行为节点id -> 引脚 -> 值。图结构只构造一次，所有行共享同一个CompiledGraph。
+        最多同时执行max_concurrency行，结果为{"row": 下标, "status": "succeeded"/"failed",
+        "outputs": 节点id -> 显示的内容, "error": 错误}。停止迭代时取消还在执行的行
+        """
+        compiled = CompiledGraph(self.node_defs, graph)
+        # 先检查所有的行，有未知节点时不执行任何一行
+        row_graphs = [compiled.with_inputs(overrides) for overrides in rows]
+        # 调用方不取结果时，执行完的行最多积累max_concurrency个，之后执行行的任务等待
+        results = asyncio.Queue(maxsize=max(1, max_concurrency))
+        pending = iter(enumerate(row_graphs))
+
+        async def execute_row(row: int, row_compiled: CompiledGraph) -> dict:
+            outputs = {}
+
+            def callback(event):
+                node_id = event.get("node_id")
+                if node_id is not None:
+                    merge_output(outputs, node_id, event)
+                progress_callback(row, event)
+
+            executor = GraphExecutor(
+                self.node_defs,
+                graph,
+                compiled=row_compiled,
+                result_cache=self.result_cache,
+            )
+            try:
+                await executor.execute_async(callback)
+            except Exception as e:
+                return {"row": row, "status": "failed", "outputs": outputs, "error": e}
+            return {"row": row, "status": "succeeded", "outputs": outputs}
+
+        async def worker():
+            for row, row_compiled in pending:
+                await results.put(await execute_row(row, row_compiled))
+
+        workers = [
+            asyncio.create_task(worker())
+            for _ in range(max(1, min(max_concurrency, len(rows))))
+        ]
+        try:
+            for _ in range(len(rows)):
+                yield await results.get()
+        finally:
+            for task in workers:
+                task.cancel()
 
 
 app = App()
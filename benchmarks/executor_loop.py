@@ -0,0 +1,115 @@
+"""执行器热循环基准测试
+
+用法: python -m benchmarks.executor_loop [--iterations N] [--chain N] [--repeat N] [--compile]
+
+构造一个ForLoop循环，循环体中的SetVariableNode依赖一条由AddIntNode组成的数据链，
+统计每秒执行的节点步数（即execute_node事件数）。
+"""
+
+import argparse
+import json
+import time
+import plugins.basic
+from app import app
+from graph import parse_graph_data
+
+
+def loop_graph_json(iterations: int, chain: int) -> str:
+    nodes = [
+        {"id": "start", "node_type": "StartNode", "execution_type": "TRIGGERED"},
+        {
+            "id": "loop",
+            "node_type": "ForLoopNode",
+            "execution_type": "TRIGGERED",
+            "inputs": {"start": 0, "end": iterations, "step": 1},
+        },
+        {
+            "id": "zero",
+            "node_type": "IntNode",
+            "execution_type": "DATA_ONCE",
+            "inputs": {"value": 0},
+        },
+        {"id": "var", "node_type": "DefineVariableNode", "execution_type": "DATA_ONCE"},
+        {"id": "get", "node_type": "GetVariableNode", "execution_type": "DATA"},
+        {"id": "set", "node_type": "SetVariableNode", "execution_type": "TRIGGERED"},
+    ]
+    edges = [
+        ("zero", "value", "var", "initial_value"),
+        ("var", "variable", "get", "variable"),
+        ("var", "variable", "set", "variable"),
+    ]
+    last = ("get", "value")
+    for i in range(chain):
+        node_id = f"add{i}"
+        nodes.append(
+            {
+                "id": node_id,
+                "node_type": "AddIntNode",
+                "execution_type": "DATA",
+                "inputs": {"b": 0},
+            }
+        )
+        edges.append((*last, node_id, "a"))
+        last = (node_id, "result")
+    edges.append(
+        ("loop", "item", "add0" if chain else "set", "b" if chain else "value")
+    )
+    edges.append((*last, "set", "value"))
+    for node in nodes:
+        node.setdefault("inputs", {})
+    return json.dumps(
+        {
+            "nodes": nodes,
+            "edges": [
+                {
+                    "source_id": source_id,
+                    "source_pin": source_pin,
+                    "target_id": target_id,
+                    "target_pin": target_pin,
+                }
+                for source_id, source_pin, target_id, target_pin in edges
+            ],
+            "route_edges": [
+                {"source_id": "start", "source_pin": "_", "target_id": "loop"},
+                {"source_id": "loop", "source_pin": "body", "target_id": "set"},
+            ],
+        }
+    )
+
+
+def run(iterations: int, chain: int, repeat: int, use_compiler: bool = False) -> float:
+    graph = parse_graph_data(loop_graph_json(iterations, chain))
+    best = 0.0
+    for _ in range(repeat):
+        steps = 0
+
+        def progress_callback(event):
+            nonlocal steps
+            if event["event"] == "execute_node":
+                steps += 1
+
+        start = time.perf_counter()
+        app.execute_graph(graph, progress_callback, use_compiler=use_compiler)
+        elapsed = time.perf_counter() - start
+        best = max(best, steps / elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the graph executor loop")
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--chain", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--compile", action="store_true", help="execute the compiled graph"
+    )
+    args = parser.parse_args()
+    steps_per_sec = run(args.iterations, args.chain, args.repeat, args.compile)
+    print(
+        f"iterations={args.iterations} chain={args.chain} compile={args.compile}: "
+        f"{steps_per_sec:,.0f} steps/sec"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""生成用于基准测试的图
+
+每个生成器返回GraphData，使用plugins/basic中的真实节点（LLM场景使用stub_llm中的桩节点）。
+图的结构都是：start -> 外层循环 -> 被测试的结构，循环结束后显示累加变量的值，
+这样节点步数和循环次数成正比，可以用不同的参数测量调度器在各种结构上的开销。
+"""
+
+import json
+from graph import GraphData, parse_graph_data
+
+
+class GraphBuilder:
+    def __init__(self):
+        self.nodes = []
+        self.edges = []
+        self.route_edges = []
+
+    def node(self, id: str, node_type: str, execution_type: str, **inputs) -> str:
+        self.nodes.append(
+            {
+                "id": id,
+                "node_type": node_type,
+                "execution_type": execution_type,
+                "inputs": inputs,
+            }
+        )
+        return id
+
+    def edge(self, source_id: str, source_pin: str, target_id: str, target_pin: str):
+        self.edges.append(
+            {
+                "source_id": source_id,
+                "source_pin": source_pin,
+                "target_id": target_id,
+                "target_pin": target_pin,
+            }
+        )
+
+    def route(self, source_id: str, source_pin: str, target_id: str):
+        self.route_edges.append(
+            {"source_id": source_id, "source_pin": source_pin, "target_id": target_id}
+        )
+
+    def variable(self, id: str, initial_value: any = 0) -> tuple[str, str]:
+        """定义一个变量，返回(变量节点, 读取变量的节点)"""
+        self.node(id, "DefineVariableNode", "DATA_ONCE", initial_value=initial_value)
+        get_id = self.node(f"{id}_get", "GetVariableNode", "DATA")
+        self.edge(id, "variable", get_id, "variable")
+        return id, get_id
+
+    def increment(self, id: str, variable: tuple[str, str], amount: int = 1) -> str:
+        """variable += amount，返回SetVariableNode的id"""
+        variable_id, get_id = variable
+        add_id = self.node(f"{id}_add", "AddIntNode", "DATA", b=amount)
+        self.edge(get_id, "value", add_id, "a")
+        set_id = self.node(id, "SetVariableNode", "TRIGGERED")
+        self.edge(variable_id, "variable", set_id, "variable")
+        self.edge(add_id, "result", set_id, "value")
+        return set_id
+
+    def build(self) -> GraphData:
+        return parse_graph_data(
+            json.dumps(
+                {
+                    "nodes": self.nodes,
+                    "edges": self.edges,
+                    "route_edges": self.route_edges,
+                }
+            )
+        )
+
+
+def _outer_loop(builder: GraphBuilder, iterations: int) -> tuple[str, str]:
+    """start -> for i in range(iterations)，循环结束后显示total，返回(循环节点, total变量)"""
+    builder.node("start", "StartNode", "TRIGGERED")
+    loop = builder.node(
+        "loop", "ForLoopNode", "TRIGGERED", start=0, end=iterations, step=1
+    )
+    builder.route("start", "_", loop)
+    total = builder.variable("total")
+    display = builder.node("display", "DisplayAsTextNode", "TRIGGERED", append=False)
+    builder.edge(total[1], "value", display, "value")
+    builder.route(loop, "_", display)
+    return loop, total
+
+
+def data_chain_graph(length: int, iterations: int) -> GraphData:
+    """每次迭代计算一条长度为length的AddIntNode数据链"""
+    builder = GraphBuilder()
+    loop, total = _outer_loop(builder, iterations)
+    previous = (loop, "item")
+    for i in range(length):
+        node = builder.node(f"chain{i}", "AddIntNode", "DATA", b=1)
+        builder.edge(*previous, node, "a")
+        previous = (node, "result")
+    sink = builder.node("sink", "SetVariableNode", "TRIGGERED")
+    builder.edge(total[0], "variable", sink, "variable")
+    builder.edge(*previous, sink, "value")
+    builder.route(loop, "body", sink)
+    return builder.build()
+
+
+def fan_in_graph(width: int, iterations: int) -> GraphData:
+    """每次迭代计算width个叶子，再用AddIntNode组成的二叉树归约成一个值"""
+    builder = GraphBuilder()
+    loop, total = _outer_loop(builder, iterations)
+    level = []
+    for i in range(width):
+        node = builder.node(f"leaf{i}", "AddIntNode", "DATA", b=i)
+        builder.edge(loop, "item", node, "a")
+        level.append(node)
+    depth = 0
+    while len(level) > 1:
+        next_level = []
+        for i in range(0, len(level) - 1, 2):
+            node = builder.node(f"sum{depth}_{i}", "AddIntNode", "DATA")
+            builder.edge(level[i], "result", node, "a")
+            builder.edge(level[i + 1], "result", node, "b")
+            next_level.append(node)
+        if len(level) % 2:
+            next_level.append(level[-1])
+        level = next_level
+        depth += 1
+    sink = builder.node("sink", "SetVariableNode", "TRIGGERED")
+    builder.edge(total[0], "variable", sink, "variable")
+    builder.edge(level[0], "result", sink, "value")
+    builder.route(loop, "body", sink)
+    return builder.build()
+
+
+def nested_loops_graph(depth: int, iterations: int) -> GraphData:
+    """depth层嵌套循环，依次使用ForLoop、ForEach和While，每层iterations次，最内层total += 1"""
+    builder = GraphBuilder()
+    builder.node("start", "StartNode", "TRIGGERED")
+    total = builder.variable("total")
+    previous = ("start", "_")
+    for level in range(depth):
+        kind = level % 3
+        if kind == 0:
+            node = builder.node(
+                f"for{level}",
+                "ForLoopNode",
+                "TRIGGERED",
+                start=0,
+                end=iterations,
+                step=1,
+            )
+            builder.route(*previous, node)
+            previous = (node, "body")
+        elif kind == 1:
+            node = builder.node(
+                f"foreach{level}",
+                "ForEachNode",
+                "TRIGGERED",
+                items=list(range(iterations)),
+            )
+            builder.route(*previous, node)
+            previous = (node, "body")
+        else:
+            # counter = 0; while counter < iterations: counter += 1; ...
+            counter = builder.variable(f"counter{level}")
+            reset = builder.node(
+                f"reset{level}", "SetVariableNode", "TRIGGERED", value=0
+            )
+            builder.edge(counter[0], "variable", reset, "variable")
+            compare = builder.node(
+                f"compare{level}", "CompareNode", "DATA", operator="<", b=iterations
+            )
+            builder.edge(counter[1], "value", compare, "a")
+            node = builder.node(f"while{level}", "WhileLoopNode", "TRIGGERED")
+            builder.edge(compare, "result", node, "condition")
+            step = builder.increment(f"step{level}", counter)
+            builder.route(*previous, reset)
+            builder.route(reset, "_", node)
+            builder.route(node, "body", step)
+            previous = (step, "_")
+    builder.route(*previous, builder.increment("inner", total))
+    display = builder.node("display", "DisplayAsTextNode", "TRIGGERED", append=False)
+    builder.edge(total[1], "value", display, "value")
+    builder.route("start", "_", display)
+    return builder.build()
+
+
+def route_fan_out_graph(width: int, iterations: int) -> GraphData:
+    """每次迭代循环体路由到width个目标节点"""
+    builder = GraphBuilder()
+    loop, total = _outer_loop(builder, iterations)
+    for i in range(width):
+        builder.route(loop, "body", builder.increment(f"target{i}", total))
+    return builder.build()
+
+
+def llm_graph(turns: int, chunks: int) -> GraphData:
+    """每次迭代调用一次桩LLM节点，流式输出的每一段都路由到一个追加显示的节点"""
+    builder = GraphBuilder()
+    loop, total = _outer_loop(builder, turns)
+    llm = builder.node(
+        "llm",
+        "Benchmark.StubLLMNode",
+        "TRIGGERED",
+        messages=[{"role": "user", "content": "hello"}],
+        chunks=chunks,
+    )
+    builder.route(loop, "body", llm)
+    output = builder.node("output", "DisplayAsTextNode", "TRIGGERED", append=True)
+    builder.edge(llm, "content_part", output, "value")
+    builder.route(llm, "on_content_part", output)
+    builder.route(llm, "_", builder.increment("count", total))
+    return builder.build()
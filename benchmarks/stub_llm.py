@@ -0,0 +1,58 @@
+"""基准测试用的桩LLM节点
+
+输入输出、发送的事件与LLM.OpenAIChatCompletionNode相同，但不调用任何API，
+按chunks参数流式输出固定的文本，可以用latency模拟每一段的网络延迟。
+"""
+
+import asyncio
+from typing import AsyncIterator
+from app import app
+from node_basic import NodeOutput
+from stream import Stream
+
+
+@app.node_def("Benchmark.StubLLMNode")
+class StubLLMNode:
+    @classmethod
+    def meta(cls):
+        return {
+            "title": "Stub LLM",
+            "category": "Benchmark",
+            "inputs": [
+                {"name": "messages", "type": "list<chat_message>"},
+                {"name": "chunks", "type": "int", "options": {"default": 16}},
+                {"name": "latency", "type": "float", "options": {"default": 0.0}},
+            ],
+            "outputs": [
+                {"name": "role", "type": "str"},
+                {"name": "content", "type": "str", "stream": True},
+                {"name": "on_stream", "type": "route"},
+                {"name": "on_content_part", "type": "route"},
+                {"name": "content_part", "type": "str"},
+            ],
+            "display": [{"name": "outputing", "type": "text"}],
+        }
+
+    async def execute(
+        self, controller, messages: list, chunks: int = 16, latency: float = 0.0
+    ) -> AsyncIterator[NodeOutput]:
+        async def content_parts():
+            for i in range(chunks):
+                if latency > 0:
+                    await asyncio.sleep(latency)
+                content_part = f"token{i} "
+                controller.send_event("append", {"outputing": content_part})
+                yield content_part
+
+        controller.send_event("display", {"outputing": ""})
+        content = Stream(content_parts())
+        yield NodeOutput(
+            execution_pin="on_stream", data={"role": "assistant", "content": content}
+        )
+        async for content_part in content:
+            yield NodeOutput(
+                execution_pin="on_content_part", data={"content_part": content_part}
+            )
+        yield NodeOutput(
+            execution_pin=None, data={"role": "assistant", "content": content}
+        )
@@ -0,0 +1,112 @@
+"""执行器基准测试套件
+
+用法: python -m benchmarks.suite [--scenario NAME ...] [--scale F] [--repeat N]
+                                  [--compile] [--max-workers N] [--json]
+
+对benchmarks.graphs生成的各种结构的图分别运行GraphExecutor，报告每秒执行的节点步数
+（即execute_node事件数，取repeat次中最好的一次）和执行过程中Python分配内存的峰值。
+峰值内存在单独的一次运行中用tracemalloc测量，不影响计时。
+--scale按比例调整每个场景的循环次数。
+"""
+
+import argparse
+import json
+import time
+import tracemalloc
+import plugins.basic
+import benchmarks.stub_llm
+from app import app
+from benchmarks import graphs
+
+# 场景名 -> (生成器, 结构参数, 默认的循环次数)
+SCENARIOS = {
+    "data_chain": (graphs.data_chain_graph, 50, 2000),
+    "fan_in": (graphs.fan_in_graph, 64, 1000),
+    "nested_loops": (graphs.nested_loops_graph, 6, 5),
+    "route_fan_out": (graphs.route_fan_out_graph, 50, 1000),
+    "llm": (graphs.llm_graph, 1000, 50),
+}
+
+
+def _execute(graph, **kwargs) -> int:
+    steps = 0
+
+    def progress_callback(event):
+        nonlocal steps
+        if event["event"] == "execute_node":
+            steps += 1
+
+    app.execute_graph(graph, progress_callback, **kwargs)
+    return steps
+
+
+def run_scenario(
+    name: str,
+    scale: float = 1.0,
+    repeat: int = 3,
+    use_compiler: bool = False,
+    max_workers: int = 0,
+) -> dict[str, any]:
+    generate, size, iterations = SCENARIOS[name]
+    if name == "llm":
+        # LLM场景的第二个参数是每次回复的段数，按比例调整
+        graph = generate(iterations, max(1, round(size * scale)))
+    else:
+        graph = generate(size, max(1, round(iterations * scale)))
+    kwargs = {"use_compiler": use_compiler, "max_workers": max_workers}
+    best = 0.0
+    steps = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        steps = _execute(graph, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = max(best, steps / elapsed)
+    tracemalloc.start()
+    try:
+        _execute(graph, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "scenario": name,
+        "nodes": len(graph.nodes),
+        "steps": steps,
+        "steps_per_sec": best,
+        "peak_memory": peak,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the graph executor")
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=list(SCENARIOS),
+        help="scenarios to run (default: all)",
+    )
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--compile", action="store_true", help="execute the compiled graph"
+    )
+    parser.add_argument("--max-workers", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+    results = [
+        run_scenario(name, args.scale, args.repeat, args.compile, args.max_workers)
+        for name in args.scenario or SCENARIOS
+    ]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'scenario':<16}{'nodes':>8}{'steps':>10}{'steps/sec':>14}{'peak MB':>10}")
+    for result in results:
+        print(
+            f"{result['scenario']:<16}{result['nodes']:>8}{result['steps']:>10}"
+            f"{result['steps_per_sec']:>14,.0f}"
+            f"{result['peak_memory'] / 1024 / 1024:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
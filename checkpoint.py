@@ -0,0 +1,162 @@
+"""执行过程的检查点，用于从失败的位置继续执行
+
+生成器无法序列化，所以检查点不保存任务栈本身，而是保存一份输出日志：
+meta中声明了"checkpoint"的节点（如调用LLM的节点）和DATA_ONCE节点每完成一次执行，
+就记录这次执行的输出和期间发送的事件，按(节点id, 第几次执行)索引。
+ParallelForEach等并发执行的迭代中节点开始的顺序不确定，每次迭代使用单独的范围（scope），
+节点id前加上(Map节点, 第几次执行, 迭代下标)，执行次数在范围内计数。
+
+恢复时从头执行同一个图，已经记录过的执行直接重放记录的事件和输出，不再调用节点；
+其它节点照常执行。只要没有记录的节点是确定性的，执行就会沿着原来的路径回到失败的位置，
+之前花费的LLM调用不需要重新支付。
+
+记录的输出在记录时就被序列化，之后节点修改输出对象也不会影响检查点。无法pickle的输出不记录。
+"""
+
+import os
+import pickle
+import threading
+
+
+class MemoryCheckpointStore:
+    """保存在内存中的检查点，用于同一个进程中重试"""
+
+    def __init__(self):
+        self.checkpoints: dict[str, dict[tuple[str, int], bytes]] = {}
+        self.lock = threading.Lock()
+
+    def load(self, run_id: str) -> dict[tuple[str, int], bytes] | None:
+        with self.lock:
+            entries = self.checkpoints.get(run_id)
+            return None if entries is None else dict(entries)
+
+    def append(self, run_id: str, entries: dict[tuple[str, int], bytes]):
+        with self.lock:
+            self.checkpoints.setdefault(run_id, {}).update(entries)
+
+    def delete(self, run_id: str):
+        with self.lock:
+            self.checkpoints.pop(run_id, None)
+
+
+class FileCheckpointStore:
+    """保存在本地目录中的检查点，每次运行一个文件，每次保存在文件末尾追加一条记录"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        # 多个线程同时追加时不交错写入
+        self.lock = threading.Lock()
+
+    def _path(self, run_id: str) -> str:
+        return os.path.join(self.directory, f"{run_id}.checkpoint")
+
+    def load(self, run_id: str) -> dict[tuple[str, int], bytes] | None:
+        try:
+            f = open(self._path(run_id), "rb")
+        except FileNotFoundError:
+            return None
+        entries = {}
+        with f:
+            while True:
+                try:
+                    entries.update(pickle.load(f))
+                except (EOFError, pickle.UnpicklingError):
+                    # 追加过程中失败时最后一条记录不完整，只丢弃这一条
+                    break
+        return entries
+
+    def append(self, run_id: str, entries: dict[tuple[str, int], bytes]):
+        os.makedirs(self.directory, exist_ok=True)
+        data = pickle.dumps(entries)
+        with self.lock, open(self._path(run_id), "ab") as f:
+            f.write(data)
+
+    def delete(self, run_id: str):
+        try:
+            os.unlink(self._path(run_id))
+        except FileNotFoundError:
+            pass
+
+
+class Checkpoint:
+    """一次运行的检查点
+
+    store: MemoryCheckpointStore、FileCheckpointStore或者实现了load/append/delete的对象，
+    append只写入上次保存之后新记录的执行，保存的开销与检查点的大小无关
+    run_id: 同一个run_id再次执行时，从保存的检查点恢复
+    save_interval: 每记录多少次执行保存一次，0表示只在失败时保存
+    """
+
+    def __init__(self, store, run_id: str, save_interval: int = 1):
+        self.store = store
+        self.run_id = run_id
+        self.save_interval = save_interval
+        # (节点id, 第几次执行) -> pickle后的[(期间发送的事件, 输出)]，格式同graph._execute_in_process
+        self.entries: dict[tuple[str, int], bytes] = store.load(run_id) or {}
+        self.replayed = 0  # 本次运行中重放的执行次数
+        self.occurrences: dict[str, int] = {}  # 节点id -> 本次运行中开始执行的次数
+        self.unsaved: dict[tuple[str, int], bytes] = {}
+        self.lock = threading.Lock()
+
+    def begin(self, node_id: str) -> tuple[int, list | None]:
+        """节点开始一次执行，返回这是第几次执行，以及记录的步骤（没有时为None）"""
+        with self.lock:
+            occurrence = self.occurrences.get(node_id, 0)
+            self.occurrences[node_id] = occurrence + 1
+            data = self.entries.get((node_id, occurrence))
+            if data is None:
+                return occurrence, None
+            self.replayed += 1
+        return occurrence, pickle.loads(data)
+
+    def record(self, node_id: str, occurrence: int, steps: list):
+        """记录节点一次完整执行的步骤"""
+        try:
+            data = pickle.dumps(steps)
+        except Exception:
+            return
+        with self.lock:
+            self.entries[(node_id, occurrence)] = data
+            self.unsaved[(node_id, occurrence)] = data
+            if self.save_interval <= 0 or len(self.unsaved) < self.save_interval:
+                return
+        self.save()
+
+    def scope(self, prefix: str) -> "CheckpointScope":
+        """一部分执行（如ParallelForEach的一次迭代）使用的检查点
+
+        节点id加上prefix后记录，执行次数在范围内单独计数，
+        并发执行的部分开始的先后顺序不影响记录的位置
+        """
+        return CheckpointScope(self, prefix)
+
+    def save(self):
+        """保存还没有保存的记录"""
+        with self.lock:
+            unsaved, self.unsaved = self.unsaved, {}
+        if unsaved:
+            self.store.append(self.run_id, unsaved)
+
+    def clear(self):
+        """运行成功后删除检查点"""
+        with self.lock:
+            self.entries = {}
+            self.unsaved = {}
+        self.store.delete(self.run_id)
+
+
+class CheckpointScope:
+    """Checkpoint.scope的结果，记录保存在原来的检查点中"""
+
+    def __init__(self, checkpoint: Checkpoint, prefix: str):
+        self.checkpoint = checkpoint
+        self.prefix = prefix
+
+    def begin(self, node_id: str) -> tuple[int, list | None]:
+        return self.checkpoint.begin(f"{self.prefix}/{node_id}")
+
+    def record(self, node_id: str, occurrence: int, steps: list):
+        self.checkpoint.record(f"{self.prefix}/{node_id}", occurrence, steps)
+
+    def scope(self, prefix: str) -> "CheckpointScope":
+        return CheckpointScope(self.checkpoint, f"{self.prefix}/{prefix}")
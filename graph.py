@@ -1,8 +1,28 @@
+import asyncio
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from concurrent.futures.process import BrokenProcessPool
+import copy
+import dataclasses
 from dataclasses import dataclass
 from enum import Enum
+import inspect
+import io
 import json
-from typing import Iterator
-from node_basic import NodeOutput, FetchInputsRequest
+import multiprocessing
+import pickle
+import threading
+from typing import Callable, Iterable, Iterator
+from node_basic import NodeOutput, FetchInputsRequest, MapRequest, Reference
+from profiler import Profiler
+from progress import EventBridge
+from result_cache import UnhashableInput, cache_key
+from stream import Stream
 
 
 class NodeExecutionType(Enum):
@@ -80,7 +100,7 @@ def parse_graph_data(graph_data: str) -> GraphData:
     return GraphData(nodes=nodes, edges=edges, route_edges=route_edges)
 
 
-@dataclass
+@dataclass(slots=True)
 class NodeInstance:
     """节点实例的运行时信息"""
 
@@ -88,292 +108,1596 @@ class NodeInstance:
     node_data: GraphNodeData  # 节点定义数据
     output_cache: dict[str, any]  # 输出值的缓存
     output_version: int  # 输出值的版本号
+    index: int = -1  # 节点在CompiledGraph中的下标
+    input_versions: tuple[int, ...] = None  # 纯节点的缓存是基于哪些上游版本计算出来的
+    controller: "Controller" = None  # 节点的控制器，首次执行时创建
 
 
-@dataclass
+@dataclass(slots=True)
 class Controller:
     send_event: lambda event, data: None
 
 
-@dataclass
+@dataclass(slots=True)
 class ExpandTask:
     node_instance: NodeInstance
     input_pins: list[str] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class ExecuteTask:
     node_instance: NodeInstance
 
 
-@dataclass
+@dataclass(slots=True)
 class IterateNextTask:
     node_instance: NodeInstance
     iterator: Iterator[NodeOutput | FetchInputsRequest]
     recollect_input_pins: list[str] = None
+    send_value: any = None  # 下一步发送给节点的值，如MapRequest的结果
 
 
-class GraphExecutor:
-    def __init__(self, node_defs: dict[str, tuple[any, dict]], graph: GraphData):
-        self.node_defs = node_defs
+@dataclass(slots=True)
+class VectorizedLoopTask:
+    node_instance: NodeInstance
+    plan: any  # vectorize.LoopPlan
+
+
+@dataclass(frozen=True)
+class NodeSpec:
+    """节点类型的引脚和标志，注册节点时根据meta构造一次，执行器不再遍历meta"""
+
+    input_names: tuple[str, ...]
+    lazy_inputs: frozenset[str]
+    eager_inputs: tuple[str, ...]  # 执行前需要收集的输入，即非lazy的输入
+    # 声明了"stream"的引脚，输出的值可能是Stream，输入可以增量读取Stream，见stream模块
+    stream_inputs: frozenset[str] = frozenset()
+    stream_outputs: frozenset[str] = frozenset()
+    pure: bool = False
+    # True时总是在进程池中执行，为输入引脚名时只在这个输入为真时在进程池中执行
+    cpu_bound: bool | str = False
+    checkpoint: bool = False
+    cache: bool = False
+    version: any = 0
+
+    @classmethod
+    def from_meta(cls, node_meta: dict) -> "NodeSpec":
+        inputs = [
+            input_meta
+            for input_meta in node_meta.get("inputs", [])
+            if input_meta.get("name") is not None
+        ]
+        input_names = tuple(input_meta["name"] for input_meta in inputs)
+        lazy = tuple(input_meta.get("lazy", False) for input_meta in inputs)
+        outputs = [
+            output_meta
+            for output_meta in node_meta.get("outputs", [])
+            if output_meta.get("name") is not None
+        ]
+        return cls(
+            input_names=input_names,
+            lazy_inputs=frozenset(
+                name for name, is_lazy in zip(input_names, lazy) if is_lazy
+            ),
+            eager_inputs=tuple(
+                name for name, is_lazy in zip(input_names, lazy) if not is_lazy
+            ),
+            stream_inputs=frozenset(
+                input_meta["name"] for input_meta in inputs if input_meta.get("stream")
+            ),
+            stream_outputs=frozenset(
+                output_meta["name"]
+                for output_meta in outputs
+                if output_meta.get("stream")
+            ),
+            pure=node_meta.get("pure", False),
+            cpu_bound=node_meta.get("cpu_bound", False),
+            checkpoint=node_meta.get("checkpoint", False),
+            cache=node_meta.get("cache", False),
+            version=node_meta.get("version", 0),
+        )
+
+
+class CompiledGraph:
+    """图的紧凑表示
+
+    节点id被映射为从0开始的整数下标，各种表都是按下标索引的列表，
+    执行器的热循环中不再需要通过字符串查找。
+    CompiledGraph只依赖图的结构和节点定义，可以被多个GraphExecutor共享。
+    """
+
+    def __init__(
+        self, node_defs: dict[str, tuple[any, dict, NodeSpec]], graph: GraphData
+    ):
         self.graph = graph
-        self.id_to_node_data = {node.id: node for node in graph.nodes}
-        self.node_instances: dict[str, NodeInstance] = {}  # id -> NodeInstance
+        self.node_ids: list[str] = [node.id for node in graph.nodes]
+        self.node_index: dict[str, int] = {
+            node_id: index for index, node_id in enumerate(self.node_ids)
+        }
+        self.node_datas: list[GraphNodeData] = list(graph.nodes)
+        self.execution_types: list[NodeExecutionType] = [
+            node.execution_type for node in graph.nodes
+        ]
+        self.node_classes: list[any] = []
+        self.node_metas: list[dict] = []
+        self.node_specs: list[NodeSpec] = []
+        for node in graph.nodes:
+            if node.node_type not in node_defs:
+                raise ValueError(f"node {node.id} has unknown type {node.node_type}")
+            node_class, node_meta, node_spec = node_defs[node.node_type]
+            self.node_classes.append(node_class)
+            self.node_metas.append(node_meta)
+            self.node_specs.append(node_spec)
         self.data_inputs = self._build_data_inputs()
         self.data_dependencies = self._build_data_dependencies()
+        self.eager_inputs = self._build_eager_inputs()
+        self.materialized_inputs = self._build_materialized_inputs()
         self.routes = self._build_routes()
+        self.memo_sources = self._build_memo_sources()
+        # meta中声明了"cpu_bound"的节点会被交给进程池执行
+        self.cpu_bound: list[bool | str] = [
+            node_spec.cpu_bound for node_spec in self.node_specs
+        ]
+        # DATA_ONCE节点和meta中声明了"checkpoint"的节点的执行会被记录到检查点中
+        self.checkpointed: list[bool] = [
+            execution_type == NodeExecutionType.DATA_ONCE or node_spec.checkpoint
+            for execution_type, node_spec in zip(self.execution_types, self.node_specs)
+        ]
+        # meta中声明了"cache"的节点的结果会被缓存到跨运行的结果缓存中
+        self.cached: list[bool] = [node_spec.cache for node_spec in self.node_specs]
+        # 循环节点 -> 向量化执行计划，由vectorize模块按需分析并缓存
+        self.loop_plans: dict[int, any] = {}
+        # 输出缓存的活跃性分析，由liveness模块按需计算并缓存
+        self.liveness = None
 
     def _build_data_inputs(
         self,
-    ) -> dict[
-        str, dict[str, (str, str, bool)]
-    ]:  # target_id -> target_pin -> (source_id, source_pin)
+    ) -> list[
+        dict[str, tuple[int, str]]
+    ]:  # target -> target_pin -> (source, source_pin)
         """构造节点输入表"""
-        inputs = {}
+        inputs = [{} for _ in self.node_ids]
         for edge in self.graph.edges:
-            if edge.target_id not in inputs:
-                inputs[edge.target_id] = {}
-
-            inputs[edge.target_id][edge.target_pin] = (edge.source_id, edge.source_pin)
+            inputs[self.node_index[edge.target_id]][edge.target_pin] = (
+                self.node_index[edge.source_id],
+                edge.source_pin,
+            )
         return inputs
 
     def _build_data_dependencies(
         self,
-    ) -> dict[str, set[str]]:  # target_id -> set[source_id]
-        """构造节点数据依赖表"""
-        dependencies = {node.id: set() for node in self.graph.nodes}
+    ) -> list[tuple[int, ...]]:  # target -> (source, ...)
+        """构造节点数据依赖表
+
+        只包含非lazy输入的非TRIGGERED上游节点，按边的顺序去重
+        """
+        dependencies = [{} for _ in self.node_ids]
         for edge in self.graph.edges:
-            # 获取目标节点的元数据
-            target_node_data = self.id_to_node_data[edge.target_id]
-            _, target_node_meta = self.node_defs[target_node_data.node_type]
+            target = self.node_index[edge.target_id]
+            source = self.node_index[edge.source_id]
+            if self.execution_types[source] == NodeExecutionType.TRIGGERED:
+                continue
+            if edge.target_pin not in self.node_specs[target].lazy_inputs:
+                dependencies[target][source] = None
+        return [tuple(sources) for sources in dependencies]
+
+    def _build_eager_inputs(
+        self,
+    ) -> list[
+        tuple[dict[str, any], tuple[tuple[str, int, str], ...]]
+    ]:  # node -> (固定输入, ((target_pin, source, source_pin), ...))
+        """构造执行前需要收集的输入，即非lazy引脚上的固定输入和数据边
 
-            # 检查input pin是否为lazy
-            input_is_lazy = False
-            for input_meta in target_node_meta.get("inputs", []):
-                if input_meta["name"] == edge.target_pin:
-                    if input_meta.get("lazy", False):
-                        input_is_lazy = True
+        固定输入中被数据边覆盖的引脚保留原来的位置，结果和_collect_inputs_on_pins相同
+        """
+        return [self._eager_inputs_of(node) for node in range(len(self.node_ids))]
 
-            if not input_is_lazy:
-                dependencies[edge.target_id].add(edge.source_id)
-        return dependencies
+    def _eager_inputs_of(
+        self, node: int
+    ) -> tuple[dict[str, any], tuple[tuple[str, int, str], ...]]:
+        pins = self.node_specs[node].eager_inputs
+        constants = {
+            key: value
+            for key, value in (self.node_datas[node].inputs or {}).items()
+            if key in pins
+        }
+        sources = tuple(
+            (target_pin, source, source_pin)
+            for target_pin, (source, source_pin) in self.data_inputs[node].items()
+            if target_pin in pins
+        )
+        return constants, sources
+
+    def with_inputs(self, overrides: dict[str, dict[str, any]]) -> "CompiledGraph":
+        """替换了部分节点固定输入的副本
+
+        overrides为节点id -> 引脚 -> 值。副本共享图结构和所有的表，只复制节点数据和固定输入表，
+        并重新构造被替换的节点的固定输入
+        """
+        if not overrides:
+            return self
+        compiled = copy.copy(self)
+        compiled.node_datas = list(self.node_datas)
+        compiled.eager_inputs = list(self.eager_inputs)
+        # 向量化计划会读取固定输入，不能共享
+        compiled.loop_plans = {}
+        for node_id, inputs in overrides.items():
+            node = self.node_index.get(node_id)
+            if node is None:
+                raise ValueError(f"unknown node {node_id}")
+            node_data = self.node_datas[node]
+            compiled.node_datas[node] = dataclasses.replace(
+                node_data, inputs={**(node_data.inputs or {}), **inputs}
+            )
+            compiled.eager_inputs[node] = compiled._eager_inputs_of(node)
+        return compiled
+
+    def _build_materialized_inputs(
+        self,
+    ) -> list[tuple[str, ...]]:  # node -> (target_pin, ...)
+        """构造收集输入时需要合并Stream的引脚，即连接到流式输出的非流式输入"""
+        materialized_inputs = []
+        for node, node_spec in enumerate(self.node_specs):
+            materialized_inputs.append(
+                tuple(
+                    target_pin
+                    for target_pin, (source, source_pin) in self.data_inputs[
+                        node
+                    ].items()
+                    if source_pin in self.node_specs[source].stream_outputs
+                    and target_pin not in node_spec.stream_inputs
+                )
+            )
+        return materialized_inputs
+
+    def _build_memo_sources(
+        self,
+    ) -> list[tuple[int, ...] | None]:  # node -> (source, ...)
+        """构造纯数据节点的上游节点表
+
+        meta中声明了"pure"的DATA节点，输出只由输入决定。记录它非lazy输入的上游节点，
+        上游输出版本都没有变化时可以直接复用缓存。其它节点为None
+        """
+        memo_sources = []
+        for node, node_spec in enumerate(self.node_specs):
+            if (
+                self.execution_types[node] != NodeExecutionType.DATA
+                or not node_spec.pure
+            ):
+                memo_sources.append(None)
+                continue
+            lazy_pins = node_spec.lazy_inputs
+            sources = {}
+            for target_pin, (source, _) in self.data_inputs[node].items():
+                if target_pin not in lazy_pins:
+                    sources[source] = None
+            memo_sources.append(tuple(sources))
+        return memo_sources
 
     def _build_routes(
         self,
-    ) -> dict[str, dict[str, str]]:  # source_id -> source_pin -> target_id
-        """构造节点路由表"""
-        routes = {
-            node.id: {}
-            for node in self.graph.nodes
-            if node.execution_type == NodeExecutionType.TRIGGERED
-        }
+    ) -> list[dict[str, tuple[int, ...]] | None]:  # source -> source_pin -> targets
+        """构造节点路由表，数据节点没有路由表
+
+        同一个引脚可以连到多个目标节点，按路由边在图中的顺序依次触发
+        """
+        routes = [
+            {} if execution_type == NodeExecutionType.TRIGGERED else None
+            for execution_type in self.execution_types
+        ]
         for edge in self.graph.route_edges:
-            if edge.source_id not in routes:
+            source_routes = routes[self.node_index[edge.source_id]]
+            if source_routes is None:
                 raise ValueError(
                     f"node {edge.source_id} is a data node, but has route edges"
                 )
-            routes[edge.source_id][edge.source_pin] = edge.target_id
+            targets = source_routes.get(edge.source_pin, ())
+            source_routes[edge.source_pin] = targets + (
+                self.node_index[edge.target_id],
+            )
         return routes
 
+
+class DependencyCycleError(ValueError):
+    """数据依赖有环，cycle是环上的节点id，首尾相同"""
+
+    def __init__(self, cycle: list[str]):
+        super().__init__(f"检测到循环依赖: {' -> '.join(cycle)}")
+        self.cycle = cycle
+
+
+def topological_sort(
+    compiled: CompiledGraph,
+    target: int,
+    dependencies: Iterable[int],
+    get_dependencies: Callable[[int], Iterable[int] | None],
+) -> list[int]:
+    """按依赖的顺序深度优先遍历，返回目标节点及其依赖的执行顺序（目标节点在最后）
+
+    dependencies是目标节点的依赖，get_dependencies返回其它节点的依赖，返回None的节点不加入结果。
+    使用显式的栈而不是递归，很深的依赖链不会超出Python的递归限制。
+    """
+    result = []
+    visited = set()
+    path = [target]  # 从目标节点到当前节点的路径
+    path_positions = {target: 0}
+    stack = [iter(dependencies)]
+    while stack:
+        for dependency in stack[-1]:
+            if dependency in visited:
+                continue
+            position = path_positions.get(dependency)
+            if position is not None:
+                raise DependencyCycleError(
+                    [compiled.node_ids[node] for node in path[position:]]
+                    + [compiled.node_ids[dependency]]
+                )
+            dependency_dependencies = get_dependencies(dependency)
+            if dependency_dependencies is None:
+                visited.add(dependency)
+                continue
+            path_positions[dependency] = len(path)
+            path.append(dependency)
+            stack.append(iter(dependency_dependencies))
+            break
+        else:
+            stack.pop()
+            node = path.pop()
+            del path_positions[node]
+            visited.add(node)
+            result.append(node)
+    return result
+
+
+class GraphExecutor:
+    def __init__(
+        self,
+        node_defs: dict[str, tuple[any, dict, NodeSpec]],
+        graph: GraphData,
+        compiled: CompiledGraph | None = None,
+        max_workers: int = 0,
+        use_process_pool: bool = True,
+        vectorize_loops: bool = False,
+        use_compiler: bool = False,
+        checkpoint=None,
+        result_cache=None,
+        profile: bool = False,
+        release_outputs: bool = False,
+    ):
+        """max_workers大于0时，一个节点的多个独立数据依赖会在线程池中并行执行
+
+        use_process_pool为True时，cpu_bound节点在共享的进程池中执行
+        vectorize_loops为True时，满足条件的循环用NumPy数组运算一次执行完，见vectorize模块
+        use_compiler为True时，把图编译成Python函数执行，见graph_compiler模块。
+        编译后的代码不使用max_workers、vectorize_loops和release_outputs，设置了它们时仍然解释执行
+        checkpoint为checkpoint.Checkpoint时，记录节点的输出，失败后可以用同一个检查点恢复执行
+        result_cache为result_cache模块中的缓存时，声明了"cache"的节点的结果跨运行缓存
+        profile为True时统计每个节点和调度器的耗时，结果在finish事件的"profile"中
+        release_outputs为True时，释放之后不会再被读取的输出缓存，见liveness模块。
+        同时统计输出缓存占用的字节数，峰值在finish事件的"peak_retained_bytes"中
+        """
+        self.node_defs = node_defs
+        self.graph = graph
+        self.compiled = (
+            compiled if compiled is not None else CompiledGraph(node_defs, graph)
+        )
+        # 下标 -> NodeInstance，首次使用时创建
+        self.node_instances: list[NodeInstance | None] = [None] * len(
+            self.compiled.node_ids
+        )
+        # (node, pins) -> 执行顺序，避免每次展开都重新拓扑排序
+        self.execution_orders: dict[tuple[int, tuple[str, ...] | None], list[int]] = {}
+        # DATA_ONCE节点 -> 依赖该节点尚未缓存这一状态的执行顺序key
+        self.execution_order_dependents: dict[int, set[tuple]] = {}
+        self.progress_callback = lambda x: None
+        self.max_workers = max_workers
+        self.use_process_pool = use_process_pool
+        self.vectorize_loops = vectorize_loops
+        self.use_compiler = use_compiler
+        self.checkpoint = checkpoint
+        # Map节点id -> 执行的次数，用于区分每次执行的迭代的检查点范围
+        self.map_occurrences: dict[str, int] = {}
+        self.result_cache = result_cache
+        self.profiler: Profiler | None = None
+        if profile:
+            self._enable_profiler(Profiler())
+        self.thread_pool: ThreadPoolExecutor | None = None
+        # ParallelForEach的迭代在其它线程中创建执行器和交回DATA_ONCE节点的输出时使用
+        self.fork_lock = threading.Lock()
+        self.release_outputs = release_outputs
+        self.liveness = None
+        # 节点 -> 输出缓存的估计字节数，启用release_outputs时统计
+        self.output_sizes: list[int] | None = None
+        self.retained_bytes = 0
+        self.peak_retained_bytes = 0
+        if release_outputs:
+            from liveness import get_liveness
+
+            self.liveness = get_liveness(self.compiled)
+            self.output_sizes = [0] * len(self.compiled.node_ids)
+
+    def _enable_profiler(self, profiler: Profiler):
+        """用统计耗时的版本覆盖需要统计的方法，不启用时没有任何额外开销"""
+        self.profiler = profiler
+        self._get_execution_order = profiler.wrap_scheduler(
+            "get_execution_order", self._get_execution_order
+        )
+        self._collect_inputs = profiler.wrap_scheduler(
+            "collect_inputs", self._collect_inputs
+        )
+        self._collect_inputs_on_pins = profiler.wrap_scheduler(
+            "collect_inputs", self._collect_inputs_on_pins
+        )
+        self._create_outputs_iterator = profiler.wrap_create_outputs_iterator(
+            self._create_outputs_iterator
+        )
+
+    def _finish_event(self) -> dict[str, any]:
+        event = {"event": "finish"}
+        if self.profiler is not None:
+            self.profiler.stop()
+            event["profile"] = self.profiler.summary()
+        if self.release_outputs:
+            event["peak_retained_bytes"] = self.peak_retained_bytes
+        return event
+
     def _get_execution_order(
-        self, target_node_id: str, pins: list[str] | None = None
-    ) -> list[str]:
-        """使用拓扑排序确定执行顺序"""
-        result = []
-        visited = set()
-        processing = set()
-
-        def visit(node_id: str, pins: list[str] | None = None):
-            if node_id in processing:
-                raise ValueError(f"检测到循环依赖，包含节点: {node_id}")
-            if node_id in visited:
-                return
-            if (
-                self.id_to_node_data[node_id].execution_type
-                == NodeExecutionType.DATA_ONCE
-                and self._get_node_instance(node_id).output_cache is not None
-            ):
-                return
-            processing.add(node_id)
-            if pins is None:
-                dependencies = self.data_dependencies.get(node_id, set())
-            else:
-                dependencies = set()
-                for pin in pins:
-                    data_inputs = self.data_inputs.get(node_id, None)
-                    if data_inputs is None:
-                        continue
-                    source_id, _ = data_inputs.get(pin, (None, None))
-                    if source_id is None:
-                        continue
-                    dependencies.add(source_id)
-            for dep_id in dependencies:
-                if (
-                    self.id_to_node_data[dep_id].execution_type
-                    == NodeExecutionType.TRIGGERED
-                ):
-                    continue
-                visit(dep_id)
-            processing.remove(node_id)
-            visited.add(node_id)
-            result.append(node_id)
+        self, target_node: int, pins: list[str] | None = None
+    ) -> list[int]:
+        """获取执行顺序，优先使用缓存的结果
 
-        visit(target_node_id, pins)
-        return result
+        返回的列表会被缓存复用，调用方不应修改它
+        """
+        key = (target_node, tuple(pins) if pins is not None else None)
+        execution_order = self.execution_orders.get(key)
+        if execution_order is None:
+            execution_order, pending_data_once = self._compute_execution_order(
+                target_node, pins
+            )
+            self.execution_orders[key] = execution_order
+            for node in pending_data_once:
+                self.execution_order_dependents.setdefault(node, set()).add(key)
+        return execution_order
 
-    def _get_node_instance(self, node_id: str) -> NodeInstance:
+    def _invalidate_execution_orders(self, data_once_node: int):
+        """DATA_ONCE节点产生缓存后，只丢弃经过该节点的执行顺序"""
+        for key in self.execution_order_dependents.pop(data_once_node, ()):
+            self.execution_orders.pop(key, None)
+
+    def _compute_execution_order(
+        self, target_node: int, pins: list[str] | None = None
+    ) -> tuple[list[int], set[int]]:
+        """使用拓扑排序确定执行顺序
+
+        同时返回遍历中遇到的尚未缓存的DATA_ONCE节点，它们缓存后执行顺序需要重新计算
+        """
+        compiled = self.compiled
+        pending_data_once = set()
+
+        def get_dependencies(node: int) -> tuple[int, ...] | None:
+            if compiled.execution_types[node] == NodeExecutionType.DATA_ONCE:
+                if self._get_node_instance(node).output_cache is not None:
+                    return None
+                pending_data_once.add(node)
+            return compiled.data_dependencies[node]
+
+        dependencies = get_dependencies(target_node)
+        if dependencies is None:
+            return [], pending_data_once
+        if pins is not None:
+            dependencies = {}
+            data_inputs = compiled.data_inputs[target_node]
+            for pin in pins:
+                source, _ = data_inputs.get(pin, (None, None))
+                if source is None:
+                    continue
+                if compiled.execution_types[source] == NodeExecutionType.TRIGGERED:
+                    continue
+                dependencies[source] = None
+        result = topological_sort(compiled, target_node, dependencies, get_dependencies)
+        return result, pending_data_once
+
+    def _get_node_instance(self, node: int) -> NodeInstance:
         """获取或创建节点实例"""
-        if node_id not in self.node_instances:
-            node_data = self.id_to_node_data[node_id]
-            node_class, _ = self.node_defs[node_data.node_type]
-            self.node_instances[node_id] = NodeInstance(
-                instance=node_class(),
-                node_data=node_data,
+        node_instance = self.node_instances[node]
+        if node_instance is None:
+            node_instance = NodeInstance(
+                instance=self.compiled.node_classes[node](),
+                node_data=self.compiled.node_datas[node],
                 output_cache=None,
                 output_version=0,
+                index=node,
+            )
+            self.node_instances[node] = node_instance
+        return node_instance
+
+    def _get_controller(self, node_instance: NodeInstance) -> Controller:
+        """获取节点的控制器，每个节点实例只创建一次"""
+        if node_instance.controller is None:
+            node_id = node_instance.node_data.id
+            progress_callback = self.progress_callback
+            node_instance.controller = Controller(
+                send_event=lambda event, data: progress_callback(
+                    {"event": event, "node_id": node_id, "data": data}
+                ),
+            )
+        return node_instance.controller
+
+    def _get_input_versions(self, sources: tuple[int, ...]) -> tuple[int, ...]:
+        return tuple(
+            self._get_node_instance(source).output_version for source in sources
+        )
+
+    def _is_memoized(self, node_instance: NodeInstance) -> bool:
+        """纯数据节点的上游输出都没有变化时，缓存的输出仍然有效"""
+        sources = self.compiled.memo_sources[node_instance.index]
+        return (
+            sources is not None
+            and node_instance.output_cache is not None
+            and node_instance.input_versions == self._get_input_versions(sources)
+        )
+
+    def _set_output(self, node_instance: NodeInstance, data: dict[str, any]):
+        """记录节点的一次输出"""
+        if (
+            node_instance.output_cache is None
+            and node_instance.node_data.execution_type == NodeExecutionType.DATA_ONCE
+        ):
+            self._invalidate_execution_orders(node_instance.index)
+        node_instance.output_cache = data
+        node_instance.output_version += 1
+        memo_sources = self.compiled.memo_sources[node_instance.index]
+        if memo_sources is not None:
+            node_instance.input_versions = self._get_input_versions(memo_sources)
+        if self.output_sizes is not None:
+            self._track_output_size(node_instance.index, data)
+
+    def _track_output_size(self, node: int, data: dict[str, any]):
+        from liveness import estimate_size
+
+        size = sum(estimate_size(value) for value in data.values())
+        self.retained_bytes += size - self.output_sizes[node]
+        self.output_sizes[node] = size
+        if self.retained_bytes > self.peak_retained_bytes:
+            self.peak_retained_bytes = self.retained_bytes
+
+    def _release_outputs(self, node_instance: NodeInstance, task_stack: list):
+        """节点结束时，释放任务栈中的节点都不会再读取的输出"""
+        candidates = self.liveness.candidates[node_instance.index]
+        if not candidates:
+            return
+        liveness = self.liveness
+        live = {task.node_instance.index for task in task_stack}
+        if any(liveness.start[node] is None for node in live):
+            # 栈中有数据节点时，不逐个分析它会读取的输出，这次不释放
+            return
+        for source in candidates:
+            source_instance = self.node_instances[source]
+            if source_instance is None or source_instance.output_cache is None:
+                continue
+            if any(liveness.is_read_after(source, node) for node in live):
+                continue
+            source_instance.output_cache = None
+            self.retained_bytes -= self.output_sizes[source]
+            self.output_sizes[source] = 0
+
+    def _run_data_node(
+        self, node_instance: NodeInstance, inputs: dict[str, any]
+    ) -> tuple[list[dict], list[NodeOutput], Exception | None]:
+        """在工作线程中执行一个数据节点
+
+        进度事件不直接发送，而是和输出一起返回，由调度线程按执行顺序发送
+        """
+        node_id = node_instance.node_data.id
+        events = []
+        outputs = []
+        controller = Controller(
+            send_event=lambda event, data: events.append(
+                {"event": event, "node_id": node_id, "data": data}
+            )
+        )
+        try:
+            outputs_iterator = self._create_outputs_iterator(
+                node_instance, controller, inputs, asynchronous=False
+            )
+            while True:
+                events.append({"event": "execute_node", "node_id": node_id})
+                try:
+                    output = next(outputs_iterator)
+                except StopIteration:
+                    break
+                if not isinstance(output, NodeOutput):
+                    raise ValueError(
+                        f"node {node_id} requested inputs, which is not supported in parallel execution"
+                    )
+                outputs.append(output)
+                if output.execution_pin is None or output.execution_pin == "_":
+                    break
+        except Exception as e:
+            events.append(
+                {
+                    "event": "execute_node_error",
+                    "node_id": node_id,
+                    "node_error": repr(e),
+                }
+            )
+            return events, outputs, e
+        return events, outputs, None
+
+    def _get_thread_pool(self) -> ThreadPoolExecutor:
+        """并行执行数据节点的线程池，首次使用时创建，由execute在结束时关闭"""
+        if self.thread_pool is None:
+            self.thread_pool = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="graph-executor"
             )
-        return self.node_instances[node_id]
+        return self.thread_pool
+
+    def _execute_in_parallel(self, nodes: list[int]):
+        """在线程池中并行执行一组数据节点
+
+        nodes是拓扑排序后的执行顺序，节点在它的依赖都完成后提交到线程池。
+        输出和进度事件都在调度线程按执行顺序提交，结果和事件顺序与串行执行相同，
+        只是节点执行过程中发送的事件要等节点完成后才发出。
+        节点执行或者收集输入出错时，只继续执行排在最早出错节点之前的节点，然后抛出该节点的异常，
+        报告的错误和事件与串行执行相同
+        """
+        thread_pool = self._get_thread_pool()
+        positions = {node: position for position, node in enumerate(nodes)}
+        waiting = [0] * len(nodes)  # 尚未完成的依赖数
+        dependents = [[] for _ in nodes]
+        for position, node in enumerate(nodes):
+            for source in self.compiled.data_dependencies[node]:
+                source_position = positions.get(source)
+                if source_position is not None:
+                    waiting[position] += 1
+                    dependents[source_position].append(position)
+
+        results = [None] * len(nodes)  # position -> (events, error)
+        running = {}  # future -> position
+        ready = [position for position in range(len(nodes)) if waiting[position] == 0]
+        first_error = len(nodes)
+        next_flush = 0
+
+        def finish(position):
+            for dependent in dependents[position]:
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0:
+                    ready.append(dependent)
+
+        while ready or running:
+            while ready:
+                position = ready.pop()
+                if position > first_error:
+                    continue
+                node_instance = self._get_node_instance(nodes[position])
+                if self._is_memoized(node_instance):
+                    results[position] = ([], None)
+                    finish(position)
+                    continue
+                try:
+                    inputs = self._collect_inputs(node_instance.index)
+                except Exception as e:
+                    # 与串行执行一样，收集输入失败的节点没有事件，按执行顺序决定报告哪个错误
+                    results[position] = ([], e)
+                    first_error = min(first_error, position)
+                    continue
+                future = thread_pool.submit(self._run_data_node, node_instance, inputs)
+                running[future] = position
+            if running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    position = running.pop(future)
+                    events, outputs, error = future.result()
+                    node_instance = self.node_instances[nodes[position]]
+                    for output in outputs:
+                        self._set_output(node_instance, output.data)
+                    results[position] = (events, error)
+                    if error is None:
+                        finish(position)
+                    else:
+                        first_error = min(first_error, position)
+            while next_flush < first_error and results[next_flush] is not None:
+                for event in results[next_flush][0]:
+                    self.progress_callback(event)
+                next_flush += 1
 
-    def _collect_inputs_on_pins(self, node_id: str, pins: list[str]) -> dict[str, any]:
+        if first_error < len(nodes):
+            events, error = results[first_error]
+            for event in events:
+                self.progress_callback(event)
+            raise error
+
+    def _collect_inputs_on_pins(self, node: int, pins: list[str]) -> dict[str, any]:
         result = {}
         pins_set = set(pins)
-        node_data = self.id_to_node_data[node_id]
+        node_data = self.compiled.node_datas[node]
         if node_data.inputs:
             for key, value in node_data.inputs.items():
                 if key in pins_set:
                     result[key] = value
-        inputs = self.data_inputs.get(node_id, {})
-        for target_pin, (source_id, source_pin) in inputs.items():
-            node_instance = self._get_node_instance(source_id)
+        for target_pin, (source, source_pin) in self.compiled.data_inputs[node].items():
             if not target_pin in pins_set:
                 continue
+            node_instance = self._get_node_instance(source)
             if node_instance.output_cache is None:
                 raise ValueError(
-                    f"node {node_id} depends on node {source_id}, but node {source_id} has not been executed yet."
+                    f"node {node_data.id} depends on node {node_instance.node_data.id}, but node {node_instance.node_data.id} has not been executed yet."
                 )
             result[target_pin] = node_instance.output_cache[source_pin]
+        if self.compiled.materialized_inputs[node]:
+            _materialize_streams(result, self.compiled.materialized_inputs[node])
         return result
 
-    def _collect_inputs(self, node_id: str) -> dict[str, any]:
-        node_data = self.id_to_node_data[node_id]
-        _, node_meta = self.node_defs[node_data.node_type]
-        pins = []
-        node_inputs = node_meta.get("inputs")
-        if node_inputs is not None:
-            for input_meta in node_inputs:
-                name = input_meta["name"]
-                if name is not None and not input_meta.get("lazy", False):
-                    pins.append(name)
-        return self._collect_inputs_on_pins(node_id, pins)
-
-    def _get_route_targets(self, node_id: str, pin: str) -> list[str]:
+    def _collect_inputs(self, node: int) -> dict[str, any]:
+        """收集节点所有非lazy的输入
+
+        返回新的字典，调用方会把它作为节点的参数、缓存键或者检查点的一部分保留下来，
+        所以每次调用复制一次预先构造的固定输入
+        """
+        constants, sources = self.compiled.eager_inputs[node]
+        result = dict(constants)
+        for target_pin, source, source_pin in sources:
+            output_cache = self._get_node_instance(source).output_cache
+            if output_cache is None:
+                node_id = self.compiled.node_ids[node]
+                source_id = self.compiled.node_ids[source]
+                raise ValueError(
+                    f"node {node_id} depends on node {source_id}, but node {source_id} has not been executed yet."
+                )
+            result[target_pin] = output_cache[source_pin]
+        if self.compiled.materialized_inputs[node]:
+            _materialize_streams(result, self.compiled.materialized_inputs[node])
+        return result
+
+    async def _materialize_streams_async(self, node: int, pins: list[str] | None):
+        """异步执行时在事件循环中先读完输入的Stream，之后收集输入时不再阻塞"""
+        for target_pin in self.compiled.materialized_inputs[node]:
+            if pins is not None and target_pin not in pins:
+                continue
+            source, source_pin = self.compiled.data_inputs[node][target_pin]
+            output_cache = self._get_node_instance(source).output_cache
+            if output_cache is None:
+                continue
+            value = output_cache.get(source_pin)
+            if isinstance(value, Stream):
+                await value.materialize_async()
+
+    def _get_route_targets(self, node: int, pin: str) -> list[int]:
         """获取路由边的目标节点"""
-        return [
-            edge.target_id
-            for edge in self.graph.route_edges
-            if edge.source_id == node_id and edge.source_pin == pin
-        ]
+        routes = self.compiled.routes[node]
+        if routes is None:
+            return []
+        return list(routes.get(pin, ()))
 
     def _follow_route(self, node_instance, execution_pin, task_stack):
-        """根据路由和执行引脚，将下一个节点添加到任务栈中"""
-        routes = self.routes.get(node_instance.node_data.id, None)
+        """根据路由和执行引脚，将下一个节点添加到任务栈中
+
+        有多个目标时逆序入栈，保证按路由边的顺序执行，前一个分支执行完才执行下一个
+        """
+        routes = self.compiled.routes[node_instance.index]
         if routes is not None:
-            target_node_id = routes.get(execution_pin, None)
-            if target_node_id is not None:
-                next_instance = self._get_node_instance(target_node_id)
-                task_stack.append(ExpandTask(node_instance=next_instance))
+            target_nodes = routes.get(execution_pin, None)
+            if target_nodes is not None:
+                for target_node in reversed(target_nodes):
+                    next_instance = self._get_node_instance(target_node)
+                    task_stack.append(ExpandTask(node_instance=next_instance))
 
     def execute(self, progress_callback=lambda x: None):
         """执行整个图"""
-        task_stack = []
-        task_stack.append(ExpandTask(node_instance=self._get_node_instance("start")))
+        self.progress_callback = progress_callback
+        if self.profiler is not None:
+            self.profiler.start()
+        try:
+            if not self._run_compiled():
+                start_node = self.compiled.node_index["start"]
+                self._run(
+                    [ExpandTask(node_instance=self._get_node_instance(start_node))]
+                )
+        except BaseException:
+            if self.checkpoint is not None:
+                self.checkpoint.save()
+            raise
+        finally:
+            if self.thread_pool is not None:
+                self.thread_pool.shutdown()
+                self.thread_pool = None
+        if self.checkpoint is not None:
+            self.checkpoint.clear()
+        progress_callback(self._finish_event())
+
+    def _run_compiled(self) -> bool:
+        """用编译后的函数执行整个图，不能编译时返回False"""
+        if (
+            not self.use_compiler
+            or self.max_workers > 0
+            or self.vectorize_loops
+            or self.release_outputs
+        ):
+            return False
+        from graph_compiler import run_compiled
+
+        return run_compiled(self)
+
+    async def execute_async(self, progress_callback=lambda x: None):
+        """在当前事件循环中执行整个图
+
+        异步节点直接在事件循环中执行，同步节点的每一步都交给事件循环的默认线程池，
+        不会阻塞事件循环。progress_callback总是在事件循环所在的线程中被调用，
+        其它线程中的事件经过EventBridge批量交给事件循环。
+        异步执行时不使用max_workers的并行模式
+        """
+        # 调用者传入的EventBridge由调用者关闭，例如ProgressPipeline.bridge()
+        owned_bridge = None
+        if isinstance(progress_callback, EventBridge):
+            self.progress_callback = progress_callback
+        else:
+            owned_bridge = EventBridge(progress_callback)
+            self.progress_callback = owned_bridge
+        if self.profiler is not None:
+            self.profiler.start()
+        start_node = self.compiled.node_index["start"]
+        loop = asyncio.get_running_loop()
+        try:
+            try:
+                await self._run_async(
+                    [ExpandTask(node_instance=self._get_node_instance(start_node))]
+                )
+            except BaseException:
+                if self.checkpoint is not None:
+                    await loop.run_in_executor(None, self.checkpoint.save)
+                raise
+            if self.checkpoint is not None:
+                await loop.run_in_executor(None, self.checkpoint.clear)
+            self.progress_callback(self._finish_event())
+        finally:
+            # 返回前交出其它线程中还没有交给progress_callback的事件
+            if owned_bridge is not None:
+                owned_bridge.close()
+
+    def _run(self, task_stack: list):
+        """不断执行任务栈中的任务，直到栈为空"""
         while len(task_stack) > 0:
             next_task = task_stack.pop()
             match next_task:
                 case ExpandTask(node_instance, input_pins):
-                    execution_order = self._get_execution_order(
-                        node_instance.node_data.id, input_pins
-                    )
-                    if input_pins is not None:  # 说明节点本身已经执行过了，不需要再执行
-                        execution_order = execution_order[:-1]
-                    for node_id in reversed(execution_order):
-                        task_stack.append(
-                            ExecuteTask(node_instance=self._get_node_instance(node_id))
-                        )
+                    self._expand(node_instance, input_pins, task_stack, parallel=True)
                 case ExecuteTask(node_instance):
-                    inputs = self._collect_inputs(node_instance.node_data.id)
-                    controller = Controller(
-                        send_event=lambda event, data: progress_callback(
-                            {
-                                "event": event,
-                                "node_id": node_instance.node_data.id,
-                                "data": data,
-                            }
-                        ),
-                    )
-                    outputs_iterator = node_instance.instance.execute(
-                        controller=controller, **inputs
-                    )
-                    task_stack.append(
-                        IterateNextTask(
-                            node_instance=node_instance, iterator=outputs_iterator
-                        )
-                    )
-                case IterateNextTask(
-                    node_instance, outputs_iterator, recollect_input_pins
-                ):
-                    progress_callback(
-                        {"event": "execute_node", "node_id": node_instance.node_data.id}
+                    self._start(node_instance, task_stack, asynchronous=False)
+                case VectorizedLoopTask(node_instance, plan):
+                    self._run_vectorized_loop(
+                        node_instance, plan, task_stack, asynchronous=False
                     )
-                    execution_pin = "_"
-                    recollected_inputs = None
-                    if recollect_input_pins is not None:
-                        collected_inputs = self._collect_inputs_on_pins(
-                            node_instance.node_data.id, recollect_input_pins
-                        )
-                        recollected_inputs = map(
-                            lambda pin: collected_inputs[pin], recollect_input_pins
-                        )
+                case IterateNextTask(node_instance, outputs_iterator):
+                    send_value = self._begin_step(next_task)
                     try:
-                        output = outputs_iterator.send(recollected_inputs)
+                        output = outputs_iterator.send(send_value)
                     except StopIteration:
                         output = None
                     except Exception as e:
-                        progress_callback(
-                            {
-                                "event": "execute_node_error",
-                                "node_id": node_instance.node_data.id,
-                                "node_error": repr(e),
-                            }
-                        )
+                        self._report_error(node_instance, e)
                         raise e
-                    match output:
-                        case NodeOutput():
-                            node_instance.output_cache = output.data
-                            node_instance.output_version += 1
-                            if output.execution_pin is not None:
-                                execution_pin = output.execution_pin
-                            if execution_pin != "_":
-                                task_stack.append(
-                                    IterateNextTask(
-                                        node_instance=node_instance,
-                                        iterator=outputs_iterator,
-                                    )
-                                )
-                            self._follow_route(node_instance, execution_pin, task_stack)
-                        case FetchInputsRequest(input_pins):
-                            task_stack.append(
-                                IterateNextTask(
-                                    node_instance=node_instance,
-                                    iterator=outputs_iterator,
-                                    recollect_input_pins=input_pins,
-                                )
-                            )
-                            task_stack.append(
-                                ExpandTask(
-                                    node_instance=node_instance, input_pins=input_pins
-                                )
+                    if isinstance(output, MapRequest):
+                        next_task.send_value = self._execute_map(node_instance, output)
+                        task_stack.append(next_task)
+                        continue
+                    self._handle_output(next_task, output, task_stack)
+
+    async def _run_async(self, task_stack: list):
+        """_run的异步版本"""
+        loop = asyncio.get_running_loop()
+        while len(task_stack) > 0:
+            next_task = task_stack.pop()
+            match next_task:
+                case ExpandTask(node_instance, input_pins):
+                    self._expand(node_instance, input_pins, task_stack, parallel=False)
+                case ExecuteTask(node_instance):
+                    if self.compiled.materialized_inputs[node_instance.index]:
+                        await self._materialize_streams_async(node_instance.index, None)
+                    self._start(node_instance, task_stack, asynchronous=True)
+                case VectorizedLoopTask(node_instance, plan):
+                    self._run_vectorized_loop(
+                        node_instance, plan, task_stack, asynchronous=True
+                    )
+                case IterateNextTask(node_instance, outputs_iterator):
+                    if (
+                        next_task.recollect_input_pins is not None
+                        and self.compiled.materialized_inputs[node_instance.index]
+                    ):
+                        await self._materialize_streams_async(
+                            node_instance.index, next_task.recollect_input_pins
+                        )
+                    send_value = self._begin_step(next_task)
+                    try:
+                        if inspect.isasyncgen(outputs_iterator):
+                            output = await outputs_iterator.asend(send_value)
+                        else:
+                            output = await loop.run_in_executor(
+                                None, _send_to_generator, outputs_iterator, send_value
                             )
-                        case None:
-                            self._follow_route(node_instance, execution_pin, task_stack)
-        progress_callback({"event": "finish"})
+                    except StopAsyncIteration:
+                        output = None
+                    except Exception as e:
+                        self._report_error(node_instance, e)
+                        raise e
+                    if isinstance(output, MapRequest):
+                        next_task.send_value = await self._execute_map_async(
+                            node_instance, output
+                        )
+                        task_stack.append(next_task)
+                        continue
+                    self._handle_output(next_task, output, task_stack)
+
+    def _fork(self, checkpoint=None) -> "GraphExecutor":
+        """创建一个共享图结构的执行器，用于ParallelForEach的一次迭代
+
+        除了检查点以外的选项都与当前执行器相同，线程池和结果缓存共享。
+        每个执行器创建自己的节点对象，节点对象中的状态不会在并发的迭代之间共享；
+        输出缓存是当前状态的副本，包括已经执行过的DATA_ONCE节点，之后各自的输出互不影响。
+        输出的值本身不复制，循环之前定义的变量（Reference）在所有迭代中是同一个。
+        checkpoint为新的执行器使用的检查点范围，见checkpoint.Checkpoint.scope
+        """
+        child = GraphExecutor(
+            self.node_defs,
+            self.graph,
+            compiled=self.compiled,
+            max_workers=self.max_workers,
+            use_process_pool=self.use_process_pool,
+            vectorize_loops=self.vectorize_loops,
+            use_compiler=self.use_compiler,
+            checkpoint=checkpoint,
+            result_cache=self.result_cache,
+            release_outputs=self.release_outputs,
+        )
+        child.progress_callback = self.progress_callback
+        child.thread_pool = self.thread_pool
+        if self.profiler is not None:
+            child._enable_profiler(self.profiler)
+        node_classes = self.compiled.node_classes
+        with self.fork_lock:
+            for node, node_instance in enumerate(self.node_instances):
+                if node_instance is not None:
+                    child.node_instances[node] = NodeInstance(
+                        instance=node_classes[node](),
+                        node_data=node_instance.node_data,
+                        output_cache=node_instance.output_cache,
+                        output_version=node_instance.output_version,
+                        index=node,
+                        input_versions=node_instance.input_versions,
+                    )
+            child.execution_orders = dict(self.execution_orders)
+            child.execution_order_dependents = {
+                node: set(keys)
+                for node, keys in self.execution_order_dependents.items()
+            }
+            if self.output_sizes is not None:
+                child.output_sizes = list(self.output_sizes)
+                child.retained_bytes = self.retained_bytes
+                child.peak_retained_bytes = self.retained_bytes
+        return child
+
+    def _join(self, child: "GraphExecutor"):
+        """一次迭代结束，把迭代中第一次执行的DATA_ONCE节点的输出交回当前执行器
+
+        之后开始的迭代和循环之后的节点直接使用这个输出，不再执行；
+        同时在执行的迭代各自执行一次，先结束的迭代的输出生效
+        """
+        with self.fork_lock:
+            for node, execution_type in enumerate(self.compiled.execution_types):
+                if execution_type != NodeExecutionType.DATA_ONCE:
+                    continue
+                child_instance = child.node_instances[node]
+                if child_instance is None or child_instance.output_cache is None:
+                    continue
+                node_instance = self._get_node_instance(node)
+                if node_instance.output_cache is None:
+                    self._set_output(node_instance, child_instance.output_cache)
+            self.peak_retained_bytes = max(
+                self.peak_retained_bytes, child.peak_retained_bytes
+            )
+
+    def _map_checkpoints(self, node_instance: NodeInstance, count: int) -> list:
+        """每次迭代使用的检查点范围
+
+        并发的迭代中节点开始执行的顺序不确定，所以每次迭代按(Map节点, 第几次执行, 迭代下标)
+        单独记录，恢复时同一次迭代重放同一份记录
+        """
+        if self.checkpoint is None:
+            return [None] * count
+        node_id = node_instance.node_data.id
+        occurrence = self.map_occurrences.get(node_id, 0)
+        self.map_occurrences[node_id] = occurrence + 1
+        return [
+            self.checkpoint.scope(f"{node_id}#{occurrence}[{index}]")
+            for index in range(count)
+        ]
+
+    def _begin_map_iteration(
+        self,
+        node_instance: NodeInstance,
+        request: MapRequest,
+        data: dict[str, any],
+        checkpoint=None,
+    ) -> tuple["GraphExecutor", list]:
+        """为一次迭代创建独立的执行器，返回执行器和循环体的任务栈"""
+        child = self._fork(checkpoint)
+        child_instance = child._get_node_instance(node_instance.index)
+        child._set_output(child_instance, data)
+        task_stack = []
+        child._follow_route(child_instance, request.execution_pin, task_stack)
+        if request.result_pins:
+            # 压在栈底，循环体执行完之后再计算结果
+            task_stack.insert(
+                0,
+                ExpandTask(
+                    node_instance=child_instance, input_pins=request.result_pins
+                ),
+            )
+        return child, task_stack
+
+    def _end_map_iteration(
+        self, child: "GraphExecutor", node_instance: NodeInstance, request: MapRequest
+    ) -> list:
+        self._join(child)
+        inputs = child._collect_inputs_on_pins(node_instance.index, request.result_pins)
+        return [inputs.get(pin) for pin in request.result_pins]
+
+    def _run_map_iteration(
+        self,
+        node_instance: NodeInstance,
+        request: MapRequest,
+        data: dict[str, any],
+        checkpoint=None,
+    ) -> list:
+        child, task_stack = self._begin_map_iteration(
+            node_instance, request, data, checkpoint
+        )
+        child._run(task_stack)
+        return self._end_map_iteration(child, node_instance, request)
+
+    def _execute_map(self, node_instance: NodeInstance, request: MapRequest) -> list:
+        """执行MapRequest，并发的迭代在线程池中执行"""
+        checkpoints = self._map_checkpoints(node_instance, len(request.items))
+        if self.max_workers > 0:
+            # 迭代的执行器共用当前执行器的线程池，由execute关闭
+            self._get_thread_pool()
+        if request.max_concurrency <= 1 or len(request.items) <= 1:
+            return [
+                self._run_map_iteration(node_instance, request, data, checkpoint)
+                for data, checkpoint in zip(request.items, checkpoints)
+            ]
+        with ThreadPoolExecutor(
+            max_workers=request.max_concurrency, thread_name_prefix="graph-map"
+        ) as pool:
+            futures = [
+                pool.submit(
+                    self._run_map_iteration, node_instance, request, data, checkpoint
+                )
+                for data, checkpoint in zip(request.items, checkpoints)
+            ]
+            try:
+                return [future.result() for future in futures]
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    async def _execute_map_async(
+        self, node_instance: NodeInstance, request: MapRequest
+    ) -> list:
+        """_execute_map的异步版本，并发的迭代作为事件循环中的任务执行"""
+        semaphore = asyncio.Semaphore(max(1, request.max_concurrency))
+
+        async def run_iteration(data, checkpoint):
+            async with semaphore:
+                child, task_stack = self._begin_map_iteration(
+                    node_instance, request, data, checkpoint
+                )
+                await child._run_async(task_stack)
+                return self._end_map_iteration(child, node_instance, request)
+
+        checkpoints = self._map_checkpoints(node_instance, len(request.items))
+        tasks = [
+            asyncio.ensure_future(run_iteration(data, checkpoint))
+            for data, checkpoint in zip(request.items, checkpoints)
+        ]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    def _expand(
+        self,
+        node_instance: NodeInstance,
+        input_pins: list[str] | None,
+        task_stack: list,
+        parallel: bool,
+    ):
+        """把节点以及它的数据依赖按执行顺序加入任务栈"""
+        execution_order = self._get_execution_order(node_instance.index, input_pins)
+        parallel = parallel and self.max_workers > 0
+        if input_pins is not None:  # 说明节点本身已经执行过了，不需要再执行
+            execution_order = execution_order[:-1]
+            if parallel and len(execution_order) > 1:
+                self._execute_in_parallel(execution_order)
+                execution_order = []
+        elif parallel and len(execution_order) > 2:
+            self._execute_in_parallel(execution_order[:-1])
+            execution_order = execution_order[-1:]
+        for node in reversed(execution_order):
+            task_stack.append(ExecuteTask(node_instance=self._get_node_instance(node)))
+
+    def _start(self, node_instance: NodeInstance, task_stack: list, asynchronous: bool):
+        """收集输入并开始执行节点，节点的execute可以是生成器、异步生成器或者协程"""
+        if self._is_memoized(node_instance):
+            return
+        if self.vectorize_loops:
+            from vectorize import get_loop_plan  # NumPy是可选依赖，启用时才导入
+
+            plan = get_loop_plan(self.compiled, node_instance.index)
+            if plan is not None:
+                # 先执行变量和表达式依赖的DATA_ONCE节点
+                task_stack.append(VectorizedLoopTask(node_instance, plan))
+                for leaf in reversed(plan.leaves):
+                    task_stack.append(
+                        ExpandTask(node_instance=self._get_node_instance(leaf))
+                    )
+                return
+        inputs = self._collect_inputs(node_instance.index)
+        self._start_iterating(node_instance, inputs, task_stack, asynchronous)
+
+    def _run_vectorized_loop(
+        self, node_instance: NodeInstance, plan, task_stack: list, asynchronous: bool
+    ):
+        """用数组运算执行整个循环，不满足条件时退回到逐次执行"""
+        from vectorize import run_loop_plan
+
+        inputs = self._collect_inputs(node_instance.index)
+        if run_loop_plan(self, node_instance, plan, inputs):
+            self._follow_route(node_instance, "_", task_stack)
+        else:
+            self._start_iterating(node_instance, inputs, task_stack, asynchronous)
+
+    def _start_iterating(
+        self,
+        node_instance: NodeInstance,
+        inputs: dict[str, any],
+        task_stack: list,
+        asynchronous: bool,
+    ):
+        outputs_iterator = self._create_outputs_iterator(
+            node_instance, self._get_controller(node_instance), inputs, asynchronous
+        )
+        task_stack.append(
+            IterateNextTask(node_instance=node_instance, iterator=outputs_iterator)
+        )
+
+    def _create_outputs_iterator(
+        self,
+        node_instance: NodeInstance,
+        controller: Controller,
+        inputs: dict[str, any],
+        asynchronous: bool,
+    ):
+        """调用节点的execute，得到节点输出的迭代器
+
+        cpu_bound节点在进程池中执行，返回的迭代器在第一次取值时等待子进程完成。
+        输入不能pickle或者包含Reference、Stream时退回到当前进程执行。
+        检查点或结果缓存中记录过的执行直接重放，需要记录的执行在完成时写入检查点和结果缓存
+        """
+        node = node_instance.index
+        checkpoint = self.checkpoint if self.compiled.checkpointed[node] else None
+        key = None
+        if self.result_cache is not None and self.compiled.cached[node]:
+            try:
+                key = cache_key(
+                    node_instance.node_data.node_type,
+                    self.compiled.node_specs[node].version,
+                    inputs,
+                )
+            except UnhashableInput:
+                pass
+        if checkpoint is None and key is None:
+            return self._execute_node(node_instance, controller, inputs, asynchronous)
+
+        node_id = node_instance.node_data.id
+        if checkpoint is not None:
+            occurrence, steps = checkpoint.begin(node_id)
+            if steps is not None:
+                return _replay_steps(steps, controller)
+
+        def replay_cached(data):
+            steps = pickle.loads(data)
+            if checkpoint is not None:
+                checkpoint.record(node_id, occurrence, steps)
+            return _replay_steps(steps, controller)
+
+        def on_finish(steps):
+            if checkpoint is not None:
+                checkpoint.record(node_id, occurrence, steps)
+            if key is not None:
+                self._cache_result(key, steps)
+
+        def execute():
+            events = []
+
+            def send_event(event, data):
+                events.append((event, data))
+                controller.send_event(event, data)
+
+            outputs_iterator = self._execute_node(
+                node_instance, Controller(send_event=send_event), inputs, asynchronous
+            )
+            if inspect.isasyncgen(outputs_iterator):
+                return _record_steps_async(outputs_iterator, events, on_finish)
+            return _record_steps(outputs_iterator, events, on_finish)
+
+        if key is None:
+            return execute()
+        if asynchronous:
+            return self._lookup_result_async(key, replay_cached, execute)
+        data = self.result_cache.get(key)
+        if data is not None:
+            return replay_cached(data)
+        return execute()
+
+    async def _lookup_result_async(self, key: str, replay_cached, execute):
+        """异步执行时在线程池中查询结果缓存，SQLiteResultCache等后端的I/O不阻塞事件循环
+
+        命中时重放缓存的结果，否则执行节点，返回的异步生成器驱动其中之一
+        """
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(None, self.result_cache.get, key)
+        if data is not None:
+            outputs_iterator = await loop.run_in_executor(None, replay_cached, data)
+        else:
+            outputs_iterator = execute()
+        send_value = None
+        while True:
+            try:
+                if inspect.isasyncgen(outputs_iterator):
+                    output = await outputs_iterator.asend(send_value)
+                else:
+                    output = await loop.run_in_executor(
+                        None, _send_to_generator, outputs_iterator, send_value
+                    )
+            except StopAsyncIteration:
+                return
+            send_value = yield output
+
+    def _cache_result(self, key: str, steps: list):
+        """请求了输入或者执行了循环体的节点，结果不只由输入决定，不缓存"""
+        for _, output in steps:
+            if isinstance(output, (FetchInputsRequest, MapRequest)):
+                return
+        try:
+            data = pickle.dumps(steps)
+        except Exception:
+            return
+        self.result_cache.set(key, data)
+
+    def _execute_node(
+        self,
+        node_instance: NodeInstance,
+        controller: Controller,
+        inputs: dict[str, any],
+        asynchronous: bool,
+    ):
+        node = node_instance.index
+        cpu_bound = self.compiled.cpu_bound[node]
+        if (
+            self.use_process_pool
+            and cpu_bound
+            and (cpu_bound is True or inputs.get(cpu_bound))
+        ):
+            data = _pickle_for_process(inputs)
+            if data is not None:
+                pool, future = _submit_to_process_pool(
+                    _execute_in_process, self.compiled.node_classes[node], data
+                )
+                return _process_outputs(pool, future, controller)
+        return _normalize_outputs_iterator(
+            node_instance.instance.execute(controller=controller, **inputs),
+            asynchronous,
+        )
+
+    def _begin_step(self, task: IterateNextTask) -> Iterator[any] | None:
+        """发送execute_node事件，返回需要发送给节点的值"""
+        node_instance = task.node_instance
+        self.progress_callback(
+            {"event": "execute_node", "node_id": node_instance.node_data.id}
+        )
+        if task.send_value is not None:
+            send_value, task.send_value = task.send_value, None
+            return send_value
+        recollect_input_pins = task.recollect_input_pins
+        if recollect_input_pins is None:
+            return None
+        collected_inputs = self._collect_inputs_on_pins(
+            node_instance.index, recollect_input_pins
+        )
+        return map(lambda pin: collected_inputs[pin], recollect_input_pins)
+
+    def _report_error(self, node_instance: NodeInstance, error: Exception):
+        self.progress_callback(
+            {
+                "event": "execute_node_error",
+                "node_id": node_instance.node_data.id,
+                "node_error": repr(error),
+            }
+        )
+
+    def _handle_output(
+        self,
+        task: IterateNextTask,
+        output: NodeOutput | FetchInputsRequest | None,
+        task_stack: list,
+    ):
+        """处理节点的一次输出，决定接下来要执行的任务"""
+        node_instance = task.node_instance
+        execution_pin = "_"
+        match output:
+            case NodeOutput():
+                self._set_output(node_instance, output.data)
+                if output.execution_pin is not None:
+                    execution_pin = output.execution_pin
+                if execution_pin != "_":
+                    # 复用当前任务对象，避免每一步都重新分配
+                    task.recollect_input_pins = None
+                    task_stack.append(task)
+                self._follow_route(node_instance, execution_pin, task_stack)
+                if execution_pin == "_" and self.release_outputs:
+                    self._release_outputs(node_instance, task_stack)
+            case FetchInputsRequest(input_pins):
+                task.recollect_input_pins = input_pins
+                task_stack.append(task)
+                task_stack.append(
+                    ExpandTask(node_instance=node_instance, input_pins=input_pins)
+                )
+            case None:
+                self._follow_route(node_instance, execution_pin, task_stack)
+                if self.release_outputs:
+                    self._release_outputs(node_instance, task_stack)
+
+
+def _normalize_outputs_iterator(outputs_iterator, asynchronous: bool):
+    """统一节点execute的返回值
+
+    协程被包装成异步生成器；同步执行时，异步生成器被包装成可以同步驱动的迭代器
+    """
+    if inspect.iscoroutine(outputs_iterator):
+        outputs_iterator = _coroutine_outputs(outputs_iterator)
+    if not asynchronous and inspect.isasyncgen(outputs_iterator):
+        outputs_iterator = _AsyncGeneratorRunner(outputs_iterator)
+    return outputs_iterator
+
+
+def _send_to_generator(generator, value):
+    """在线程池中驱动同步生成器
+
+    StopIteration不能穿过Future传递，这里把它转换为StopAsyncIteration
+    """
+    try:
+        return generator.send(value)
+    except StopIteration:
+        raise StopAsyncIteration
+
+
+async def _coroutine_outputs(coroutine):
+    """把返回NodeOutput的协程包装成异步生成器"""
+    output = await coroutine
+    if output is not None:
+        yield output
+
+
+_background_loop: asyncio.AbstractEventLoop | None = None
+_background_loop_lock = threading.Lock()
+
+
+def _get_background_loop() -> asyncio.AbstractEventLoop:
+    """同步执行器用来驱动异步节点的事件循环，运行在一个后台线程中"""
+    global _background_loop
+    with _background_loop_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_background_loop.run_forever,
+                name="graph-executor-async",
+                daemon=True,
+            ).start()
+        return _background_loop
+
+
+def _materialize_streams(inputs: dict[str, any], pins: tuple[str, ...]):
+    """把非流式输入上的Stream合并成完整的值"""
+    for pin in pins:
+        value = inputs.get(pin)
+        if isinstance(value, Stream):
+            inputs[pin] = value.materialize()
+
+
+class _AsyncGeneratorRunner:
+    """在同步执行器中驱动异步生成器，可以在任意线程中调用send"""
+
+    def __init__(self, generator):
+        self.generator = generator
+
+    def send(self, value):
+        future = asyncio.run_coroutine_threadsafe(
+            self.generator.asend(value), _get_background_loop()
+        )
+        try:
+            return future.result()
+        except StopAsyncIteration:
+            raise StopIteration
+
+    def __next__(self):
+        return self.send(None)
+
+
+_process_pool: ProcessPoolExecutor | None = None
+_process_pool_lock = threading.Lock()
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """cpu_bound节点共用的进程池，第一次使用时创建，之后一直保持预热"""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            # 执行器所在的进程通常有多个线程，使用spawn避免fork带来的死锁
+            _process_pool = ProcessPoolExecutor(
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _process_pool
+
+
+def _discard_process_pool(pool: ProcessPoolExecutor):
+    """子进程意外退出后进程池不能再使用，丢弃它，下次使用时重新创建"""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is pool:
+            _process_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _submit_to_process_pool(fn, *args) -> tuple[ProcessPoolExecutor, Future]:
+    pool = get_process_pool()
+    try:
+        return pool, pool.submit(fn, *args)
+    except BrokenProcessPool:
+        _discard_process_pool(pool)
+    pool = get_process_pool()
+    return pool, pool.submit(fn, *args)
+
+
+class _OffloadPickler(pickle.Pickler):
+    def persistent_id(self, obj):
+        # Reference的意义在于共享，子进程中的修改不会传回来
+        if isinstance(obj, Reference):
+            raise pickle.PicklingError("Reference cannot be sent to another process")
+        # 序列化Stream会先读完它，节点就不能边读边处理了
+        if isinstance(obj, Stream):
+            raise pickle.PicklingError("Stream cannot be sent to another process")
+        return None
+
+
+def _pickle_for_process(inputs: dict[str, any]) -> bytes | None:
+    """序列化发送给子进程的输入，不能pickle或者包含Reference、Stream时返回None
+
+    提交给进程池的是这份字节，输入只序列化一次
+    """
+    buffer = io.BytesIO()
+    try:
+        _OffloadPickler(buffer, pickle.HIGHEST_PROTOCOL).dump(inputs)
+    except Exception:
+        return None
+    return buffer.getvalue()
+
+
+def _execute_in_process(
+    node_class, data: bytes
+) -> list[tuple[list[tuple[str, any]], NodeOutput | Exception | None]]:
+    """在子进程中执行节点直到结束，data为_pickle_for_process序列化的输入
+
+    返回每一步的(期间发送的事件, 输出)，最后一步的输出为None，出错时为异常。
+    子进程中无法向执行器请求输入，所以不支持FetchInputsRequest
+    """
+    inputs = pickle.loads(data)
+    steps = []
+    events = []
+    controller = Controller(send_event=lambda event, data: events.append((event, data)))
+    try:
+        outputs_iterator = _normalize_outputs_iterator(
+            node_class().execute(controller=controller, **inputs), asynchronous=False
+        )
+        for output in outputs_iterator:
+            if not isinstance(output, NodeOutput):
+                raise ValueError(
+                    f"{node_class.__name__} requested inputs, which is not supported for cpu_bound nodes"
+                )
+            steps.append((events, output))
+            events = []
+    except Exception as e:
+        steps.append((events, e))
+        return steps
+    steps.append((events, None))
+    return steps
+
+
+def _process_outputs(pool: ProcessPoolExecutor, future: Future, controller: Controller):
+    """按原来的顺序重放子进程中节点发送的事件和输出
+
+    子进程意外退出时这个节点以BrokenProcessPool失败，之后的节点使用新的进程池
+    """
+    try:
+        steps = future.result()
+    except BrokenProcessPool:
+        _discard_process_pool(pool)
+        raise
+    yield from _replay_steps(steps, controller)
+
+
+def _replay_steps(steps: list, controller: Controller):
+    """按顺序重放记录的每一步发送的事件和输出"""
+    for events, output in steps:
+        for event, data in events:
+            controller.send_event(event, data)
+        if isinstance(output, Exception):
+            raise output
+        if output is not None:
+            yield output
+
+
+def _is_final_output(output) -> bool:
+    """节点产生这个输出后，执行器不会再继续驱动它"""
+    return output is None or (
+        isinstance(output, NodeOutput) and output.execution_pin in (None, "_")
+    )
+
+
+def _record_steps(outputs_iterator, events: list, on_finish):
+    """记录节点每一步期间发送的事件和输出，节点执行完时调用on_finish(steps)
+
+    出错的执行不会被记录
+    """
+    steps = []
+    send_value = None
+    while True:
+        try:
+            output = outputs_iterator.send(send_value)
+        except StopIteration:
+            break
+        steps.append((events.copy(), output))
+        events.clear()
+        if _is_final_output(output):
+            on_finish(steps)
+            yield output
+            return
+        send_value = yield output
+    steps.append((events.copy(), None))
+    on_finish(steps)
+
+
+async def _record_steps_async(outputs_iterator, events: list, on_finish):
+    """_record_steps的异步生成器版本
+
+    on_finish会写入检查点和结果缓存，在线程池中调用，不阻塞事件循环
+    """
+    loop = asyncio.get_running_loop()
+    steps = []
+    send_value = None
+    while True:
+        try:
+            output = await outputs_iterator.asend(send_value)
+        except StopAsyncIteration:
+            break
+        steps.append((events.copy(), output))
+        events.clear()
+        if _is_final_output(output):
+            await loop.run_in_executor(None, on_finish, steps)
+            yield output
+            return
+        send_value = yield output
+    steps.append((events.copy(), None))
+    await loop.run_in_executor(None, on_finish, steps)
@@ -0,0 +1,433 @@
+"""把图编译成Python函数
+
+GraphExecutor的解释执行每一步都要经过任务栈、模式匹配和字典查找。编译后：
+- 路由边变成函数调用，只有一个入口的"_"路由链直接内联成顺序执行的代码
+- 数据边变成对上游节点输出缓存的直接读取
+- 数据依赖按执行顺序展开成顺序执行的代码，执行中遇到尚未缓存的DATA_ONCE节点时，
+  这一步退回到解释器计算执行顺序
+节点仍然是生成器，产生的事件和解释执行完全相同。FetchInputsRequest和MapRequest
+交给解释器处理，它们执行完后继续执行编译后的代码。
+
+编译结果按图结构的hash缓存，固定输入的值不参与hash，只改输入值的图可以共用编译结果。
+路由有环、函数嵌套过深、数据依赖有环或者生成的代码过长的图不能编译，由解释器执行。
+"""
+
+import hashlib
+import json
+import threading
+from graph import (
+    CompiledGraph,
+    DependencyCycleError,
+    ExecuteTask,
+    GraphExecutor,
+    IterateNextTask,
+    NodeExecutionType,
+    NodeInstance,
+    topological_sort,
+)
+from node_basic import NodeOutput, FetchInputsRequest, MapRequest
+
+# 编译后的函数嵌套调用的最大深度，超过时由解释器执行，避免超出Python的递归限制
+MAX_CALL_DEPTH = 100
+# 生成代码的最大行数，Python编译很长的函数的时间是超线性的，超过时由解释器执行
+MAX_SOURCE_LINES = 10000
+MAX_CACHE_SIZE = 256
+
+# workflow hash -> build函数，不能编译的图为None
+_cache: dict[str, any] = {}
+_cache_lock = threading.Lock()
+
+
+class UnsupportedGraph(Exception):
+    """图中有不能编译的结构"""
+
+
+def workflow_hash(compiled: CompiledGraph) -> str:
+    """图结构的hash，包含生成代码时用到的所有信息"""
+    structure = {
+        "nodes": [
+            [
+                node_data.id,
+                node_data.node_type,
+                node_data.execution_type.value,
+                sorted(node_data.inputs or {}),
+                [
+                    [
+                        input_meta.get("name"),
+                        input_meta.get("lazy", False),
+                        input_meta.get("stream", False),
+                    ]
+                    for input_meta in node_meta.get("inputs", [])
+                ],
+                [
+                    output_meta.get("name")
+                    for output_meta in node_meta.get("outputs", [])
+                    if output_meta.get("stream", False)
+                ],
+                node_meta.get("pure", False),
+            ]
+            for node_data, node_meta in zip(compiled.node_datas, compiled.node_metas)
+        ],
+        "edges": [
+            [edge.source_id, edge.source_pin, edge.target_id, edge.target_pin]
+            for edge in compiled.graph.edges
+        ],
+        "route_edges": [
+            [edge.source_id, edge.source_pin, edge.target_id]
+            for edge in compiled.graph.route_edges
+        ],
+    }
+    return hashlib.sha256(json.dumps(structure).encode()).hexdigest()
+
+
+def get_compiled_function(compiled: CompiledGraph):
+    """获取图编译后的build函数，不能编译时返回None"""
+    key = workflow_hash(compiled)
+    with _cache_lock:
+        if key in _cache:
+            return _cache[key]
+    try:
+        source = generate_source(compiled)
+        namespace = {
+            "NodeOutput": NodeOutput,
+            "FetchInputsRequest": FetchInputsRequest,
+            "MapRequest": MapRequest,
+        }
+        exec(compile(source, f"<compiled graph {key[:12]}>", "exec"), namespace)
+        build = namespace["build"]
+    except (UnsupportedGraph, RecursionError):
+        build = None
+    with _cache_lock:
+        if len(_cache) >= MAX_CACHE_SIZE:
+            _cache.pop(next(iter(_cache)))
+        _cache[key] = build
+    return build
+
+
+def run_compiled(executor: GraphExecutor) -> bool:
+    """用编译后的函数执行整个图，图不能编译时返回False"""
+    build = get_compiled_function(executor.compiled)
+    if build is None:
+        return False
+    build(executor, _Runtime(executor))()
+    return True
+
+
+class _Runtime:
+    """编译后的代码调用的辅助函数，不常见的情况都交给解释器处理"""
+
+    def __init__(self, executor: GraphExecutor):
+        self.executor = executor
+
+    def expand(self, node: int):
+        """执行节点的数据依赖，用于有DATA_ONCE节点尚未缓存时"""
+        executor = self.executor
+        execution_order = executor._get_execution_order(node)
+        executor._run(
+            [
+                ExecuteTask(node_instance=executor._get_node_instance(dependency))
+                for dependency in reversed(execution_order[:-1])
+            ]
+        )
+
+    def collect_inputs(self, node: int) -> dict[str, any]:
+        """上游节点没有输出时，由解释器收集输入并报告错误"""
+        return self.executor._collect_inputs(node)
+
+    def run_data(self, node_instance: NodeInstance, inputs: dict[str, any]):
+        """执行一个数据节点"""
+        executor = self.executor
+        outputs_iterator = executor._create_outputs_iterator(
+            node_instance, executor._get_controller(node_instance), inputs, False
+        )
+        executor.progress_callback(
+            {"event": "execute_node", "node_id": node_instance.node_data.id}
+        )
+        try:
+            output = next(outputs_iterator)
+        except StopIteration:
+            return
+        except Exception as e:
+            executor._report_error(node_instance, e)
+            raise e
+        if isinstance(output, NodeOutput) and output.execution_pin in (None, "_"):
+            executor._set_output(node_instance, output.data)
+            return
+        # 节点还有后续步骤，交给解释器继续执行
+        task = IterateNextTask(node_instance=node_instance, iterator=outputs_iterator)
+        task_stack = []
+        if isinstance(output, MapRequest):
+            task.send_value = executor._execute_map(node_instance, output)
+            task_stack.append(task)
+        else:
+            executor._handle_output(task, output, task_stack)
+        executor._run(task_stack)
+
+    def fetch(self, node_instance: NodeInstance, input_pins: list[str]):
+        """处理FetchInputsRequest，返回需要发送给节点的值"""
+        executor = self.executor
+        task_stack = []
+        executor._expand(node_instance, input_pins, task_stack, parallel=False)
+        executor._run(task_stack)
+        collected_inputs = executor._collect_inputs_on_pins(
+            node_instance.index, input_pins
+        )
+        return map(lambda pin: collected_inputs[pin], input_pins)
+
+
+def generate_source(compiled: CompiledGraph) -> str:
+    return _SourceGenerator(compiled).generate()
+
+
+class _SourceGenerator:
+    def __init__(self, compiled: CompiledGraph):
+        self.compiled = compiled
+        self.incoming_routes = [0] * len(compiled.node_ids)
+        for edge in compiled.graph.route_edges:
+            self.incoming_routes[compiled.node_index[edge.target_id]] += 1
+        self.used_nodes: dict[int, None] = {}  # 代码中用到的节点实例
+        self.constants: dict[tuple[int, str], str] = {}  # 固定输入 -> 变量名
+        self.function_calls: dict[int, list[int]] = {}  # 函数 -> 调用的函数
+
+    def generate(self) -> str:
+        compiled = self.compiled
+        if "start" not in compiled.node_index:
+            raise UnsupportedGraph("graph has no start node")
+        start = compiled.node_index["start"]
+        self._check_route_cycles(start)
+
+        functions = []
+        size = 0
+        pending = [start]
+        while pending:
+            node = pending.pop()
+            if node in self.function_calls:
+                continue
+            calls = []
+            body = self._block(node, 2, calls)
+            self.function_calls[node] = calls
+            pending.extend(calls)
+            name = "run" if node == start else f"_node_{node}"
+            functions.append([f"    def {name}():"] + body)
+            size += len(body)
+            if size > MAX_SOURCE_LINES:
+                raise UnsupportedGraph("generated code exceeds size limit")
+        self._check_call_depth(start)
+
+        lines = ["def build(executor, runtime):"]
+        lines += [
+            "    progress = executor.progress_callback",
+            "    set_output = executor._set_output",
+            "    is_memoized = executor._is_memoized",
+            "    get_controller = executor._get_controller",
+            "    create_outputs_iterator = executor._create_outputs_iterator",
+            "    report_error = executor._report_error",
+            "    execute_map = executor._execute_map",
+            "    collect_inputs = runtime.collect_inputs",
+            "    expand = runtime.expand",
+            "    run_data = runtime.run_data",
+            "    fetch = runtime.fetch",
+            "    node_datas = executor.compiled.node_datas",
+        ]
+        for node in self.used_nodes:
+            lines.append(f"    n{node} = executor._get_node_instance({node})")
+        for (node, pin), name in self.constants.items():
+            lines.append(f"    {name} = node_datas[{node}].inputs[{pin!r}]")
+        for function in functions:
+            lines += function
+        lines.append("    return run")
+        return "\n".join(lines) + "\n"
+
+    def _check_route_cycles(self, start: int):
+        """路由有环时不能编译成嵌套的函数调用"""
+        routes = self.compiled.routes
+        visiting = set()
+        visited = set()
+        stack = [(start, False)]
+        while stack:
+            node, leaving = stack.pop()
+            if leaving:
+                visiting.remove(node)
+                visited.add(node)
+                continue
+            if node in visiting:
+                raise UnsupportedGraph(f"route cycle at {self.compiled.node_ids[node]}")
+            if node in visited:
+                continue
+            visiting.add(node)
+            stack.append((node, True))
+            for targets in (routes[node] or {}).values():
+                for target in targets:
+                    if target in visiting:
+                        raise UnsupportedGraph(
+                            f"route cycle at {self.compiled.node_ids[target]}"
+                        )
+                    stack.append((target, False))
+
+    def _check_call_depth(self, start: int):
+        depths = {}
+
+        def depth(function: int, level: int) -> int:
+            if level > MAX_CALL_DEPTH:
+                raise UnsupportedGraph("call depth exceeds limit")
+            if function not in depths:
+                depths[function] = 1 + max(
+                    (depth(call, level + 1) for call in self.function_calls[function]),
+                    default=0,
+                )
+            return depths[function]
+
+        depth(start, 0)
+
+    def _node(self, node: int) -> str:
+        self.used_nodes[node] = None
+        return f"n{node}"
+
+    def _inputs_expression(self, node: int, pins: list[str]) -> str:
+        """和GraphExecutor._collect_inputs_on_pins相同的输入字典"""
+        compiled = self.compiled
+        items = {}
+        node_inputs = compiled.node_datas[node].inputs or {}
+        data_inputs = compiled.data_inputs[node]
+        for key in node_inputs:
+            if key in pins and key not in data_inputs:
+                name = self.constants.setdefault(
+                    (node, key), f"k{node}_{len(self.constants)}"
+                )
+                items[key] = name
+        for target_pin, (source, source_pin) in data_inputs.items():
+            if target_pin in pins:
+                items[target_pin] = f"{self._node(source)}.output_cache[{source_pin!r}]"
+        return (
+            "{" + ", ".join(f"{key!r}: {value}" for key, value in items.items()) + "}"
+        )
+
+    def _input_pins(self, node: int) -> tuple[str, ...]:
+        return self.compiled.node_specs[node].eager_inputs
+
+    def _collect_inputs_lines(self, node: int, indent: str) -> list[str]:
+        if self.compiled.materialized_inputs[node]:
+            # 需要合并Stream的输入交给解释器收集
+            return [f"{indent}inputs = collect_inputs({node})"]
+        # 上游节点没有输出时output_cache为None，读取时抛出TypeError，交给解释器报告错误
+        return [
+            f"{indent}try:",
+            f"{indent}    inputs = {self._inputs_expression(node, self._input_pins(node))}",
+            f"{indent}except TypeError:",
+            f"{indent}    inputs = collect_inputs({node})",
+        ]
+
+    def _data_dependencies(self, target: int) -> tuple[list[int], list[int]]:
+        """所有DATA_ONCE节点都已缓存时的执行顺序（不含目标节点），以及遇到的DATA_ONCE节点
+
+        和GraphExecutor._compute_execution_order的遍历顺序相同
+        """
+        compiled = self.compiled
+        data_once = []
+
+        def get_dependencies(node: int) -> tuple[int, ...] | None:
+            if compiled.execution_types[node] == NodeExecutionType.DATA_ONCE:
+                data_once.append(node)
+                return None
+            return compiled.data_dependencies[node]
+
+        dependencies = get_dependencies(target)
+        if dependencies is None:
+            return [], data_once
+        try:
+            result = topological_sort(compiled, target, dependencies, get_dependencies)
+        except DependencyCycleError as e:
+            raise UnsupportedGraph(f"data cycle: {' -> '.join(e.cycle)}")
+        return result[:-1], data_once
+
+    def _dependency_lines(self, node: int, indent: str) -> list[str]:
+        compiled = self.compiled
+        dependencies, data_once = self._data_dependencies(node)
+        if not dependencies and not data_once:
+            return []
+        if len(dependencies) > MAX_SOURCE_LINES:
+            raise UnsupportedGraph("generated code exceeds size limit")
+        lines = []
+        body_indent = indent
+        if data_once:
+            condition = " and ".join(
+                f"{self._node(source)}.output_cache is not None" for source in data_once
+            )
+            lines.append(f"{indent}if {condition}:")
+            body_indent = indent + "    "
+        for dependency in dependencies:
+            line_indent = body_indent
+            if compiled.memo_sources[dependency] is not None:
+                lines.append(
+                    f"{body_indent}if not is_memoized({self._node(dependency)}):"
+                )
+                line_indent += "    "
+            lines += self._collect_inputs_lines(dependency, line_indent)
+            lines.append(f"{line_indent}run_data({self._node(dependency)}, inputs)")
+        if not dependencies:
+            lines.append(f"{body_indent}pass")
+        if data_once:
+            lines.append(f"{indent}else:")
+            lines.append(f"{indent}    expand({node})")
+        return lines
+
+    def _is_inlined(self, node: int, targets: tuple[int, ...]) -> bool:
+        return len(targets) == 1 and self.incoming_routes[targets[0]] == 1
+
+    def _block(self, node: int, level: int, calls: list[int]) -> list[str]:
+        """节点以及内联的"_"路由链的代码"""
+        compiled = self.compiled
+        lines = []
+        while True:
+            indent = "    " * level
+            node_data = compiled.node_datas[node]
+            instance = self._node(node)
+            routes = compiled.routes[node] or {}
+            lines.append(f"{indent}# {node_data.id} ({node_data.node_type})")
+            lines += self._dependency_lines(node, indent)
+            lines += self._collect_inputs_lines(node, indent)
+            lines += [
+                f"{indent}outputs = create_outputs_iterator({instance}, get_controller({instance}), inputs, False)",
+                f"{indent}send_value = None",
+                f"{indent}while True:",
+                f"{indent}    progress({{'event': 'execute_node', 'node_id': {node_data.id!r}}})",
+                f"{indent}    try:",
+                f"{indent}        output = outputs.send(send_value)",
+                f"{indent}    except StopIteration:",
+                f"{indent}        break",
+                f"{indent}    except Exception as e:",
+                f"{indent}        report_error({instance}, e)",
+                f"{indent}        raise e",
+                f"{indent}    send_value = None",
+                f"{indent}    if isinstance(output, NodeOutput):",
+                f"{indent}        set_output({instance}, output.data)",
+                f"{indent}        pin = output.execution_pin",
+                f"{indent}        if pin is None or pin == '_':",
+                f"{indent}            break",
+            ]
+            for pin, targets in routes.items():
+                if pin == "_":
+                    continue
+                lines.append(f"{indent}        if pin == {pin!r}:")
+                for target in targets:
+                    calls.append(target)
+                    lines.append(f"{indent}            _node_{target}()")
+            lines += [
+                f"{indent}    elif isinstance(output, FetchInputsRequest):",
+                f"{indent}        send_value = fetch({instance}, output.input_pins)",
+                f"{indent}    elif isinstance(output, MapRequest):",
+                f"{indent}        send_value = execute_map({instance}, output)",
+                f"{indent}    elif output is None:",
+                f"{indent}        break",
+                f"{indent}    else:",
+                # 解释器遇到未知的输出时结束节点，不执行"_"路由
+                f"{indent}        return",
+            ]
+            targets = routes.get("_", ())
+            if self._is_inlined(node, targets):
+                node = targets[0]
+                continue
+            for target in targets:
+                calls.append(target)
+                lines.append(f"{indent}_node_{target}()")
+            return lines
@@ -0,0 +1,256 @@
+"""输出缓存的活跃性分析
+
+节点的输出缓存默认一直保留到执行器被丢弃。启用release_outputs后，执行器在TRIGGERED节点
+执行结束（从"_"引脚离开）时，释放之后不可能再被读取的输出。
+
+执行器的任务栈就是剩余的执行：之后能执行的节点，只有从栈中的节点沿路由边可以到达的节点，
+以及它们的数据依赖。为了让分析是线性的，不为每个节点保存可以到达的节点集合，而是：
+- 把路由图的强连通分量按拓扑顺序编号为位置，节点n沿路由边可以到达的节点的位置
+  都在区间[start[n], reach[n]]中
+- 每个输出记录读取它的TRIGGERED节点的最小和最大位置[first, last]，经过数据节点的
+  间接读取算在读取数据节点的TRIGGERED节点上
+两个区间相交时认为n之后可能读取这个输出。判断是保守的：循环节点还在栈中时，
+循环体中所有节点的输出都会保留；并列的分支在区间上交错时也会保留。
+
+DATA_ONCE节点和纯数据节点的缓存之后还会被复用，从不释放。
+"""
+
+import bisect
+from collections.abc import Mapping
+from dataclasses import dataclass
+import itertools
+import sys
+from graph import CompiledGraph, NodeExecutionType
+from persistent import PersistentDict, PersistentList
+
+
+@dataclass
+class Liveness:
+    # 节点 -> 沿路由边可以到达的位置区间，数据节点为None
+    start: list[int | None]
+    reach: list[int | None]
+    # 节点 -> 读取它的输出的位置区间，没有被读取时为None
+    first: list[int | None]
+    last: list[int | None]
+    # TRIGGERED节点 -> 结束时需要检查的输出，即它之后的执行不再读取、但"_"路由的目标
+    # 之后还可能读取的之外的输出，以及它自己
+    candidates: list[tuple[int, ...]]
+
+    def is_read_after(self, source: int, node: int) -> bool:
+        """从node开始的执行是否可能读取source的输出"""
+        first = self.first[source]
+        return (
+            first is not None
+            and first <= self.reach[node]
+            and self.last[source] >= self.start[node]
+        )
+
+
+def get_liveness(compiled: CompiledGraph) -> Liveness:
+    """结果缓存在CompiledGraph中"""
+    if compiled.liveness is None:
+        compiled.liveness = _analyze(compiled)
+    return compiled.liveness
+
+
+def _route_targets(compiled: CompiledGraph, node: int):
+    # 先访问"_"路由的目标，它们在拓扑顺序中排在循环体等其它目标的后面
+    routes = compiled.routes[node] or {}
+    yield from routes.get("_", ())
+    for pin, targets in routes.items():
+        if pin != "_":
+            yield from targets
+
+
+def _positions(compiled: CompiledGraph) -> tuple[list, list]:
+    """用Tarjan算法求路由图的强连通分量，返回每个节点的位置和可以到达的最大位置"""
+    count = len(compiled.node_ids)
+    index = [None] * count
+    lowlink = [0] * count
+    on_stack = [False] * count
+    stack = []
+    components = []  # 按逆拓扑顺序
+    next_index = 0
+    for root in range(count):
+        if compiled.routes[root] is None or index[root] is not None:
+            continue
+        index[root] = lowlink[root] = next_index
+        next_index += 1
+        stack.append(root)
+        on_stack[root] = True
+        work = [(root, _route_targets(compiled, root))]
+        while work:
+            node, targets = work[-1]
+            for target in targets:
+                if index[target] is None:
+                    index[target] = lowlink[target] = next_index
+                    next_index += 1
+                    stack.append(target)
+                    on_stack[target] = True
+                    work.append((target, _route_targets(compiled, target)))
+                    break
+                if on_stack[target]:
+                    lowlink[node] = min(lowlink[node], index[target])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = False
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+
+    start = [None] * count
+    reach = [None] * count
+    # 后继分量先出现，按出现的顺序计算可以到达的最大位置
+    for order, component in enumerate(components):
+        position = len(components) - 1 - order
+        for member in component:
+            start[member] = position
+        component_reach = position
+        for member in component:
+            for target in _route_targets(compiled, member):
+                if start[target] != position:
+                    component_reach = max(component_reach, reach[target])
+        for member in component:
+            reach[member] = component_reach
+    return start, reach
+
+
+def _read_ranges(compiled: CompiledGraph, start: list) -> tuple[list, list]:
+    """每个输出被读取的位置区间
+
+    TRIGGERED节点只读取输出，不会因此执行；数据节点被读取时才执行，
+    它读取的输出算作读取它的节点读取的
+    """
+    count = len(compiled.node_ids)
+    readers = [[] for _ in range(count)]
+    for target in range(count):
+        for source, _ in compiled.data_inputs[target].values():
+            readers[source].append(target)
+    first = [None] * count
+    last = [None] * count
+    done = [False] * count
+
+    def add(source: int, low: int | None, high: int | None):
+        if low is None:
+            return
+        if first[source] is None or low < first[source]:
+            first[source] = low
+        if last[source] is None or high > last[source]:
+            last[source] = high
+
+    for root in range(count):
+        if done[root]:
+            continue
+        done[root] = True
+        work = [(root, iter(readers[root]))]
+        while work:
+            source, pending = work[-1]
+            for reader in pending:
+                if start[reader] is not None:
+                    add(source, start[reader], start[reader])
+                elif done[reader]:
+                    add(source, first[reader], last[reader])
+                else:
+                    # 数据依赖没有环，先计算读取者的区间
+                    done[reader] = True
+                    work.append((reader, iter(readers[reader])))
+                    break
+            else:
+                work.pop()
+                if work:
+                    add(work[-1][0], first[source], last[source])
+    return first, last
+
+
+def _analyze(compiled: CompiledGraph) -> Liveness:
+    count = len(compiled.node_ids)
+    start, reach = _positions(compiled)
+    first, last = _read_ranges(compiled, start)
+    liveness = Liveness(start=start, reach=reach, first=first, last=last, candidates=[])
+    releasable = [
+        execution_type != NodeExecutionType.DATA_ONCE
+        and compiled.memo_sources[node] is None
+        for node, execution_type in enumerate(compiled.execution_types)
+    ]
+    # 按最后读取的位置排序，用二分查找取出最后读取的位置在一个区间中的输出
+    read_sources = sorted(
+        (source for source in range(count) if last[source] is not None),
+        key=lambda source: last[source],
+    )
+    read_lasts = [last[source] for source in read_sources]
+    for node in range(count):
+        if compiled.routes[node] is None:
+            liveness.candidates.append(())
+            continue
+        # "_"路由的目标结束后还会检查，它们可能读取的输出这里不用检查
+        following = list(compiled.routes[node].get("_", ()))
+        sources = {node}
+        low = start[node]
+        for following_start, following_reach in sorted(
+            (start[target], reach[target]) for target in following
+        ):
+            sources.update(
+                _sources_read_in(read_sources, read_lasts, low, following_start - 1)
+            )
+            low = max(low, following_reach + 1)
+        sources.update(_sources_read_in(read_sources, read_lasts, low, reach[node]))
+        liveness.candidates.append(
+            tuple(
+                source
+                for source in sorted(sources)
+                if releasable[source]
+                and not any(
+                    liveness.is_read_after(source, target) for target in following
+                )
+            )
+        )
+    return liveness
+
+
+def _sources_read_in(
+    read_sources: list[int], read_lasts: list[int], low: int, high: int
+) -> list[int]:
+    """最后读取的位置在[low, high]中的输出"""
+    if low > high:
+        return []
+    return read_sources[
+        bisect.bisect_left(read_lasts, low) : bisect.bisect_right(read_lasts, high)
+    ]
+
+
+# 估计容器的内容时抽样的元素数
+SAMPLE_SIZE = 8
+
+
+def estimate_size(value: any, depth: int = 3) -> int:
+    """估计对象占用的字节数
+
+    容器只抽样前SAMPLE_SIZE个元素，按长度推算内容的大小，递归depth层。
+    耗时与容器的长度无关，在循环中不断变长的集合每次输出时都可以重新估计。
+    被多次引用的对象会被重复计算
+    """
+    size = sys.getsizeof(value)
+    if depth == 0:
+        return size
+    if isinstance(value, PersistentDict):
+        items = value.sample(SAMPLE_SIZE)
+    elif isinstance(value, PersistentList):
+        items = [(item,) for item in value.sample(SAMPLE_SIZE)]
+    elif isinstance(value, Mapping):
+        items = list(itertools.islice(value.items(), SAMPLE_SIZE))
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        items = [(item,) for item in itertools.islice(value, SAMPLE_SIZE)]
+    else:
+        return size
+    if not items:
+        return size
+    sampled = sum(estimate_size(part, depth - 1) for item in items for part in item)
+    return size + sampled * len(value) // len(items)
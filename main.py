@@ -10,6 +10,29 @@ if __name__ == "__main__":
     parser.add_argument(
         "--dev", action="store_true", help="Enable development mode with CORS"
     )
+    parser.add_argument(
+        "--max-running-graphs",
+        type=int,
+        default=4,
+        help="Maximum number of graphs executed at the same time",
+    )
+    parser.add_argument(
+        "--max-queued-graphs",
+        type=int,
+        default=16,
+        help="Maximum number of requests waiting to execute, more are rejected with 429",
+    )
+    parser.add_argument(
+        "--max-queue-wait",
+        type=float,
+        default=30.0,
+        help="Seconds a request may wait in the queue before failing with 503",
+    )
+    parser.add_argument(
+        "--run-store",
+        default=None,
+        help="SQLite file keeping finished runs for /api/runs, in memory if omitted",
+    )
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.INFO)
@@ -17,4 +40,10 @@ if __name__ == "__main__":
         logging.info("Starting application in development mode")
 
     load_plugins()
-    start_api_service(dev_mode=args.dev)
+    start_api_service(
+        dev_mode=args.dev,
+        max_running_graphs=args.max_running_graphs,
+        max_queued_graphs=args.max_queued_graphs,
+        max_queue_wait=args.max_queue_wait,
+        run_store_path=args.run_store,
+    )
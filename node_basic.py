@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import Iterator
+from typing import AsyncIterator, Iterator
 
 
 @dataclass
@@ -13,6 +13,21 @@ class FetchInputsRequest:
     input_pins: list[str]
 
 
+@dataclass
+class MapRequest:
+    """请求执行器对items中的每个元素执行一次execution_pin路由的循环体
+
+    每次迭代时，节点的输出为items中对应的字典，循环体执行完后收集result_pins的值。
+    各次迭代可以并发执行，最多同时执行max_concurrency个，每次迭代使用独立的输出缓存副本。
+    执行器按items的顺序返回每次迭代result_pins的值的列表
+    """
+
+    execution_pin: str
+    items: list[dict[str, any]]
+    result_pins: list[str]
+    max_concurrency: int = 1
+
+
 @dataclass
 class Reference:
     value: any
@@ -34,3 +49,16 @@ class BaseDataNode:
         raise NotImplementedError(
             "get_data() is not implemented for {self.__class__.__name__}"
         )
+
+
+class AsyncBaseDataNode:
+    async def execute(self, controller, **kwargs) -> AsyncIterator[NodeOutput]:
+        yield NodeOutput(
+            execution_pin=None,
+            data=await self.get_data(controller=controller, **kwargs),
+        )
+
+    async def get_data(self, controller, **kwargs) -> dict[str, any]:
+        raise NotImplementedError(
+            "get_data() is not implemented for {self.__class__.__name__}"
+        )
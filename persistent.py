@@ -0,0 +1,258 @@
+"""共享结构的不可变列表和字典
+
+集合节点在循环中每次复制整个列表或字典，构造n个元素的集合需要O(n²)。
+这里的PersistentList和PersistentDict没有修改自身的方法，appended/with_item等操作返回新的版本，
+新旧版本共享数据（rerooting）：同一组版本中只有一个版本直接持有列表或字典，
+其它版本记录与下一个版本的差异，访问旧版本时沿差异链把数据调整过来。
+按顺序构造和访问时每次操作是O(1)，不需要复制。
+
+方法名特意不与list/dict的修改方法同名：脚本中对输入调用append、update等方法时直接报错，
+而不是看起来成功、实际没有修改任何东西。
+两者分别实现了Sequence和Mapping，下游节点可以像list/dict一样读取，
+但isinstance(value, list)为False，也不能直接json.dumps。交给用户脚本之前用to_plain转换，
+序列化事件时使用json_default。
+同一组版本共享一把锁，可以在多个线程中使用。
+"""
+
+from collections.abc import Mapping, Sequence
+import itertools
+import threading
+
+_MISSING = object()
+
+
+class PersistentList(Sequence):
+    # 持有列表的版本_data为列表、_diff为None；其它版本_data为None，
+    # _diff为(index, 这个版本中的值, 下一个版本)，两个版本的长度不同时是追加或者删除最后一个元素
+    __slots__ = ("_data", "_diff", "_length", "_lock")
+
+    def __init__(self, items=()):
+        self._data = list(items)
+        self._diff = None
+        self._length = len(self._data)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def of(cls, items) -> "PersistentList":
+        """已经是PersistentList时直接返回，否则复制一次"""
+        if isinstance(items, PersistentList):
+            return items
+        return cls(items)
+
+    def _reroot(self) -> list:
+        """让这个版本持有列表，调用时需要持有锁"""
+        if self._diff is None:
+            return self._data
+        path = []
+        version = self
+        while version._diff is not None:
+            path.append(version)
+            version = version._diff[2]
+        data = version._data
+        for version in reversed(path):
+            index, value, next_version = version._diff
+            if version._length > next_version._length:
+                data.append(value)
+                undo = (index, _MISSING, version)
+            elif version._length < next_version._length:
+                undo = (index, data.pop(), version)
+            else:
+                undo = (index, data[index], version)
+                data[index] = value
+            next_version._data = None
+            next_version._diff = undo
+            version._data = data
+            version._diff = None
+        return data
+
+    def _derive(self, data: list, diff: tuple) -> "PersistentList":
+        """新版本持有data，这个版本记录diff，调用时需要持有锁"""
+        version = PersistentList.__new__(PersistentList)
+        version._data = data
+        version._diff = None
+        version._length = len(data)
+        version._lock = self._lock
+        self._data = None
+        self._diff = diff + (version,)
+        return version
+
+    def appended(self, item) -> "PersistentList":
+        """返回追加了item的新版本"""
+        with self._lock:
+            data = self._reroot()
+            data.append(item)
+            return self._derive(data, (self._length, _MISSING))
+
+    def extended(self, items) -> "PersistentList":
+        """返回追加了items的新版本"""
+        result = self
+        for item in items:
+            result = result.appended(item)
+        return result
+
+    def with_item(self, index: int, item) -> "PersistentList":
+        """返回把index处的元素替换为item的新版本"""
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("list assignment index out of range")
+        with self._lock:
+            data = self._reroot()
+            old = data[index]
+            data[index] = item
+            return self._derive(data, (index, old))
+
+    def sample(self, count: int) -> list:
+        """前count个元素，不复制整个列表"""
+        with self._lock:
+            return list(itertools.islice(self._reroot(), count))
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, index):
+        with self._lock:
+            return self._reroot()[index]
+
+    def __iter__(self):
+        with self._lock:
+            items = list(self._reroot())
+        return iter(items)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, (list, PersistentList)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    __hash__ = None
+
+    def __add__(self, other) -> "PersistentList":
+        if not isinstance(other, (list, PersistentList)):
+            return NotImplemented
+        return self.extended(other)
+
+    def __radd__(self, other) -> list:
+        if not isinstance(other, list):
+            return NotImplemented
+        return other + list(self)
+
+    def __repr__(self) -> str:
+        return repr(list(self))
+
+    def __reduce__(self):
+        return (PersistentList, (list(self),))
+
+
+class PersistentDict(Mapping):
+    # 持有字典的版本_data为字典、_diff为None；其它版本_data为None，
+    # _diff为(key, 这个版本中的值或者_MISSING, 下一个版本)
+    __slots__ = ("_data", "_diff", "_lock")
+
+    def __init__(self, mapping=(), **kwargs):
+        self._data = dict(mapping, **kwargs)
+        self._diff = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def of(cls, mapping) -> "PersistentDict":
+        """已经是PersistentDict时直接返回，否则复制一次"""
+        if isinstance(mapping, PersistentDict):
+            return mapping
+        return cls(mapping)
+
+    def _reroot(self) -> dict:
+        """让这个版本持有字典，调用时需要持有锁"""
+        if self._diff is None:
+            return self._data
+        path = []
+        version = self
+        while version._diff is not None:
+            path.append(version)
+            version = version._diff[2]
+        data = version._data
+        for version in reversed(path):
+            key, value, next_version = version._diff
+            old = data.get(key, _MISSING)
+            if value is _MISSING:
+                del data[key]
+            else:
+                data[key] = value
+            next_version._data = None
+            next_version._diff = (key, old, version)
+            version._data = data
+            version._diff = None
+        return data
+
+    def with_item(self, key, value) -> "PersistentDict":
+        """返回把key设置为value的新版本"""
+        with self._lock:
+            data = self._reroot()
+            version = PersistentDict.__new__(PersistentDict)
+            version._data = data
+            version._diff = None
+            version._lock = self._lock
+            self._data = None
+            self._diff = (key, data.get(key, _MISSING), version)
+            data[key] = value
+            return version
+
+    def updated(self, mapping) -> "PersistentDict":
+        """返回合并了mapping的新版本"""
+        result = self
+        for key, value in mapping.items():
+            result = result.with_item(key, value)
+        return result
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return dict(self._reroot())
+
+    def __getitem__(self, key):
+        with self._lock:
+            return self._reroot()[key]
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._reroot()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._reroot())
+
+    def __iter__(self):
+        with self._lock:
+            keys = list(self._reroot())
+        return iter(keys)
+
+    def items(self):
+        return self.to_dict().items()
+
+    def sample(self, count: int) -> list[tuple]:
+        """最多count个(key, value)，不复制整个字典"""
+        with self._lock:
+            return list(itertools.islice(self._reroot().items(), count))
+
+    def values(self):
+        return self.to_dict().values()
+
+    def __repr__(self) -> str:
+        return repr(self.to_dict())
+
+    def __reduce__(self):
+        return (PersistentDict, (self.to_dict(),))
+
+
+def to_plain(value):
+    """把PersistentList/PersistentDict（包括其中嵌套的）转换成list/dict，其它值原样返回"""
+    if isinstance(value, PersistentList):
+        return [to_plain(item) for item in value]
+    if isinstance(value, PersistentDict):
+        return {key: to_plain(item) for key, item in value.items()}
+    return value
+
+
+def json_default(value):
+    """json.dumps的default，持久集合转换成list/dict，其它无法序列化的对象用repr"""
+    if isinstance(value, (PersistentList, PersistentDict)):
+        return to_plain(value)
+    return repr(value)
@@ -1,6 +1,17 @@
 from typing import Iterator
+import math
+import operator as operators
 from app import app
-from node_basic import BaseDataNode, NodeOutput, Reference, FetchInputsRequest, NoInput
+from node_basic import (
+    BaseDataNode,
+    NodeOutput,
+    Reference,
+    FetchInputsRequest,
+    MapRequest,
+    NoInput,
+)
+from persistent import PersistentDict, PersistentList, to_plain
+from stream import Stream
 from types import SimpleNamespace
 
 TOP_CATEGORY = "Basic/"
@@ -122,6 +133,7 @@ class ConvertToIntNode(BaseDataNode):
         return {
             "title": "Convert To Int",
             "execution": "DATA",
+            "pure": True,
             "category": TOP_CATEGORY + "Convert",
             "inputs": [{"name": "value", "type": "*"}],
             "outputs": [{"name": "value", "type": "int"}],
@@ -130,6 +142,10 @@ class ConvertToIntNode(BaseDataNode):
     def get_data(self, controller, value: int) -> dict[str, any]:
         return {"value": int(value)}
 
+    @classmethod
+    def get_data_vectorized(cls, np, value) -> dict[str, any] | None:
+        return {"value": np.frompyfunc(int, 1, 1)(value)}
+
 
 @app.node_def("ConvertToFloatNode")
 class ConvertToFloatNode(BaseDataNode):
@@ -138,6 +154,7 @@ class ConvertToFloatNode(BaseDataNode):
         return {
             "title": "Convert To Float",
             "execution": "DATA",
+            "pure": True,
             "category": TOP_CATEGORY + "Convert",
             "inputs": [{"name": "value", "type": "*"}],
             "outputs": [{"name": "value", "type": "float"}],
@@ -146,6 +163,10 @@ class ConvertToFloatNode(BaseDataNode):
     def get_data(self, controller, value: int) -> dict[str, any]:
         return {"value": float(value)}
 
+    @classmethod
+    def get_data_vectorized(cls, np, value) -> dict[str, any] | None:
+        return {"value": np.frompyfunc(float, 1, 1)(value)}
+
 
 @app.node_def("ConvertToStringNode")
 class ConvertToStringNode(BaseDataNode):
@@ -210,6 +231,41 @@ class ForEachNode:
             yield NodeOutput(execution_pin="body", data={"item": item})
 
 
+@app.node_def("ParallelForEachNode")
+class ParallelForEachNode:
+    @classmethod
+    def meta(cls) -> dict[str, any]:
+        return {
+            "title": "Parallel For Each",
+            "category": TOP_CATEGORY + "Control Flow",
+            "inputs": [
+                {"name": "items", "type": "list<T>"},
+                {"name": "max_concurrency", "type": "int", "options": {"default": 4}},
+                {"name": "result", "type": "R", "lazy": True},
+            ],
+            "outputs": [
+                {"name": "item", "type": "T"},
+                {"name": "index", "type": "int"},
+                {"name": "body", "type": "route"},
+                {"name": "results", "type": "list<R>"},
+            ],
+            "generic_types": ["T", "R"],
+        }
+
+    def execute(
+        self, controller, items: list, max_concurrency: int = 4
+    ) -> Iterator[NodeOutput]:
+        results = yield MapRequest(
+            execution_pin="body",
+            items=[{"item": item, "index": index} for index, item in enumerate(items)],
+            result_pins=["result"],
+            max_concurrency=max_concurrency,
+        )
+        yield NodeOutput(
+            execution_pin=None, data={"results": [result for (result,) in results]}
+        )
+
+
 @app.node_def("WhileLoopNode")
 class WhileLoopNode:
     @classmethod
@@ -284,6 +340,7 @@ class AddIntNode(BaseDataNode):
             "title": "Add Int",
             "category": TOP_CATEGORY + "Math",
             "execution": "DATA",
+            "pure": True,
             "inputs": [
                 {"name": "a", "type": "int"},
                 {"name": "b", "type": "int"},
@@ -296,6 +353,29 @@ class AddIntNode(BaseDataNode):
     def get_data(self, controller, a: int, b: int) -> dict[str, any]:
         return {"result": a + b}
 
+    @classmethod
+    def get_data_vectorized(cls, np, a, b) -> dict[str, any] | None:
+        """a、b可以是object类型的NumPy数组，用于循环的向量化执行，见vectorize模块"""
+        return {"result": a + b}
+
+
+# 和eval(f"{a} {operator} {b}")结果相同的运算，"**"对负数的结果不同，不能向量化
+VECTORIZED_OPERATORS = {
+    "+": operators.add,
+    "-": operators.sub,
+    "*": operators.mul,
+    "/": operators.truediv,
+    "%": operators.mod,
+}
+
+
+def _is_finite_numbers(np, value) -> bool:
+    """eval只对有限的int/float和直接运算结果相同"""
+    values = value.flat if isinstance(value, np.ndarray) else (value,)
+    return all(
+        type(v) is int or (type(v) is float and math.isfinite(v)) for v in values
+    )
+
 
 @app.node_def("MathOperationNode")
 class MathOperationNode(BaseDataNode):
@@ -305,6 +385,7 @@ class MathOperationNode(BaseDataNode):
             "title": "Math Operation",
             "category": TOP_CATEGORY + "Math",
             "execution": "DATA",
+            "pure": True,
             "inputs": [
                 {"name": "a", "type": "*"},
                 {"name": "b", "type": "*"},
@@ -326,6 +407,19 @@ class MathOperationNode(BaseDataNode):
     def get_data(self, controller, a: any, b: any, operator: str) -> dict[str, any]:
         return {"result": eval(f"{a} {operator} {b}")}
 
+    @classmethod
+    def get_data_vectorized(
+        cls, np, a: any, b: any, operator: str
+    ) -> dict[str, any] | None:
+        if (
+            not isinstance(operator, str)
+            or operator not in VECTORIZED_OPERATORS
+            or not _is_finite_numbers(np, a)
+            or not _is_finite_numbers(np, b)
+        ):
+            return None
+        return {"result": VECTORIZED_OPERATORS[operator](a, b)}
+
 
 @app.node_def("CompareNode")
 class CompareNode(BaseDataNode):
@@ -335,6 +429,7 @@ class CompareNode(BaseDataNode):
             "title": "Compare",
             "category": TOP_CATEGORY + "Logic",
             "execution": "DATA",
+            "pure": True,
             "inputs": [
                 {
                     "name": "operator",
@@ -431,6 +526,29 @@ class DisplayAsTextNode(BaseDataNode):
         return {"value": value}
 
 
+@app.node_def("DisplayStreamNode")
+class DisplayStreamNode(BaseDataNode):
+    @classmethod
+    def meta(cls) -> dict[str, any]:
+        return {
+            "title": "Display Stream",
+            "category": TOP_CATEGORY + "Output",
+            # 上游还在输出时就逐段显示，结束后输出完整的文本
+            "inputs": [{"name": "stream", "type": "str", "stream": True}],
+            "outputs": [{"name": "value", "type": "str"}],
+            "display": [{"name": "value", "type": "text"}],
+        }
+
+    def get_data(self, controller, stream: any) -> dict[str, any]:
+        if not isinstance(stream, Stream):
+            controller.send_event("display", {"value": str(stream)})
+            return {"value": stream}
+        controller.send_event("display", {"value": ""})
+        for part in stream:
+            controller.send_event("append", {"value": str(part)})
+        return {"value": stream.materialize()}
+
+
 @app.node_def("ExecutePythonScriptNode")
 class ExecutePythonScriptNode(BaseDataNode):
     @classmethod
@@ -438,6 +556,9 @@ class ExecutePythonScriptNode(BaseDataNode):
         return {
             "title": "Execute Python Script",
             "category": TOP_CATEGORY + "Script",
+            # 默认在当前进程中执行，脚本可以修改输入；
+            # process_pool为真时在进程池中执行，对输入的修改不会传回来
+            "cpu_bound": "process_pool",
             "inputs": [
                 {"name": "script", "type": "str", "widget": "str_multiline"},
                 {"name": "input", "type": "*"},
@@ -446,6 +567,11 @@ class ExecutePythonScriptNode(BaseDataNode):
                     "type": "str",
                     "options": {"default": "result"},
                 },
+                {
+                    "name": "process_pool",
+                    "type": "bool",
+                    "options": {"default": False},
+                },
             ],
             "outputs": [{"name": "result", "type": "*"}],
         }
@@ -456,9 +582,11 @@ class ExecutePythonScriptNode(BaseDataNode):
         script: str,
         input: any = None,
         output_name: str = "result",
+        process_pool: bool = False,
     ) -> dict[str, any]:
         locals_dict = {}
-        input_dict = {"input": input}
+        # 脚本按普通的list/dict使用输入
+        input_dict = {"input": to_plain(input)}
         try:
             exec(script, input_dict, locals_dict)
         except SystemExit as e:
@@ -473,9 +601,17 @@ class PythonEvalNode(BaseDataNode):
         return {
             "title": "Python Eval",
             "category": TOP_CATEGORY + "Script",
+            # 默认在当前进程中执行，脚本可以修改输入；
+            # process_pool为真时在进程池中执行，对输入的修改不会传回来
+            "cpu_bound": "process_pool",
             "inputs": [
                 {"name": "expression", "type": "str"},
                 {"name": "input", "type": "*"},
+                {
+                    "name": "process_pool",
+                    "type": "bool",
+                    "options": {"default": False},
+                },
             ],
             "outputs": [{"name": "result", "type": "*"}],
         }
@@ -485,9 +621,11 @@ class PythonEvalNode(BaseDataNode):
         controller,
         expression: str,
         input: any = None,
+        process_pool: bool = False,
     ) -> dict[str, any]:
         locals_dict = {}
-        input_dict = {"input": input}
+        # 脚本按普通的list/dict使用输入
+        input_dict = {"input": to_plain(input)}
         try:
             return {"result": eval(expression, input_dict, locals_dict)}
         except SystemExit as e:
@@ -596,8 +734,8 @@ class ListNode(BaseDataNode):
         if not isinstance(item_4, NoInput):
             result.append(item_4)
         if last_list is not None:
-            result = last_list + result
-        return {"list": result}
+            return {"list": PersistentList.of(last_list).extended(result)}
+        return {"list": PersistentList(result)}
 
 
 @app.node_def("AppendToListNode")
@@ -620,8 +758,8 @@ class AppendToListNode(BaseDataNode):
         self, controller, item: any, list: list | None = None
     ) -> dict[str, any]:
         if list is None:
-            list = []
-        return {"list": list + [item]}
+            return {"list": PersistentList([item])}
+        return {"list": PersistentList.of(list).appended(item)}
 
 
 @app.node_def("GetListItemNode")
@@ -662,6 +800,10 @@ class SetListItemNode(BaseDataNode):
         }
 
     def get_data(self, controller, list: list, index: int, item: any) -> dict[str, any]:
+        # 持久列表不可修改，返回新的版本；普通的列表直接修改，
+        # 可以在循环中填充DATA_ONCE的EmptyListNode
+        if isinstance(list, PersistentList):
+            return {"list": list.with_item(index, item)}
         list[index] = item
         return {"list": list}
 
@@ -704,6 +846,10 @@ class PutToDictNode(BaseDataNode):
     ) -> dict[str, any]:
         if dict is None:
             dict = {}
+        # 持久字典不可修改，返回新的版本；普通的字典直接修改，
+        # 可以在循环中填充DATA_ONCE的EmptyDictNode
+        if isinstance(dict, PersistentDict):
+            return {"dict": dict.with_item(key, value)}
         dict[key] = value
         return {"dict": dict}
 
@@ -769,17 +915,17 @@ class StringKeyDictNode(BaseDataNode):
         value_4: any = NoInput(),
     ) -> dict[str, any]:
         if last_dict is None:
-            result_dict = {}
+            result_dict = PersistentDict()
         else:
-            result_dict = dict(last_dict)
+            result_dict = PersistentDict.of(last_dict)
         if not isinstance(value_0, NoInput):
-            result_dict[key_0] = value_0
+            result_dict = result_dict.with_item(key_0, value_0)
         if not isinstance(value_1, NoInput):
-            result_dict[key_1] = value_1
+            result_dict = result_dict.with_item(key_1, value_1)
         if not isinstance(value_2, NoInput):
-            result_dict[key_2] = value_2
+            result_dict = result_dict.with_item(key_2, value_2)
         if not isinstance(value_3, NoInput):
-            result_dict[key_3] = value_3
+            result_dict = result_dict.with_item(key_3, value_3)
         if not isinstance(value_4, NoInput):
-            result_dict[key_4] = value_4
+            result_dict = result_dict.with_item(key_4, value_4)
         return {"dict": result_dict}
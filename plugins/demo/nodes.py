@@ -1,6 +1,7 @@
-from node_basic import BaseDataNode, NodeOutput
+from node_basic import AsyncBaseDataNode, BaseDataNode, NodeOutput
 from app import app
 from typing import Iterator
+import asyncio
 
 
 # For data nodes, inherit from BaseDataNode and implement meta and get_data function
@@ -21,6 +22,9 @@ class HelloExampleNode(BaseDataNode):
             # The default execution mode of the node. TRIGGERED: execute when triggered, DATA: execute when other nodes need its output data, DATA_ONCE: same as DATA but only execute once
             # 节点的默认执行方式。TRIGGERED: 触发时执行，DATA：其它节点需要它的输出数据时执行，DATA_ONCE：同DATA，但只执行一次
             "execution": "DATA",
+            # Optional. A pure DATA node's outputs depend only on its inputs, so it is not re-executed while none of its upstream outputs change.
+            # 可选。纯数据节点的输出只由输入决定，上游输出都没有变化时不会重新执行
+            "pure": True,
             # The category of the node displayed in the menu. If it contains "/", it represents multi-level categories.
             # 显示在菜单中的节点的分类。如果带了"/"，则表示多级分类
             "category": "Demo",
@@ -102,3 +106,27 @@ class CustomRouteExampleNode:
                 "display", {"tip1": "negative", "tip2": f"You choosed {input2}."}
             )
             yield NodeOutput(execution_pin="negative", data={"value": -1})
+
+
+# Nodes that wait on I/O can be asynchronous. Inherit from AsyncBaseDataNode and implement an async get_data, or implement execute as an async generator.
+# 等待I/O的节点可以是异步的。继承AsyncBaseDataNode并实现异步的get_data，或者把execute实现为异步生成器
+@app.node_def("Demo.AsyncExampleNode")
+class AsyncExampleNode(AsyncBaseDataNode):
+    @classmethod
+    def meta(cls) -> dict[str, any]:
+        return {
+            "title": "Async Example",
+            "execution": "DATA",
+            "category": "Demo",
+            "inputs": [
+                {"name": "value", "type": "str", "options": {"default": ""}},
+                {"name": "delay", "type": "float", "options": {"default": 1.0}},
+            ],
+            "outputs": [{"name": "value", "type": "str"}],
+        }
+
+    async def get_data(self, controller, value: str, delay: float) -> dict[str, any]:
+        # While waiting, the event loop keeps running other nodes and requests.
+        # 等待期间，事件循环可以继续执行其它节点和请求
+        await asyncio.sleep(delay)
+        return {"value": value}
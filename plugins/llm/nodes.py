@@ -1,9 +1,11 @@
 from node_basic import BaseDataNode
 from app import app
 from dataclasses import dataclass
-from typing import Iterator
+from typing import AsyncIterator
 from node_basic import NodeOutput
-from openai import OpenAI
+from openai import AsyncOpenAI
+from persistent import PersistentList
+from stream import Stream
 import string
 
 
@@ -40,7 +42,11 @@ class AppendToChatMessageListNode(BaseDataNode):
     def get_data(
         self, controller, role: str, content: str, message_list: list[ChatMessage] = []
     ) -> dict[str, any]:
-        return {"message_list": message_list + [{"role": role, "content": content}]}
+        return {
+            "message_list": PersistentList.of(message_list).appended(
+                {"role": role, "content": content}
+            )
+        }
 
 
 @app.node_def("LLM.OpenAIChatCompletionNode")
@@ -50,6 +56,10 @@ class OpenAIChatCompletionNode:
         return {
             "title": "OpenAI Chat Completion",
             "category": "LLM",
+            # 调用的结果记录到检查点中，失败后恢复执行时不需要重新调用
+            "checkpoint": True,
+            # 相同的输入在启用了结果缓存时直接使用上一次的回复
+            "cache": True,
             "inputs": [
                 {
                     "name": "api_key",
@@ -75,14 +85,17 @@ class OpenAIChatCompletionNode:
             ],
             "outputs": [
                 {"name": "role", "type": "str"},
-                {"name": "content", "type": "str"},
+                # 回复开始时就通过on_stream输出，下游的流式输入可以逐段读取，
+                # 其它输入读到的是完整的文本
+                {"name": "content", "type": "str", "stream": True},
+                {"name": "on_stream", "type": "route"},
                 {"name": "on_content_part", "type": "route"},
                 {"name": "content_part", "type": "str"},
             ],
             "display": [{"name": "outputing", "type": "text"}],
         }
 
-    def execute(
+    async def execute(
         self,
         controller,
         api_key: str,
@@ -91,28 +104,36 @@ class OpenAIChatCompletionNode:
         messages: list[ChatMessage],
         temperature: float,
         max_tokens: int,
-    ) -> Iterator[NodeOutput]:
-        client = OpenAI(api_key=api_key, base_url=base_url if base_url else None)
+    ) -> AsyncIterator[NodeOutput]:
+        client = AsyncOpenAI(api_key=api_key, base_url=base_url if base_url else None)
 
-        response_text = ""
-        completion = client.chat.completions.create(
+        completion = await client.chat.completions.create(
             model=model,
-            messages=messages,
+            # 消息列表可能是PersistentList，客户端需要list
+            messages=list(messages),
             temperature=temperature,
             max_tokens=max_tokens,
             stream=True,
         )
+
+        async def content_parts():
+            async for chunk in completion:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    content_part = chunk.choices[0].delta.content
+                    controller.send_event("append", {"outputing": content_part})
+                    yield content_part
+
         controller.send_event("display", {"outputing": ""})
-        for chunk in completion:
-            if chunk.choices and chunk.choices[0].delta.content:
-                content_part = chunk.choices[0].delta.content
-                response_text += content_part
-                controller.send_event("append", {"outputing": content_part})
-                yield NodeOutput(
-                    execution_pin="on_content_part", data={"content_part": content_part}
-                )
+        content = Stream(content_parts())
+        yield NodeOutput(
+            execution_pin="on_stream", data={"role": "assistant", "content": content}
+        )
+        async for content_part in content:
+            yield NodeOutput(
+                execution_pin="on_content_part", data={"content_part": content_part}
+            )
         yield NodeOutput(
-            execution_pin=None, data={"role": "assistant", "content": response_text}
+            execution_pin=None, data={"role": "assistant", "content": content}
         )
 
 
@@ -124,6 +145,7 @@ class PromptTemplateNode(BaseDataNode):
             "title": "Prompt Template",
             "category": "LLM",
             "execution": "DATA",
+            "cache": True,
             "inputs": [
                 {"name": "template", "type": "str", "widget": "str_multiline"},
                 {"name": "variables", "type": "dict<str, str>"},
@@ -0,0 +1,177 @@
+"""执行器的性能分析
+
+启用后记录每个节点和每种节点类型的墙钟时间、CPU时间、执行次数和产生输出的次数，
+以及调度器内部（计算执行顺序、收集输入）花费的时间。
+不启用时执行器不会调用这里的任何代码。
+
+节点的时间是驱动节点生成器（包括调用execute）花费的时间，不包含它触发的下游节点。
+CPU时间是驱动节点的线程的CPU时间，不包含子进程和后台事件循环中的时间。
+"""
+
+from dataclasses import asdict, dataclass
+import threading
+import time
+
+
+@dataclass
+class NodeStats:
+    node_type: str
+    calls: int = 0  # 开始执行的次数
+    yields: int = 0  # 产生输出的次数
+    wall_time: float = 0.0
+    cpu_time: float = 0.0
+
+
+@dataclass
+class SchedulerStats:
+    calls: int = 0
+    wall_time: float = 0.0
+
+
+class Profiler:
+    def __init__(self):
+        self.nodes: dict[str, NodeStats] = {}  # 节点id -> 统计
+        self.scheduler: dict[str, SchedulerStats] = {}  # 调度器函数 -> 统计
+        self.start_time: float | None = None
+        self.end_time: float | None = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.start_time = time.perf_counter()
+
+    def stop(self):
+        self.end_time = time.perf_counter()
+
+    def _add_node_time(
+        self, stats: NodeStats, wall_time: float, cpu_time: float, yielded: bool
+    ):
+        with self.lock:
+            stats.wall_time += wall_time
+            stats.cpu_time += cpu_time
+            if yielded:
+                stats.yields += 1
+
+    def _node_stats(self, node_id: str, node_type: str) -> NodeStats:
+        with self.lock:
+            stats = self.nodes.get(node_id)
+            if stats is None:
+                stats = self.nodes[node_id] = NodeStats(node_type=node_type)
+            stats.calls += 1
+            return stats
+
+    def wrap_scheduler(self, name: str, function):
+        """统计调度器函数的调用次数和时间"""
+        stats = self.scheduler.setdefault(name, SchedulerStats())
+        lock = self.lock
+
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with lock:
+                    stats.calls += 1
+                    stats.wall_time += elapsed
+
+        return wrapper
+
+    def wrap_create_outputs_iterator(self, create_outputs_iterator):
+        """统计节点的执行，包装GraphExecutor._create_outputs_iterator"""
+
+        def wrapper(node_instance, controller, inputs, asynchronous):
+            node_data = node_instance.node_data
+            stats = self._node_stats(node_data.id, node_data.node_type)
+            wall_start = time.perf_counter()
+            cpu_start = time.thread_time()
+            outputs_iterator = create_outputs_iterator(
+                node_instance, controller, inputs, asynchronous
+            )
+            self._add_node_time(
+                stats,
+                time.perf_counter() - wall_start,
+                time.thread_time() - cpu_start,
+                False,
+            )
+            if hasattr(outputs_iterator, "asend"):
+                return self._profile_async_outputs(outputs_iterator, stats)
+            return self._profile_outputs(outputs_iterator, stats)
+
+        return wrapper
+
+    def _profile_outputs(self, outputs_iterator, stats: NodeStats):
+        send_value = None
+        while True:
+            wall_start = time.perf_counter()
+            cpu_start = time.thread_time()
+            output = None
+            try:
+                output = outputs_iterator.send(send_value)
+            except StopIteration:
+                return
+            finally:
+                self._add_node_time(
+                    stats,
+                    time.perf_counter() - wall_start,
+                    time.thread_time() - cpu_start,
+                    output is not None,
+                )
+            send_value = yield output
+
+    async def _profile_async_outputs(self, outputs_iterator, stats: NodeStats):
+        send_value = None
+        while True:
+            wall_start = time.perf_counter()
+            cpu_start = time.thread_time()
+            output = None
+            try:
+                output = await outputs_iterator.asend(send_value)
+            except StopAsyncIteration:
+                return
+            finally:
+                self._add_node_time(
+                    stats,
+                    time.perf_counter() - wall_start,
+                    time.thread_time() - cpu_start,
+                    output is not None,
+                )
+            send_value = yield output
+
+    def summary(self) -> dict[str, any]:
+        """可以JSON序列化的统计结果"""
+        with self.lock:
+            nodes = {node_id: asdict(stats) for node_id, stats in self.nodes.items()}
+            scheduler = {name: asdict(stats) for name, stats in self.scheduler.items()}
+        node_types = {}
+        for stats in nodes.values():
+            type_stats = node_types.setdefault(
+                stats["node_type"],
+                {
+                    "nodes": 0,
+                    "calls": 0,
+                    "yields": 0,
+                    "wall_time": 0.0,
+                    "cpu_time": 0.0,
+                },
+            )
+            type_stats["nodes"] += 1
+            for key in ("calls", "yields", "wall_time", "cpu_time"):
+                type_stats[key] += stats[key]
+        total_time = None
+        if self.start_time is not None:
+            end_time = (
+                self.end_time if self.end_time is not None else time.perf_counter()
+            )
+            total_time = end_time - self.start_time
+        node_time = sum(stats["wall_time"] for stats in nodes.values())
+        return {
+            "total_time": total_time,
+            "node_time": node_time,
+            # 总时间中不属于任何节点的部分，即调度器和进度回调花费的时间
+            "overhead_time": (
+                total_time - node_time if total_time is not None else None
+            ),
+            "scheduler": scheduler,
+            "nodes": nodes,
+            "node_types": node_types,
+        }
@@ -0,0 +1,302 @@
+"""执行器和传输层之间的进度事件管道
+
+执行器每一步都会发送execute_node事件，LLM节点每个token都会发送一个append事件，
+逐个序列化和发送会在进度报告上花费大量CPU和带宽。ProgressPipeline在发送前：
+- 按详细程度过滤事件：
+  - none: 只有finish、execute_node_error和run_admitted
+  - summary: 再加上节点的输出，即display和append
+  - node: 再加上execute_node，每个节点在一批中最多一个
+  - full: 所有事件
+- 把同一个节点连续的append事件合并成一个
+- 按时间间隔批量发送，两批之间至少间隔flush_interval秒
+- 传输跟不上时最多保留max_pending个事件，超过时丢弃最旧的事件（finish和错误不会被丢弃），
+  下一批的开头用events_dropped事件报告丢弃的数量
+
+put必须在事件循环所在的线程中调用，GraphExecutor.execute_async保证了这一点。
+bridge()返回可以在任意线程中调用的EventBridge，传输跟不上时让其它线程中产生事件的节点等待，
+而不是丢弃它们的事件。
+"""
+
+import asyncio
+from collections import deque
+import threading
+from persistent import PersistentDict, PersistentList, to_plain
+
+NONE = "none"
+SUMMARY = "summary"
+NODE = "node"
+FULL = "full"
+VERBOSITY_LEVELS = (NONE, SUMMARY, NODE, FULL)
+
+# 不会被过滤和丢弃的事件
+ESSENTIAL_EVENTS = frozenset(
+    [
+        "finish",
+        "execute_node_error",
+        "run_admitted",
+        "run_rejected",
+        "row_result",
+        "batch_finish",
+    ]
+)
+
+
+def plain_event(event: dict) -> dict:
+    """data中的PersistentList/PersistentDict转换成list/dict后的事件，没有时返回原来的事件
+
+    保存下来、之后被序列化成JSON的事件使用
+    """
+    data = event.get("data")
+    if not isinstance(data, dict) or not any(
+        isinstance(value, (PersistentList, PersistentDict)) for value in data.values()
+    ):
+        return event
+    return {**event, "data": {key: to_plain(value) for key, value in data.items()}}
+
+
+def merge_output(outputs: dict[str, dict], node_id: str, event: dict):
+    """把节点的display和append事件合并到outputs[node_id]中，即节点最终显示的内容"""
+    event = plain_event(event)
+    kind = event.get("event")
+    if kind == "display":
+        outputs[node_id] = dict(event["data"])
+    elif kind == "append":
+        output = outputs.setdefault(node_id, {})
+        for key, value in event["data"].items():
+            if isinstance(value, str) and isinstance(output.get(key), str):
+                output[key] += value
+            else:
+                output[key] = value
+
+
+class EventBridge:
+    """把其它线程中产生的事件交给事件循环线程中的callback
+
+    其它线程中的事件先放入缓冲区，缓冲区从空变为非空时才调用一次call_soon_threadsafe，
+    事件循环一次取出所有积累的事件，密集的事件只唤醒事件循环一次。
+    缓冲区中有max_buffered个事件时，产生事件的线程等待事件循环取走它们。
+    pause之后事件留在缓冲区中，直到resume。事件循环线程中的事件不会等待，
+    缓冲区为空时直接交给callback，否则排在缓冲区中的事件之后。必须在事件循环中创建
+    """
+
+    def __init__(self, callback, max_buffered: int = 10000):
+        self.callback = callback
+        self.max_buffered = max_buffered
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.buffer: list = []
+        self.condition = threading.Condition()
+        self.scheduled = False
+        self.paused = False
+        self.closed = False
+
+    def __call__(self, event):
+        if threading.get_ident() == self.loop_thread:
+            # 缓冲区中还有其它线程的事件时排在它们之后，保持顺序
+            if not self.buffer:
+                self.callback(event)
+                return
+            with self.condition:
+                self.buffer.append(event)
+            return
+        with self.condition:
+            while len(self.buffer) >= self.max_buffered and not self.closed:
+                self.condition.wait()
+            self.buffer.append(event)
+            self._schedule()
+
+    def _schedule(self):
+        """调用时需要持有锁"""
+        if not self.scheduled and not self.paused:
+            self.scheduled = True
+            self.loop.call_soon_threadsafe(self._deliver)
+
+    def _deliver(self):
+        with self.condition:
+            self.scheduled = False
+            if self.paused:
+                return
+            events, self.buffer = self.buffer, []
+            self.condition.notify_all()
+        for index, event in enumerate(events):
+            if self.paused:
+                # callback中暂停了，剩下的事件放回缓冲区
+                with self.condition:
+                    self.buffer[:0] = events[index:]
+                return
+            self.callback(event)
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        with self.condition:
+            if self.buffer:
+                self._schedule()
+
+    def close(self):
+        """在事件循环中调用，立即交出缓冲区中的事件，之后产生事件的线程不再等待"""
+        self.closed = True
+        self.paused = False
+        self._deliver()
+
+
+class ProgressPipeline:
+    def __init__(
+        self,
+        verbosity: str = FULL,
+        flush_interval: float = 0.05,
+        max_pending: int = 10000,
+    ):
+        if verbosity not in VERBOSITY_LEVELS:
+            raise ValueError(f"unknown verbosity {verbosity}")
+        level = VERBOSITY_LEVELS.index(verbosity)
+        self.include_outputs = level >= VERBOSITY_LEVELS.index(SUMMARY)
+        self.include_execute_node = level >= VERBOSITY_LEVELS.index(NODE)
+        self.merge_execute_node = verbosity == NODE
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending: deque[dict] = deque()
+        # 节点id -> 这一批中可以继续合并的append事件
+        self.appends: dict[str, dict] = {}
+        # 这一批中已经有execute_node事件的节点，node级别使用
+        self.executing: set[str] = set()
+        self.dropped = 0
+        self.closed = False
+        self.error: Exception | None = None
+        self.ready = asyncio.Event()
+        # close之后设置
+        self.finished = asyncio.Event()
+        # 待发送的事件少于max_pending时设置，见wait_for_space
+        self.has_space = asyncio.Event()
+        self.has_space.set()
+        self.last_flush = 0.0
+        self._bridge: EventBridge | None = None
+
+    def bridge(self) -> EventBridge:
+        """可以在任意线程中调用的put，必须在事件循环中调用
+
+        待发送的事件达到max_pending时暂停，其它线程中的节点等到下一批发送后才能继续
+        """
+        if self._bridge is None:
+            self._bridge = EventBridge(self.put, self.max_pending)
+        return self._bridge
+
+    def put(self, event: dict):
+        """作为执行器的progress_callback"""
+        kind = event.get("event")
+        if kind in ESSENTIAL_EVENTS:
+            pass
+        elif kind == "execute_node":
+            if not self.include_execute_node:
+                return
+            if self.merge_execute_node:
+                if event["node_id"] in self.executing:
+                    return
+                self.executing.add(event["node_id"])
+        elif not self.include_outputs:
+            return
+        elif kind == "append":
+            if self._merge_append(event):
+                return
+            # 复制一份，之后的合并不会修改节点发送的对象
+            event = {**event, "data": dict(event["data"])}
+            self.appends[event["node_id"]] = event
+        elif kind == "display":
+            # display会替换之前的内容，之后的append不能合并到它之前
+            self.appends.pop(event.get("node_id"), None)
+        self.pending.append(event)
+        if len(self.pending) > self.max_pending:
+            self._drop_oldest()
+        if len(self.pending) >= self.max_pending:
+            self.has_space.clear()
+        if (
+            self._bridge is not None
+            and not self.closed
+            and len(self.pending) >= self.max_pending
+        ):
+            self._bridge.pause()
+        self.ready.set()
+
+    def _merge_append(self, event: dict) -> bool:
+        pending = self.appends.get(event["node_id"])
+        if pending is None:
+            return False
+        data = event["data"]
+        pending_data = pending["data"]
+        if data.keys() != pending_data.keys() or not all(
+            type(value) is str and type(pending_data[key]) is str
+            for key, value in data.items()
+        ):
+            self.appends.pop(event["node_id"])
+            return False
+        for key, value in data.items():
+            pending_data[key] += value
+        return True
+
+    def _drop_oldest(self):
+        for index, event in enumerate(self.pending):
+            if event.get("event") in ESSENTIAL_EVENTS:
+                continue
+            del self.pending[index]
+            node_id = event.get("node_id")
+            if self.appends.get(node_id) is event:
+                del self.appends[node_id]
+            if event.get("event") == "execute_node":
+                self.executing.discard(node_id)
+            self.dropped += 1
+            return
+
+    def drain(self) -> list[dict]:
+        """取出所有待发送的事件"""
+        events = list(self.pending)
+        if self.dropped:
+            events.insert(0, {"event": "events_dropped", "count": self.dropped})
+            self.dropped = 0
+        self.pending.clear()
+        self.appends.clear()
+        self.executing.clear()
+        self.ready.clear()
+        self.has_space.set()
+        if self._bridge is not None:
+            self._bridge.resume()
+        return events
+
+    async def wait_for_space(self):
+        """事件循环中的生产者在put之前等待，待发送的事件达到max_pending时等到下一批发送"""
+        await self.has_space.wait()
+
+    def close(self, error: Exception | None = None):
+        """执行结束或者不再读取，error不为None时batches在发送完剩余事件后抛出它，
+        重复调用时忽略。之后bridge不再暂停"""
+        if self.closed:
+            return
+        self.closed = True
+        self.error = error
+        self.has_space.set()
+        if self._bridge is not None:
+            self._bridge.close()
+        self.ready.set()
+        self.finished.set()
+
+    def exhausted(self) -> bool:
+        """已经close并且没有剩余的事件，batches不会再产生任何一批"""
+        return self.closed and not self.pending and not self.dropped
+
+    async def batches(self):
+        """按时间间隔产生一批批事件，直到close"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.ready.wait()
+            delay = self.last_flush + self.flush_interval - loop.time()
+            if delay > 0 and not self.closed:
+                await asyncio.sleep(delay)
+            events = self.drain()
+            self.last_flush = loop.time()
+            if events:
+                yield events
+            if self.closed and not self.pending:
+                if self.error is not None:
+                    raise self.error
+                return
@@ -0,0 +1,173 @@
+"""跨运行的节点结果缓存
+
+meta中声明了"cache": True的节点，按(节点类型, meta中的"version", 输入的hash)缓存一次执行的
+事件和输出，之后任何一次运行遇到相同的输入时直接重放，不再调用节点。
+修改了节点的实现、结果不再兼容时，增加meta中的"version"即可让旧的缓存失效。
+
+缓存的后端只需要实现get(key) -> bytes | None和set(key, bytes)：
+- MemoryResultCache: 进程内的LRU缓存
+- SQLiteResultCache: 保存在本地SQLite文件中，多个进程可以共用
+两者都支持最大条目数和TTL。
+"""
+
+from collections import OrderedDict
+import dataclasses
+import hashlib
+import sqlite3
+import struct
+import threading
+import time
+from persistent import PersistentDict, PersistentList
+
+
+class UnhashableInput(Exception):
+    """输入中有无法计算稳定hash的值，这次执行不使用缓存"""
+
+
+def stable_hash(value: any) -> str:
+    """与进程、字典顺序无关的hash，支持JSON类型、tuple、bytes、dataclass和persistent中的集合"""
+    hasher = hashlib.sha256()
+    _update_hash(hasher, value)
+    return hasher.hexdigest()
+
+
+def _update_hash(hasher, value: any):
+    if value is None:
+        hasher.update(b"N")
+    elif value is True or value is False:
+        hasher.update(b"T" if value else b"F")
+    elif type(value) is int:
+        data = str(value).encode()
+        hasher.update(b"i" + struct.pack("<Q", len(data)) + data)
+    elif type(value) is float:
+        hasher.update(b"f" + struct.pack("<d", value))
+    elif type(value) is str:
+        data = value.encode()
+        hasher.update(b"s" + struct.pack("<Q", len(data)) + data)
+    elif type(value) is bytes:
+        hasher.update(b"b" + struct.pack("<Q", len(value)) + value)
+    elif type(value) in (list, tuple, PersistentList):
+        hasher.update(b"l" + struct.pack("<Q", len(value)))
+        for item in value:
+            _update_hash(hasher, item)
+    elif type(value) in (dict, PersistentDict):
+        items = sorted(
+            ((stable_hash(key), item) for key, item in value.items()),
+            key=lambda item: item[0],
+        )
+        hasher.update(b"d" + struct.pack("<Q", len(items)))
+        for key_hash, item in items:
+            hasher.update(key_hash.encode())
+            _update_hash(hasher, item)
+    elif dataclasses.is_dataclass(value) and not isinstance(value, type):
+        _update_hash(hasher, type(value).__qualname__)
+        for field in dataclasses.fields(value):
+            _update_hash(hasher, getattr(value, field.name))
+    else:
+        raise UnhashableInput(f"cannot hash value of type {type(value).__name__}")
+
+
+def cache_key(node_type: str, version: any, inputs: dict[str, any]) -> str:
+    """输入无法hash时抛出UnhashableInput"""
+    return stable_hash([node_type, str(version), inputs])
+
+
+class MemoryResultCache:
+    """进程内的LRU缓存
+
+    max_entries: 最多保存的条目数，超过时淘汰最久没有使用的条目
+    ttl: 条目的有效时间（秒），None表示不过期
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float | None = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> bytes | None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None:
+                if time.time() - entry[0] > self.ttl:
+                    del self.entries[key]
+                    entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: str, value: bytes):
+        with self.lock:
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class SQLiteResultCache:
+    """保存在SQLite文件中的缓存，淘汰策略同MemoryResultCache"""
+
+    def __init__(self, path: str, max_entries: int = 100000, ttl: float | None = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+            "created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)"
+        )
+        self.connection.commit()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> bytes | None:
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value, created FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                self.connection.execute("DELETE FROM results WHERE key = ?", (key,))
+                self.connection.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.connection.execute(
+                "UPDATE results SET accessed = ? WHERE key = ?", (now, key)
+            )
+            self.connection.commit()
+            self.hits += 1
+            return row[0]
+
+    def set(self, key: str, value: bytes):
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO results (key, value, created, accessed) "
+                "VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            if self.ttl is not None:
+                self.connection.execute(
+                    "DELETE FROM results WHERE created < ?", (now - self.ttl,)
+                )
+            self.connection.execute(
+                "DELETE FROM results WHERE key IN ("
+                "SELECT key FROM results ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,132 @@
+"""图执行的准入控制
+
+每个请求都立即执行图时，突发的请求会同时占用事件循环和线程池，所有运行都变慢。
+RunPool限制同时执行的图的数量，超出的请求按到达顺序排队：
+- 队列已满时reserve抛出RunRejected(429)，请求在到达时就被拒绝
+- 排队超过max_queue_wait秒时acquire抛出RunRejected(503)
+两者都带有retry_after，根据最近运行的平均耗时和排在前面的运行数估计。
+
+所有方法都必须在事件循环所在的线程中调用。
+"""
+
+import asyncio
+from collections import deque
+import math
+import time
+
+
+class RunRejected(Exception):
+    def __init__(self, status_code: int, retry_after: int, reason: str):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class RunTicket:
+    """reserve得到的排队凭证，acquire之后必须release"""
+
+    def __init__(self, pool: "RunPool"):
+        self.pool = pool
+        self.reserved_at = time.monotonic()
+        self.started_at: float | None = None
+        self.released = False
+
+    @property
+    def queue_wait(self) -> float:
+        """排队等待的秒数"""
+        end = self.started_at if self.started_at is not None else time.monotonic()
+        return end - self.reserved_at
+
+    async def acquire(self) -> float:
+        """等待可以开始执行，返回排队等待的秒数"""
+        pool = self.pool
+        if pool.running < pool.max_running and not pool.waiters:
+            pool.running += 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            pool.waiters.append(waiter)
+            timeout = pool.max_queue_wait - self.queue_wait
+            try:
+                await asyncio.wait_for(waiter, max(timeout, 0))
+            except BaseException as e:
+                pool.queued -= 1
+                self.released = True
+                if waiter.done() and not waiter.cancelled():
+                    # 名额已经交给了这个请求，转交给下一个
+                    pool.pass_slot()
+                if isinstance(e, asyncio.TimeoutError):
+                    raise RunRejected(
+                        503, pool.retry_after(), "timed out waiting for a free run slot"
+                    ) from None
+                raise
+            finally:
+                if waiter in pool.waiters:
+                    pool.waiters.remove(waiter)
+        pool.queued -= 1
+        self.started_at = time.monotonic()
+        return self.queue_wait
+
+    def release(self):
+        """执行结束，或者reserve之后不再执行时调用，重复调用时忽略"""
+        if self.released:
+            return
+        self.released = True
+        pool = self.pool
+        if self.started_at is None:
+            pool.queued -= 1
+            return
+        pool.record_duration(time.monotonic() - self.started_at)
+        pool.pass_slot()
+
+
+class RunPool:
+    def __init__(
+        self,
+        max_running: int = 4,
+        max_queued: int = 16,
+        max_queue_wait: float = 30.0,
+    ):
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.max_queue_wait = max_queue_wait
+        self.running = 0
+        # 已经reserve但还没有开始执行的请求数
+        self.queued = 0
+        self.waiters: deque[asyncio.Future] = deque()
+        # 最近运行耗时的指数移动平均，用于估计retry_after
+        self.average_duration = 1.0
+
+    def reserve(self) -> RunTicket:
+        """占用一个排队位置，队列已满时抛出RunRejected(429)"""
+        free = self.max_running - self.running
+        if self.queued >= free + self.max_queued:
+            raise RunRejected(429, self.retry_after(), "too many queued graph runs")
+        self.queued += 1
+        return RunTicket(self)
+
+    def pass_slot(self):
+        """一个运行结束，名额直接交给下一个排队的请求，没有排队的请求时释放"""
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.running -= 1
+
+    def record_duration(self, duration: float):
+        self.average_duration = 0.8 * self.average_duration + 0.2 * duration
+
+    def retry_after(self) -> int:
+        """估计排在前面的运行都开始执行需要的秒数"""
+        ahead = self.queued + 1
+        return max(
+            1, math.ceil(self.average_duration * ahead / max(self.max_running, 1))
+        )
+
+    def stats(self) -> dict[str, any]:
+        return {
+            "running": self.running,
+            "queued": self.queued,
+            "max_running": self.max_running,
+            "max_queued": self.max_queued,
+        }
@@ -0,0 +1,465 @@
+"""图运行的注册表、结束后的结果存储，以及在一个WebSocket连接上复用多个运行的协议
+
+RunRegistry在事件循环中启动运行，运行不属于任何连接，连接断开后继续执行到结束。
+每个订阅者有自己的ProgressPipeline，一个订阅者读取得慢不会影响其它订阅者。
+运行记录所有的事件（最多max_events个，超过时丢弃最旧的，事件的序号不变）和每个节点
+显示的输出，可以用序号从任意位置重放或者继续读取。运行结束后记录被放入结果存储：
+- MemoryRunStore: 进程内，最多保存max_runs个，超过时淘汰最早结束的
+- SQLiteRunStore: 保存在本地SQLite文件中，淘汰策略相同
+
+RunConnection实现WebSocket上的协议，消息都是JSON对象，客户端发送的消息用op区分：
+- {"op": "start", "graph": {...}, "ref": any, "verbosity": "full", "profile": false,
+  "credits": 16}: 启动运行并订阅，回复{"op": "started", "ref": ..., "run": id}
+- {"op": "subscribe", "run": id, "verbosity": ..., "credits": ...}: 订阅其它连接启动的运行，
+  回复{"op": "subscribed", "run": id}
+- {"op": "unsubscribe", "run": id}: 取消订阅，运行继续执行
+- {"op": "cancel", "run": id}: 取消运行
+- {"op": "credit", "run": id, "n": k}: 允许再发送k帧这个运行的事件
+服务端发送的帧：
+- {"run": id, "e": [event, ...]}: 一批事件，每帧消耗一个credit，credit用完时事件留在
+  订阅者的管道中合并，直到客户端发送credit
+- {"run": id, "done": status, "error": ...}: 运行结束，status为succeeded/failed/cancelled
+- {"op": "error", "ref": ..., "status": ..., "detail": ...}: 请求失败，运行太多时status为429，
+  并带有retry_after
+"""
+
+import asyncio
+from collections import OrderedDict, deque
+import itertools
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from graph import parse_graph_data
+from persistent import json_default
+from progress import (
+    FULL,
+    VERBOSITY_LEVELS,
+    ProgressPipeline,
+    merge_output,
+    plain_event,
+)
+from run_pool import RunPool, RunRejected
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class Run:
+    def __init__(self, id: str, max_events: int = 10000):
+        self.id = id
+        self.status = QUEUED
+        self.error: Exception | None = None
+        self.task: asyncio.Task | None = None
+        self.subscribers: set[ProgressPipeline] = set()
+        self.created = time.time()
+        self.finished_at: float | None = None
+        self.max_events = max_events
+        self.events: deque[dict] = deque()
+        # 第一个保留的事件的序号
+        self.first_event = 0
+        # 节点id -> display和append事件合并后的输出
+        self.outputs: dict[str, dict] = {}
+        self.changed = asyncio.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (SUCCEEDED, FAILED, CANCELLED)
+
+    @property
+    def event_count(self) -> int:
+        return self.first_event + len(self.events)
+
+    def publish(self, event: dict):
+        """作为执行器的progress_callback，记录事件并交给所有订阅者"""
+        event = plain_event(event)
+        self.events.append(event)
+        if len(self.events) > self.max_events:
+            self.events.popleft()
+            self.first_event += 1
+        node_id = event.get("node_id")
+        if node_id is not None:
+            merge_output(self.outputs, node_id, event)
+        for pipeline in list(self.subscribers):
+            pipeline.put(event)
+        self.notify()
+
+    def notify(self):
+        """唤醒所有等待新事件的读取者"""
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def events_since(self, since: int) -> tuple[int, list[dict]]:
+        """序号不小于since的事件和第一个事件的序号，较早的事件已经被丢弃时从first_event开始"""
+        start = max(since, self.first_event)
+        return start, list(
+            itertools.islice(self.events, start - self.first_event, None)
+        )
+
+    def snapshot(self) -> dict[str, any]:
+        return {
+            "run_id": self.id,
+            "status": self.status,
+            "error": None if self.error is None else repr(self.error),
+            "created": self.created,
+            "finished": self.finished_at,
+            "outputs": self.outputs,
+            "first_event": self.first_event,
+            "event_count": self.event_count,
+        }
+
+    def record(self) -> dict[str, any]:
+        """放入结果存储的记录"""
+        return {**self.snapshot(), "events": list(self.events)}
+
+
+class MemoryRunStore:
+    """进程内的结果存储，最多保存max_runs个运行，超过时淘汰最早结束的"""
+
+    def __init__(self, max_runs: int = 1000):
+        self.max_runs = max_runs
+        self.records: OrderedDict[str, dict] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def put(self, record: dict):
+        with self.lock:
+            self.records[record["run_id"]] = record
+            while len(self.records) > self.max_runs:
+                self.records.popitem(last=False)
+
+    def get(self, run_id: str) -> dict | None:
+        with self.lock:
+            return self.records.get(run_id)
+
+
+class SQLiteRunStore:
+    """保存在SQLite文件中的结果存储，淘汰策略同MemoryRunStore"""
+
+    def __init__(self, path: str, max_runs: int = 100000):
+        self.max_runs = max_runs
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS runs ("
+            "id TEXT PRIMARY KEY, record TEXT NOT NULL, finished REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS runs_finished ON runs (finished)"
+        )
+        self.connection.commit()
+        self.lock = threading.Lock()
+
+    def put(self, record: dict):
+        data = json.dumps(record, default=json_default)
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO runs (id, record, finished) VALUES (?, ?, ?)",
+                (record["run_id"], data, record["finished"] or time.time()),
+            )
+            self.connection.execute(
+                "DELETE FROM runs WHERE id IN ("
+                "SELECT id FROM runs ORDER BY finished DESC LIMIT -1 OFFSET ?)",
+                (self.max_runs,),
+            )
+            self.connection.commit()
+
+    def get(self, run_id: str) -> dict | None:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT record FROM runs WHERE id = ?", (run_id,)
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class RunRegistry:
+    """所有方法都必须在事件循环所在的线程中调用"""
+
+    def __init__(self, app, run_pool: RunPool, store=None, max_events: int = 10000):
+        self.app = app
+        self.run_pool = run_pool
+        # 结束的运行，需要实现put(record)和get(run_id)
+        self.store = store if store is not None else MemoryRunStore()
+        self.max_events = max_events
+        # 正在排队或者执行的运行
+        self.runs: dict[str, Run] = {}
+
+    def start(self, graph, profile: bool = False) -> Run:
+        """启动运行，运行太多时抛出RunRejected"""
+        ticket = self.run_pool.reserve()
+        run = Run(uuid.uuid4().hex, self.max_events)
+        self.runs[run.id] = run
+        run.task = asyncio.create_task(self._execute(run, graph, profile, ticket))
+        # 任务开始执行前被取消时_execute不会运行，清理放在完成回调中
+        run.task.add_done_callback(lambda task: self._finish(run, ticket, task))
+        return run
+
+    async def _execute(self, run: Run, graph, profile: bool, ticket):
+        queue_wait = await ticket.acquire()
+        run.status = RUNNING
+        run.publish({"event": "run_admitted", "queue_wait": queue_wait})
+        await self.app.execute_graph_async(graph, run.publish, profile=profile)
+
+    def _finish(self, run: Run, ticket, task: asyncio.Task):
+        ticket.release()
+        if task.cancelled():
+            run.status = CANCELLED
+        elif task.exception() is not None:
+            run.status = FAILED
+            run.error = task.exception()
+        else:
+            run.status = SUCCEEDED
+        run.finished_at = time.time()
+        self.store.put(run.record())
+        del self.runs[run.id]
+        for pipeline in list(run.subscribers):
+            pipeline.close(run.error)
+        run.notify()
+
+    def get(self, run_id: str) -> Run | None:
+        return self.runs.get(run_id)
+
+    def status(self, run_id: str) -> dict | None:
+        """运行的状态和输出，运行不存在或者已经被淘汰时返回None"""
+        run = self.runs.get(run_id)
+        if run is not None:
+            return run.snapshot()
+        record = self.store.get(run_id)
+        if record is None:
+            return None
+        return {key: value for key, value in record.items() if key != "events"}
+
+    def events(self, run_id: str, since: int = 0) -> dict | None:
+        """序号从since开始的事件，next为下一次读取时使用的since"""
+        run = self.runs.get(run_id)
+        if run is not None:
+            status = run.status
+            start, events = run.events_since(since)
+        else:
+            record = self.store.get(run_id)
+            if record is None:
+                return None
+            status = record["status"]
+            start = max(since, record["first_event"])
+            events = record["events"][start - record["first_event"] :]
+        return {
+            "run_id": run_id,
+            "status": status,
+            "first": start,
+            "next": start + len(events),
+            "events": events,
+        }
+
+    async def follow(self, run_id: str, since: int = 0):
+        """产生(第一个事件的序号, 事件列表)，直到运行结束，运行不存在时什么也不产生"""
+        run = self.runs.get(run_id)
+        if run is None:
+            result = self.events(run_id, since)
+            if result is not None and result["events"]:
+                yield result["first"], result["events"]
+            return
+        while True:
+            changed = run.changed
+            finished = run.finished
+            start, events = run.events_since(since)
+            if events:
+                yield start, events
+                since = start + len(events)
+            elif finished:
+                return
+            else:
+                await changed.wait()
+
+    def cancel(self, run_id: str) -> bool:
+        """运行已经结束或者不存在时返回False"""
+        run = self.runs.get(run_id)
+        if run is None:
+            return False
+        run.task.cancel()
+        return True
+
+    def subscribe(self, run: Run, verbosity: str = FULL) -> ProgressPipeline:
+        pipeline = ProgressPipeline(verbosity)
+        run.subscribers.add(pipeline)
+        return pipeline
+
+    def unsubscribe(self, run: Run, pipeline: ProgressPipeline):
+        run.subscribers.discard(pipeline)
+
+
+class RequestError(Exception):
+    def __init__(self, detail: str, status: int = 400, retry_after: int | None = None):
+        super().__init__(detail)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def _run_id(message: dict) -> str:
+    run_id = message.get("run")
+    if not isinstance(run_id, str):
+        raise RequestError("run must be a string")
+    return run_id
+
+
+def _integer(message: dict, key: str, default: int) -> int:
+    value = message.get(key, default)
+    if type(value) is not int:
+        raise RequestError(f"{key} must be an integer")
+    if value <= 0:
+        raise RequestError(f"{key} must be positive")
+    return value
+
+
+async def _first_of(*awaitables):
+    """等待到其中一个完成，取消其它的"""
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+class _Subscription:
+    def __init__(self, pipeline: ProgressPipeline, credits: int):
+        self.pipeline = pipeline
+        self.credits = credits
+        self.granted = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+
+class RunConnection:
+    """一个WebSocket连接，send_text发送一帧文本"""
+
+    def __init__(self, registry: RunRegistry, send_text, initial_credits: int = 16):
+        self.registry = registry
+        self.send_text = send_text
+        self.initial_credits = initial_credits
+        self.subscriptions: dict[str, _Subscription] = {}
+        # 多个运行的帧在同一个连接上发送，同一时间只能有一个发送
+        self.send_lock = asyncio.Lock()
+
+    async def send(self, frame: dict):
+        text = json.dumps(frame, separators=(",", ":"), default=json_default)
+        async with self.send_lock:
+            await self.send_text(text)
+
+    async def handle(self, message: any):
+        """处理客户端的一条消息，请求错误时回复error帧"""
+        ref = message.get("ref") if isinstance(message, dict) else None
+        try:
+            if not isinstance(message, dict):
+                raise RequestError("message must be a JSON object")
+            match message.get("op"):
+                case "start":
+                    await self._start(message, ref)
+                case "subscribe":
+                    options = self._subscription_options(message)
+                    run = self._get_run(message)
+                    self._subscribe(run, *options)
+                    await self.send({"op": "subscribed", "run": run.id})
+                case "unsubscribe":
+                    subscription = self.subscriptions.get(_run_id(message))
+                    if subscription is not None:
+                        subscription.task.cancel()
+                case "cancel":
+                    if not self.registry.cancel(_run_id(message)):
+                        raise RequestError("unknown run", 404)
+                case "credit":
+                    n = _integer(message, "n", 1)
+                    subscription = self.subscriptions.get(_run_id(message))
+                    if subscription is not None:
+                        subscription.credits += n
+                        subscription.granted.set()
+                case op:
+                    raise RequestError(f"unknown op {op}")
+        except RequestError as e:
+            frame = {"op": "error", "ref": ref, "status": e.status, "detail": str(e)}
+            if e.retry_after is not None:
+                frame["retry_after"] = e.retry_after
+            await self.send(frame)
+
+    async def _start(self, message: dict, ref: any):
+        options = self._subscription_options(message)
+        try:
+            graph = parse_graph_data(json.dumps(message.get("graph")))
+        except Exception as e:
+            raise RequestError(str(e))
+        try:
+            run = self.registry.start(
+                graph, profile=bool(message.get("profile", False))
+            )
+        except RunRejected as e:
+            raise RequestError(str(e), e.status_code, e.retry_after)
+        self._subscribe(run, *options)
+        await self.send({"op": "started", "ref": ref, "run": run.id})
+
+    def _get_run(self, message: dict) -> Run:
+        run = self.registry.get(_run_id(message))
+        if run is None:
+            raise RequestError("unknown run", 404)
+        return run
+
+    def _subscription_options(self, message: dict) -> tuple[str, int]:
+        verbosity = message.get("verbosity", FULL)
+        if verbosity not in VERBOSITY_LEVELS:
+            raise RequestError(f"unknown verbosity {verbosity}")
+        return verbosity, _integer(message, "credits", self.initial_credits)
+
+    def _subscribe(self, run: Run, verbosity: str, credits: int):
+        if run.id in self.subscriptions:
+            raise RequestError("already subscribed")
+        subscription = _Subscription(self.registry.subscribe(run, verbosity), credits)
+        self.subscriptions[run.id] = subscription
+        subscription.task = asyncio.create_task(self._forward(run, subscription))
+
+    async def _forward(self, run: Run, subscription: _Subscription):
+        """把订阅者管道中的事件按credit发送给客户端"""
+        pipeline = subscription.pipeline
+        batches = pipeline.batches()
+        try:
+            while True:
+                # 先等待credit再取出一批，等待期间的事件在管道中合并。
+                # 管道结束并且没有剩余事件时，done帧不需要credit
+                while subscription.credits <= 0 and not pipeline.exhausted():
+                    subscription.granted.clear()
+                    if pipeline.closed:
+                        await subscription.granted.wait()
+                    else:
+                        await _first_of(
+                            subscription.granted.wait(), pipeline.finished.wait()
+                        )
+                if subscription.credits <= 0:
+                    done = {"run": run.id, "done": run.status}
+                    if pipeline.error is not None:
+                        done["error"] = repr(pipeline.error)
+                    break
+                try:
+                    events = await anext(batches)
+                except StopAsyncIteration:
+                    done = {"run": run.id, "done": run.status}
+                    break
+                except Exception as e:
+                    done = {"run": run.id, "done": run.status, "error": repr(e)}
+                    break
+                subscription.credits -= 1
+                await self.send({"run": run.id, "e": events})
+        finally:
+            self.registry.unsubscribe(run, subscription.pipeline)
+            del self.subscriptions[run.id]
+        try:
+            await self.send(done)
+        except Exception:
+            # 连接已经断开，没有接收done帧的客户端
+            pass
+
+    def close(self):
+        """连接断开时取消所有订阅，运行继续执行"""
+        for subscription in list(self.subscriptions.values()):
+            subscription.task.cancel()
@@ -0,0 +1,151 @@
+"""流式引脚的值
+
+节点的输出只有写入输出缓存后才能被读取，下游节点只能等待最终的值，
+或者通过每一段触发一次的路由（例如LLM节点的on_content_part）处理，每一段都需要经过一次执行器。
+Stream把一个同步或异步迭代器包装成可以在引脚上传递的值：
+- 惰性：只有下游读取时才从源迭代器取下一段
+- 记忆：取出的段保存下来，每个读取者都从头读到所有的段，可以被多个下游节点读取
+- 线程安全：异步源总是在创建Stream时所在的事件循环中迭代，其它线程中的同步读取
+  通过run_coroutine_threadsafe交给那个事件循环；同步源由锁保护
+
+meta中输出引脚声明"stream": True表示这个引脚的值可能是Stream，
+输入引脚声明"stream": True表示节点可以增量读取Stream。
+连接到其它输入引脚的Stream由执行器在收集输入时合并成完整的值（materialize）。
+"""
+
+import asyncio
+import threading
+
+
+def _completed_stream(chunks: list, join) -> "Stream":
+    stream = Stream(iter(()), join=join)
+    stream._chunks = chunks
+    stream._done = True
+    return stream
+
+
+class Stream:
+    def __init__(self, source, join=None):
+        """source为同步或异步的可迭代对象，join把所有的段合并成完整的值，默认为"".join
+
+        异步源需要在事件循环中创建，之后一直在这个事件循环中迭代
+        """
+        self._is_async = hasattr(source, "__aiter__")
+        if self._is_async:
+            self._source = source.__aiter__()
+            self._loop = asyncio.get_running_loop()
+        else:
+            self._source = iter(source)
+            self._loop = None
+        self._join = join
+        self._chunks = []
+        self._done = False
+        self._error: Exception | None = None
+        self._lock = threading.Lock()
+        # 异步源在事件循环中迭代，第一次使用时创建
+        self._async_lock: asyncio.Lock | None = None
+
+    @classmethod
+    def completed(cls, chunks, join=None) -> "Stream":
+        """已经结束的流，读取时依次产生chunks"""
+        return _completed_stream(list(chunks), join)
+
+    @property
+    def done(self) -> bool:
+        return self._done
+
+    def _available(self, index: int) -> bool:
+        """第index段是否存在，源迭代出错时抛出错误"""
+        if index < len(self._chunks):
+            return True
+        if self._error is not None:
+            raise self._error
+        return False
+
+    def _fetch(self, index: int) -> bool:
+        """确保第index段已经取出，流在这之前结束时返回False"""
+        if index < len(self._chunks) or self._done:
+            return self._available(index)
+        if self._is_async:
+            if _running_loop() is self._loop:
+                raise RuntimeError(
+                    "stream with an async source must be read with async for in its event loop"
+                )
+            return asyncio.run_coroutine_threadsafe(
+                self._fetch_async(index), self._loop
+            ).result()
+        with self._lock:
+            while len(self._chunks) <= index and not self._done:
+                try:
+                    self._chunks.append(next(self._source))
+                except StopIteration:
+                    self._done = True
+                except Exception as e:
+                    self._error = e
+                    self._done = True
+        return self._available(index)
+
+    async def _fetch_async(self, index: int) -> bool:
+        if index < len(self._chunks) or self._done:
+            return self._available(index)
+        if not self._is_async:
+            return self._fetch(index)
+        if asyncio.get_running_loop() is not self._loop:
+            return await asyncio.wrap_future(
+                asyncio.run_coroutine_threadsafe(self._fetch_async(index), self._loop)
+            )
+        if self._async_lock is None:
+            self._async_lock = asyncio.Lock()
+        async with self._async_lock:
+            while len(self._chunks) <= index and not self._done:
+                try:
+                    self._chunks.append(await self._source.__anext__())
+                except StopAsyncIteration:
+                    self._done = True
+                except Exception as e:
+                    self._error = e
+                    self._done = True
+        return self._available(index)
+
+    def __iter__(self):
+        index = 0
+        while self._fetch(index):
+            yield self._chunks[index]
+            index += 1
+
+    async def __aiter__(self):
+        index = 0
+        while await self._fetch_async(index):
+            yield self._chunks[index]
+            index += 1
+
+    def _joined(self):
+        join = self._join if self._join is not None else "".join
+        return join(self._chunks)
+
+    def materialize(self):
+        """读取所有的段，返回合并后的值"""
+        for _ in self:
+            pass
+        return self._joined()
+
+    async def materialize_async(self):
+        async for _ in self:
+            pass
+        return self._joined()
+
+    def __repr__(self) -> str:
+        state = "done" if self._done else "open"
+        return f"Stream({len(self._chunks)} chunks, {state})"
+
+    def __reduce__(self):
+        """序列化时先读完，反序列化得到已经结束的流"""
+        self.materialize()
+        return (_completed_stream, (list(self._chunks), self._join))
+
+
+def _running_loop() -> asyncio.AbstractEventLoop | None:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
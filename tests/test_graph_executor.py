@@ -0,0 +1,1868 @@
+import unittest
+import asyncio
+from concurrent.futures.process import BrokenProcessPool
+import json
+import os
+import pickle
+import sys
+import tempfile
+import threading
+import time
+import plugins.basic
+from app import app
+import graph_compiler
+from persistent import PersistentDict, PersistentList, json_default
+from progress import EventBridge, ProgressPipeline, plain_event
+from liveness import estimate_size
+from checkpoint import Checkpoint, FileCheckpointStore, MemoryCheckpointStore
+from result_cache import MemoryResultCache, SQLiteResultCache
+from run_pool import RunPool, RunRejected
+from runs import MemoryRunStore, RunConnection, RunRegistry, SQLiteRunStore
+from graph import (
+    CompiledGraph,
+    DependencyCycleError,
+    GraphExecutor,
+    _pickle_for_process,
+    parse_graph_data,
+)
+from vectorize import np
+from node_basic import AsyncBaseDataNode, BaseDataNode, NodeOutput
+from stream import Stream
+
+
+@app.node_def("Test.SleepNode")
+class SleepNode(BaseDataNode):
+    @classmethod
+    def meta(cls) -> dict[str, any]:
+        return {
+            "title": "Sleep",
+            "category": "Test",
+            "execution": "DATA",
+            "inputs": [{"name": "value", "type": "int"}],
+            "outputs": [{"name": "value", "type": "int"}],
+        }
+
+    def get_data(self, controller, value: int) -> dict[str, any]:
+        time.sleep(0.2)
+        controller.send_event("display", {"value": str(value)})
+        return {"value": value}
+
+
+@app.node_def("Test.AsyncSleepNode")
+class AsyncSleepNode(AsyncBaseDataNode):
+    @classmethod
+    def meta(cls) -> dict[str, any]:
+        return {
+            "title": "Async Sleep",
+            "category": "Test",
+            "execution": "DATA",
+            "inputs": [{"name": "value", "type": "int"}],
+            "outputs": [{"name": "value", "type": "int"}],
+        }
+
+    async def get_data(self, controller, value: int) -> dict[str, any]:
+        await asyncio.sleep(0.2)
+        return {"value": value}
+
+
+@app.node_def("Test.ProcessIdNode")
+class ProcessIdNode(BaseDataNode):
+    @classmethod
+    def meta(cls) -> dict[str, any]:
+        return {
+            "title": "Process Id",
+            "category": "Test",
+            "execution": "DATA",
+            "cpu_bound": True,
+            "inputs": [{"name": "value", "type": "int"}],
+            "outputs": [
+                {"name": "pid", "type": "int"},
+                {"name": "value", "type": "int"},
+            ],
+        }
+
+    def get_data(self, controller, value: int) -> dict[str, any]:
+        controller.send_event("display", {"value": str(value)})
+        return {"pid": os.getpid(), "value": sum(range(value))}
+
+
+class CountedPickle:
+    """记录被序列化的次数，反序列化得到1"""
+
+    reduced = 0
+
+    def __reduce__(self):
+        CountedPickle.reduced += 1
+        return int, (1,)
+
+
+@app.node_def("Test.ExitProcessNode")
+class ExitProcessNode(BaseDataNode):
+    """在进程池中执行时杀死所在的子进程"""
+
+    @classmethod
+    def meta(cls) -> dict[str, any]:
+        return {
+            "title": "Exit Process",
+            "category": "Test",
+            "execution": "DATA",
+            "cpu_bound": True,
+            "inputs": [{"name": "value", "type": "int"}],
+            "outputs": [{"name": "value", "type": "int"}],
+        }
+
+    def get_data(self, controller, value: int) -> dict[str, any]:
+        os._exit(1)
+
+
+@app.node_def("Test.ExpensiveNode")
+class ExpensiveNode(BaseDataNode):
+    calls = 0
+
+    @classmethod
+    def meta(cls) -> dict[str, any]:
+        return {
+            "title": "Expensive",
+            "category": "Test",
+            "execution": "DATA",
+            "checkpoint": True,
+            "cache": True,
+            "inputs": [{"name": "value", "type": "int"}],
+            "outputs": [{"name": "value", "type": "int"}],
+        }
+
+    def get_data(self, controller, value: int) -> dict[str, any]:
+        ExpensiveNode.calls += 1
+        controller.send_event("append", {"value": str(value)})
+        return {"value": value * 10}
+
+
+@app.node_def("Test.FailOnceNode")
+class FailOnceNode(BaseDataNode):
+    failed = False
+
+    @classmethod
+    def meta(cls) -> dict[str, any]:
+        return {
+            "title": "Fail Once",
+            "category": "Test",
+            "inputs": [],
+            "outputs": [],
+        }
+
+    def get_data(self, controller) -> dict[str, any]:
+        if not FailOnceNode.failed:
+            FailOnceNode.failed = True
+            raise TimeoutError("timeout")
+        return {}
+
+
+@app.node_def("Test.StreamNode")
+class StreamNode:
+    """逐段输出parts中的字符，每取出一段发送一个produce事件"""
+
+    @classmethod
+    def meta(cls) -> dict[str, any]:
+        return {
+            "title": "Stream",
+            "category": "Test",
+            "inputs": [{"name": "parts", "type": "str"}],
+            "outputs": [
+                {"name": "content", "type": "str", "stream": True},
+                {"name": "on_stream", "type": "route"},
+            ],
+        }
+
+    def execute(self, controller, parts: str):
+        def source():
+            for part in parts:
+                controller.send_event("produce", {"value": part})
+                yield part
+
+        content = Stream(source())
+        yield NodeOutput(execution_pin="on_stream", data={"content": content})
+        yield NodeOutput(execution_pin=None, data={"content": content})
+
+
+@app.node_def("Test.AsyncStreamNode")
+class AsyncStreamNode(StreamNode):
+    async def execute(self, controller, parts: str):
+        async def source():
+            for part in parts:
+                await asyncio.sleep(0)
+                controller.send_event("produce", {"value": part})
+                yield part
+
+        content = Stream(source())
+        yield NodeOutput(execution_pin="on_stream", data={"content": content})
+        yield NodeOutput(execution_pin=None, data={"content": content})
+
+
+def graph_json(nodes, edges, route_edges):
+    """用简化的元组描述构造图的JSON对象
+
+    nodes: [(id, node_type, execution_type, inputs)]
+    edges: [(source_id, source_pin, target_id, target_pin)]
+    route_edges: [(source_id, source_pin, target_id)]
+    """
+    return {
+        "nodes": [
+            {
+                "id": id,
+                "node_type": node_type,
+                "execution_type": execution_type,
+                "inputs": inputs,
+            }
+            for id, node_type, execution_type, inputs in nodes
+        ],
+        "edges": [
+            {
+                "source_id": source_id,
+                "source_pin": source_pin,
+                "target_id": target_id,
+                "target_pin": target_pin,
+            }
+            for source_id, source_pin, target_id, target_pin in edges
+        ],
+        "route_edges": [
+            {
+                "source_id": source_id,
+                "source_pin": source_pin,
+                "target_id": target_id,
+            }
+            for source_id, source_pin, target_id in route_edges
+        ],
+    }
+
+
+def build_graph(nodes, edges, route_edges):
+    """用简化的元组描述构造图，参数见graph_json"""
+    return parse_graph_data(json.dumps(graph_json(nodes, edges, route_edges)))
+
+
+def sum_loop_graph(end):
+    """sum = 0; for i in range(end): sum += i; display(sum)"""
+    return build_graph(
+        nodes=[
+            ("start", "StartNode", "TRIGGERED", {}),
+            ("loop", "ForLoopNode", "TRIGGERED", {"start": 0, "end": end, "step": 1}),
+            ("zero", "IntNode", "DATA_ONCE", {"value": 0}),
+            ("var", "DefineVariableNode", "DATA_ONCE", {}),
+            ("get", "GetVariableNode", "DATA", {}),
+            ("add", "AddIntNode", "DATA", {}),
+            ("set", "SetVariableNode", "TRIGGERED", {}),
+            ("display", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+        ],
+        edges=[
+            ("zero", "value", "var", "initial_value"),
+            ("var", "variable", "get", "variable"),
+            ("loop", "item", "add", "a"),
+            ("get", "value", "add", "b"),
+            ("var", "variable", "set", "variable"),
+            ("add", "result", "set", "value"),
+            ("get", "value", "display", "value"),
+        ],
+        route_edges=[
+            ("start", "_", "loop"),
+            ("loop", "body", "set"),
+            ("loop", "_", "display"),
+        ],
+    )
+
+
+def displayed_values(events):
+    return [
+        (event["node_id"], event["data"]["value"])
+        for event in events
+        if event["event"] in ("display", "append")
+    ]
+
+
+class TestGraphExecutor(unittest.TestCase):
+    def test_sum_loop(self):
+        events = []
+        app.execute_graph(sum_loop_graph(5), events.append)
+        self.assertEqual(displayed_values(events), [("display", "10")])
+        self.assertEqual(events[-1]["event"], "finish")
+
+    def test_execute_graph_batch(self):
+        graph = sum_loop_graph(5)
+        compiled = CompiledGraph(app.node_defs, graph)
+        row_compiled = compiled.with_inputs({"loop": {"end": 3}})
+        self.assertIs(compiled.with_inputs({}), compiled)
+        self.assertIs(row_compiled.data_inputs, compiled.data_inputs)
+        loop = compiled.node_index["loop"]
+        self.assertEqual(row_compiled.node_datas[loop].inputs["end"], 3)
+        self.assertEqual(compiled.node_datas[loop].inputs["end"], 5)
+        with self.assertRaises(ValueError):
+            compiled.with_inputs({"missing": {"value": 1}})
+
+        async def run_batch(rows):
+            events = []
+            results = [
+                result
+                async for result in app.execute_graph_batch(
+                    graph,
+                    rows,
+                    max_concurrency=2,
+                    progress_callback=lambda row, event: events.append(row),
+                )
+            ]
+            return results, events
+
+        rows = [{"loop": {"end": end}} for end in range(6)] + [{}]
+        results, events = asyncio.run(run_batch(rows))
+        self.assertEqual(sorted(result["row"] for result in results), list(range(7)))
+        by_row = {result["row"]: result for result in results}
+        for row, end in enumerate(list(range(6)) + [5]):
+            self.assertEqual(by_row[row]["status"], "succeeded")
+            self.assertEqual(
+                by_row[row]["outputs"]["display"]["value"], str(sum(range(end)))
+            )
+        self.assertEqual(set(events), set(range(7)))
+
+        failing = [{"loop": {"end": 2}}, {"loop": {"end": "x"}}]
+        results, _ = asyncio.run(run_batch(failing))
+        by_row = {result["row"]: result for result in results}
+        self.assertEqual(by_row[0]["status"], "succeeded")
+        self.assertEqual(by_row[1]["status"], "failed")
+        with self.assertRaises(ValueError):
+            asyncio.run(run_batch([{"missing": {}}]))
+
+        # 客户端读取得慢时，生产者等待管道有空间，所有行的结果都送达
+        async def slow_consumer(rows):
+            pipeline = ProgressPipeline(max_pending=2, flush_interval=0)
+
+            async def produce():
+                async for result in app.execute_graph_batch(
+                    graph, rows, max_concurrency=4
+                ):
+                    await pipeline.wait_for_space()
+                    pipeline.put({"event": "row_result", **result})
+                pipeline.put({"event": "batch_finish", "rows": len(rows)})
+                pipeline.close()
+
+            producer = asyncio.create_task(produce())
+            received = []
+            async for events in pipeline.batches():
+                received += events
+                await asyncio.sleep(0.01)
+            await producer
+            return received
+
+        rows = [{"loop": {"end": row % 5}} for row in range(30)]
+        received = asyncio.run(slow_consumer(rows))
+        self.assertNotIn("events_dropped", [event["event"] for event in received])
+        self.assertEqual(
+            sorted(
+                event["row"] for event in received if event["event"] == "row_result"
+            ),
+            list(range(30)),
+        )
+        self.assertEqual(received[-1], {"event": "batch_finish", "rows": 30})
+
+        # 没有等待时row_result也不会被丢弃
+        pipeline = ProgressPipeline(max_pending=2)
+        for row in range(5):
+            pipeline.put({"event": "display", "node_id": "a", "data": {}})
+            pipeline.put({"event": "row_result", "row": row})
+        self.assertEqual(
+            [
+                event["row"]
+                for event in pipeline.drain()
+                if event["event"] == "row_result"
+            ],
+            list(range(5)),
+        )
+
+    def test_execution_order_is_cached(self):
+        executor = GraphExecutor(app.node_defs, sum_loop_graph(100))
+        compute = executor._compute_execution_order
+        calls = []
+
+        def counting_compute(node, pins=None):
+            calls.append((executor.compiled.node_ids[node], pins))
+            return compute(node, pins)
+
+        executor._compute_execution_order = counting_compute
+        events = []
+        executor.execute(events.append)
+        self.assertEqual(displayed_values(events), [("display", "4950")])
+        # 第一次展开set时DATA_ONCE节点尚未缓存，之后只会重新计算一次
+        self.assertEqual(calls.count(("set", None)), 2)
+
+    def test_data_once_invalidation_keeps_other_orders(self):
+        executor = GraphExecutor(app.node_defs, sum_loop_graph(3))
+        executor.execute()
+        self.assertEqual(executor.execution_order_dependents, {})
+        node_index = executor.compiled.node_index
+        self.assertEqual(
+            executor._get_execution_order(node_index["set"]),
+            [node_index["get"], node_index["add"], node_index["set"]],
+        )
+
+    def test_deep_data_chain(self):
+        # 远超Python递归限制的数据链
+        length = 20000
+        nodes = [
+            ("start", "StartNode", "TRIGGERED", {}),
+            ("add0", "AddIntNode", "DATA", {"a": 0, "b": 1}),
+            ("display", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+        ]
+        edges = [(f"add{length - 1}", "result", "display", "value")]
+        for i in range(1, length):
+            nodes.append((f"add{i}", "AddIntNode", "DATA", {"b": 1}))
+            edges.append((f"add{i - 1}", "result", f"add{i}", "a"))
+        graph = build_graph(
+            nodes=nodes, edges=edges, route_edges=[("start", "_", "display")]
+        )
+        events = []
+        app.execute_graph(graph, events.append)
+        self.assertEqual(displayed_values(events), [("display", str(length))])
+
+    def test_dependency_cycle_reports_path(self):
+        graph = build_graph(
+            nodes=[
+                ("start", "StartNode", "TRIGGERED", {}),
+                ("a", "AddIntNode", "DATA", {"b": 1}),
+                ("b", "AddIntNode", "DATA", {"b": 1}),
+                ("c", "AddIntNode", "DATA", {"b": 1}),
+                ("display", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+            ],
+            edges=[
+                ("a", "result", "b", "a"),
+                ("b", "result", "c", "a"),
+                ("c", "result", "a", "a"),
+                ("c", "result", "display", "value"),
+            ],
+            route_edges=[("start", "_", "display")],
+        )
+        with self.assertRaises(DependencyCycleError) as context:
+            app.execute_graph(graph)
+        self.assertEqual(context.exception.cycle, ["c", "b", "a", "c"])
+
+    def test_node_spec(self):
+        _, _, spec = app.node_defs["ParallelForEachNode"]
+        self.assertEqual(spec.input_names, ("items", "max_concurrency", "result"))
+        self.assertEqual(spec.lazy_inputs, frozenset(["result"]))
+        self.assertEqual(spec.eager_inputs, ("items", "max_concurrency"))
+        self.assertTrue(app.node_defs["AddIntNode"][2].pure)
+
+    def test_route_fan_out(self):
+        graph = build_graph(
+            nodes=[
+                ("start", "StartNode", "TRIGGERED", {}),
+                ("if", "IfNode", "TRIGGERED", {"condition": True}),
+                (
+                    "a",
+                    "DisplayAsTextNode",
+                    "TRIGGERED",
+                    {"value": "a", "append": False},
+                ),
+                (
+                    "b",
+                    "DisplayAsTextNode",
+                    "TRIGGERED",
+                    {"value": "b", "append": False},
+                ),
+                (
+                    "c",
+                    "DisplayAsTextNode",
+                    "TRIGGERED",
+                    {"value": "c", "append": False},
+                ),
+                (
+                    "d",
+                    "DisplayAsTextNode",
+                    "TRIGGERED",
+                    {"value": "d", "append": False},
+                ),
+            ],
+            edges=[],
+            route_edges=[
+                ("start", "_", "if"),
+                ("if", "if", "a"),
+                ("if", "if", "b"),
+                ("a", "_", "c"),
+                ("if", "else", "d"),
+            ],
+        )
+        executor = GraphExecutor(app.node_defs, graph)
+        node_index = executor.compiled.node_index
+        self.assertEqual(
+            executor._get_route_targets(node_index["if"], "if"),
+            [node_index["a"], node_index["b"]],
+        )
+        events = []
+        executor.execute(events.append)
+        self.assertEqual(
+            [value for _, value in displayed_values(events)], ["a", "c", "b"]
+        )
+
+    def test_pure_data_nodes_are_memoized(self):
+        # x = (1 + 2) * 10 不依赖循环变量，只需计算一次；x + item 每次都要重新计算
+        graph = build_graph(
+            nodes=[
+                ("start", "StartNode", "TRIGGERED", {}),
+                ("loop", "ForLoopNode", "TRIGGERED", {"start": 0, "end": 3, "step": 1}),
+                ("add", "AddIntNode", "DATA", {"a": 1, "b": 2}),
+                ("mul", "MathOperationNode", "DATA", {"b": 10, "operator": "*"}),
+                ("sum", "AddIntNode", "DATA", {}),
+                ("display", "DisplayAsTextNode", "TRIGGERED", {"append": True}),
+            ],
+            edges=[
+                ("add", "result", "mul", "a"),
+                ("mul", "result", "sum", "a"),
+                ("loop", "item", "sum", "b"),
+                ("sum", "result", "display", "value"),
+            ],
+            route_edges=[("start", "_", "loop"), ("loop", "body", "display")],
+        )
+        events = []
+        app.execute_graph(graph, events.append)
+        self.assertEqual(
+            [value for _, value in displayed_values(events)], ["30", "31", "32"]
+        )
+        executed = [
+            event["node_id"] for event in events if event["event"] == "execute_node"
+        ]
+        self.assertEqual(executed.count("add"), 1)
+        self.assertEqual(executed.count("mul"), 1)
+        self.assertEqual(executed.count("sum"), 3)
+
+    def test_parallel_data_dependencies(self):
+        graph = build_graph(
+            nodes=[
+                ("start", "StartNode", "TRIGGERED", {}),
+                ("sleep1", "Test.SleepNode", "DATA", {"value": 1}),
+                ("sleep2", "Test.SleepNode", "DATA", {"value": 2}),
+                ("add", "AddIntNode", "DATA", {}),
+                ("display", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+            ],
+            edges=[
+                ("sleep1", "value", "add", "a"),
+                ("sleep2", "value", "add", "b"),
+                ("add", "result", "display", "value"),
+            ],
+            route_edges=[("start", "_", "display")],
+        )
+        sequential_events = []
+        app.execute_graph(graph, sequential_events.append)
+        parallel_events = []
+        start = time.perf_counter()
+        app.execute_graph(graph, parallel_events.append, max_workers=2)
+        elapsed = time.perf_counter() - start
+        self.assertLess(elapsed, 0.35)
+        self.assertEqual(parallel_events, sequential_events)
+        self.assertEqual(
+            displayed_values(parallel_events),
+            [("sleep1", "1"), ("sleep2", "2"), ("display", "3")],
+        )
+
+        # 读取还没有产生的输出时，报告的节点和发送的事件与串行执行相同
+        def run(graph, **options):
+            events = []
+            with self.assertRaises(Exception) as raised:
+                app.execute_graph(graph, events.append, **options)
+            return repr(raised.exception), events
+
+        for first, pin, inputs in (
+            ("Test.SleepNode", "value", {"value": 1}),
+            ("PythonEvalNode", "result", {"expression": "1 / input", "input": 0}),
+        ):
+            graph = build_graph(
+                nodes=[
+                    ("start", "StartNode", "TRIGGERED", {}),
+                    ("first", first, "DATA", inputs),
+                    ("never", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+                    ("bad", "AddIntNode", "DATA", {"b": 1}),
+                    ("add", "AddIntNode", "DATA", {}),
+                    ("display", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+                ],
+                edges=[
+                    ("first", pin, "add", "a"),
+                    ("never", "value", "bad", "a"),
+                    ("bad", "result", "add", "b"),
+                    ("add", "result", "display", "value"),
+                ],
+                route_edges=[("start", "_", "display")],
+            )
+            self.assertEqual(run(graph, max_workers=2), run(graph))
+
+    def async_graph(self, value):
+        return build_graph(
+            nodes=[
+                ("start", "StartNode", "TRIGGERED", {}),
+                ("sleep", "Test.AsyncSleepNode", "DATA", {"value": value}),
+                ("display", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+            ],
+            edges=[("sleep", "value", "display", "value")],
+            route_edges=[("start", "_", "display")],
+        )
+
+    def test_async_node_in_sync_executor(self):
+        events = []
+        app.execute_graph(self.async_graph(1), events.append)
+        self.assertEqual(displayed_values(events), [("display", "1")])
+
+    def test_async_executor_runs_concurrently(self):
+        async def run_all():
+            runs = [([], self.async_graph(value)) for value in range(20)]
+            await asyncio.gather(
+                *(
+                    app.execute_graph_async(graph, events.append)
+                    for events, graph in runs
+                )
+            )
+            return [events for events, _ in runs]
+
+        start = time.perf_counter()
+        all_events = asyncio.run(run_all())
+        self.assertLess(time.perf_counter() - start, 1.0)
+        for value, events in enumerate(all_events):
+            self.assertEqual(displayed_values(events), [("display", str(value))])
+            self.assertEqual(events[-1]["event"], "finish")
+
+    def test_async_executor_matches_sync_executor(self):
+        sync_events = []
+        app.execute_graph(sum_loop_graph(5), sync_events.append)
+        async_events = []
+        asyncio.run(app.execute_graph_async(sum_loop_graph(5), async_events.append))
+        self.assertEqual(async_events, sync_events)
+
+    def test_cpu_bound_node_runs_in_process_pool(self):
+        graph = build_graph(
+            nodes=[
+                ("start", "StartNode", "TRIGGERED", {}),
+                ("pid", "Test.ProcessIdNode", "DATA", {"value": 100}),
+                ("display", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+            ],
+            edges=[("pid", "value", "display", "value")],
+            route_edges=[("start", "_", "display")],
+        )
+        for use_process_pool in (True, False):
+            executor = GraphExecutor(
+                app.node_defs, graph, use_process_pool=use_process_pool
+            )
+            events = []
+            executor.execute(events.append)
+            self.assertEqual(
+                displayed_values(events), [("pid", "100"), ("display", "4950")]
+            )
+            pid = executor.node_instances[executor.compiled.node_index["pid"]]
+            self.assertEqual(pid.output_cache["pid"] != os.getpid(), use_process_pool)
+
+    def test_process_pool_inputs(self):
+        graph = build_graph(
+            nodes=[
+                ("start", "StartNode", "TRIGGERED", {}),
+                (
+                    "eval",
+                    "PythonEvalNode",
+                    "DATA",
+                    {"expression": "input + 1", "process_pool": True},
+                ),
+                ("display", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+            ],
+            edges=[("eval", "result", "display", "value")],
+            route_edges=[("start", "_", "display")],
+        )
+        graph.nodes[1].inputs["input"] = CountedPickle()
+        CountedPickle.reduced = 0
+        events = []
+        app.execute_graph(graph, events.append)
+        self.assertEqual(displayed_values(events), [("display", "2")])
+        # 提交给进程池的是已经序列化的字节，输入只序列化一次
+        self.assertEqual(CountedPickle.reduced, 1)
+
+        # 包含Stream时不发送到子进程，也不会因为序列化而读完它
+        stream = Stream(iter(["a", "b"]))
+        self.assertIsNone(_pickle_for_process({"input": [stream]}))
+        self.assertFalse(stream.done)
+
+    def test_cpu_bound_node_error(self):
+        graph = build_graph(
+            nodes=[
+                ("start", "StartNode", "TRIGGERED", {}),
+                ("eval", "PythonEvalNode", "DATA", {"expression": "1 / input"}),
+                ("display", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+            ],
+            edges=[("eval", "result", "display", "value")],
+            route_edges=[("start", "_", "display")],
+        )
+        graph.nodes[1].inputs["input"] = 0
+        for process_pool in (True, False):
+            graph.nodes[1].inputs["process_pool"] = process_pool
+            events = []
+            with self.assertRaises(ZeroDivisionError):
+                app.execute_graph(graph, events.append)
+            self.assertEqual(events[-1]["event"], "execute_node_error")
+            self.assertEqual(events[-1]["node_id"], "eval")
+
+    def test_script_nodes_mutate_inputs_in_process(self):
+        def script_graph(process_pool):
+            return build_graph(
+                nodes=[
+                    ("start", "StartNode", "TRIGGERED", {}),
+                    ("zero", "IntNode", "DATA_ONCE", {"value": 0}),
+                    ("var", "DefineVariableNode", "DATA_ONCE", {}),
+                    (
+                        "script",
+                        "ExecutePythonScriptNode",
+                        "TRIGGERED",
+                        {
+                            "script": "import os\ninput.value = 1\nresult = os.getpid()",
+                            "process_pool": process_pool,
+                        },
+                    ),
+                    ("get", "GetVariableNode", "DATA", {}),
+                    ("display", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+                ],
+                edges=[
+                    ("zero", "value", "var", "initial_value"),
+                    ("var", "variable", "script", "input"),
+                    ("var", "variable", "get", "variable"),
+                    ("get", "value", "display", "value"),
+                ],
+                route_edges=[("start", "_", "script"), ("script", "_", "display")],
+            )
+
+        # 默认以及输入包含Reference时都在当前进程中执行，修改可以被之后的节点看到
+        for process_pool in (False, True):
+            executor = GraphExecutor(app.node_defs, script_graph(process_pool))
+            events = []
+            executor.execute(events.append)
+            self.assertEqual(displayed_values(events), [("display", "1")])
+            script = executor.node_instances[executor.compiled.node_index["script"]]
+            self.assertEqual(script.output_cache["result"], os.getpid())
+
+        graph = build_graph(
+            nodes=[
+                ("start", "StartNode", "TRIGGERED", {}),
+                (
+                    "eval",
+                    "PythonEvalNode",
+                    "DATA",
+                    {"expression": "__import__('os').getpid()", "process_pool": True},
+                ),
+                ("display", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+            ],
+            edges=[("eval", "result", "display", "value")],
+            route_edges=[("start", "_", "display")],
+        )
+        events = []
+        app.execute_graph(graph, events.append)
+        self.assertNotEqual(displayed_values(events)[-1][1], str(os.getpid()))
+
+    def test_broken_process_pool_is_replaced(self):
+        def graph_of(node_type):
+            return build_graph(
+                nodes=[
+                    ("start", "StartNode", "TRIGGERED", {}),
+                    ("node", node_type, "DATA", {"value": 10}),
+                    ("display", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+                ],
+                edges=[("node", "value", "display", "value")],
+                route_edges=[("start", "_", "display")],
+            )
+
+        with self.assertRaises(BrokenProcessPool):
+            app.execute_graph(graph_of("Test.ExitProcessNode"), lambda event: None)
+        events = []
+        app.execute_graph(graph_of("Test.ProcessIdNode"), events.append)
+        self.assertEqual(displayed_values(events)[-1], ("display", "45"))
+
+    def parallel_for_each_graph(self, max_concurrency):
+        return build_graph(
+            nodes=[
+                ("start", "StartNode", "TRIGGERED", {}),
+                (
+                    "loop",
+                    "ParallelForEachNode",
+                    "TRIGGERED",
+                    {"items": [1, 2, 3, 4, 5, 6], "max_concurrency": max_concurrency},
+                ),
+                ("sleep", "Test.SleepNode", "DATA", {}),
+                ("mul", "MathOperationNode", "DATA", {"b": 10, "operator": "*"}),
+                ("body", "DisplayAsTextNode", "TRIGGERED", {"append": True}),
+                ("display", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+            ],
+            edges=[
+                ("loop", "item", "sleep", "value"),
+                ("loop", "index", "body", "value"),
+                ("sleep", "value", "mul", "a"),
+                ("mul", "result", "loop", "result"),
+                ("loop", "results", "display", "value"),
+            ],
+            route_edges=[
+                ("start", "_", "loop"),
+                ("loop", "body", "body"),
+                ("loop", "_", "display"),
+            ],
+        )
+
+    def test_parallel_for_each(self):
+        for max_concurrency in (1, 6):
+            events = []
+            start = time.perf_counter()
+            app.execute_graph(
+                self.parallel_for_each_graph(max_concurrency), events.append
+            )
+            elapsed = time.perf_counter() - start
+            if max_concurrency > 1:
+                self.assertLess(elapsed, 0.8)
+            values = displayed_values(events)
+            self.assertEqual(values[-1], ("display", "[10, 20, 30, 40, 50, 60]"))
+            self.assertEqual(
+                sorted(value for node_id, value in values if node_id == "body"),
+                ["0", "1", "2", "3", "4", "5"],
+            )
+
+    def test_parallel_for_each_async(self):
+        events = []
+        start = time.perf_counter()
+        asyncio.run(
+            app.execute_graph_async(self.parallel_for_each_graph(6), events.append)
+        )
+        self.assertLess(time.perf_counter() - start, 0.8)
+        self.assertEqual(
+            displayed_values(events)[-1], ("display", "[10, 20, 30, 40, 50, 60]")
+        )
+
+    def test_parallel_for_each_forks(self):
+        graph = build_graph(
+            nodes=[
+                ("start", "StartNode", "TRIGGERED", {}),
+                (
+                    "loop",
+                    "ParallelForEachNode",
+                    "TRIGGERED",
+                    {"items": [1, 2, 3], "max_concurrency": 1},
+                ),
+                ("once", "Test.ExpensiveNode", "DATA_ONCE", {}),
+                ("display", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+                ("after", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+            ],
+            edges=[
+                ("loop", "item", "once", "value"),
+                ("once", "value", "loop", "result"),
+                ("loop", "results", "display", "value"),
+                ("once", "value", "after", "value"),
+            ],
+            route_edges=[
+                ("start", "_", "loop"),
+                ("loop", "_", "display"),
+                ("display", "_", "after"),
+            ],
+        )
+        # DATA_ONCE节点在第一次迭代中执行，之后的迭代和循环之后的节点使用它的输出
+        for options in ({}, {"max_workers": 2, "release_outputs": True}):
+            ExpensiveNode.calls = 0
+            events = []
+            app.execute_graph(graph, events.append, **options)
+            self.assertEqual(ExpensiveNode.calls, 1)
+            self.assertEqual(
+                [item for item in displayed_values(events) if item[0] != "once"],
+                [("display", "[10, 10, 10]"), ("after", "10")],
+            )
+
+        # 迭代的执行器使用同样的选项，节点对象各自创建
+        executor = GraphExecutor(
+            app.node_defs, graph, max_workers=2, release_outputs=True
+        )
+        loop = executor._get_node_instance(executor.compiled.node_index["loop"])
+        child = executor._fork()
+        child_loop = child.node_instances[loop.index]
+        self.assertEqual((child.max_workers, child.release_outputs), (2, True))
+        self.assertIsNot(child_loop.instance, loop.instance)
+        self.assertIs(type(child_loop.instance), type(loop.instance))
+
+    def expression_loop_graph(self, end, operator):
+        """sum = 0; for i in range(end): sum += float(i) <operator> 0.5; display(sum)"""
+        graph = sum_loop_graph(end)
+        graph.nodes += build_graph(
+            nodes=[
+                ("float", "ConvertToFloatNode", "DATA", {}),
+                ("math", "MathOperationNode", "DATA", {"b": 0.5, "operator": operator}),
+            ],
+            edges=[],
+            route_edges=[],
+        ).nodes
+        graph.edges = [edge for edge in graph.edges if edge.target_id != "add"]
+        graph.edges += build_graph(
+            nodes=[],
+            edges=[
+                ("loop", "item", "float", "value"),
+                ("float", "value", "math", "a"),
+                ("get", "value", "add", "a"),
+                ("math", "result", "add", "b"),
+            ],
+            route_edges=[],
+        ).edges
+        return graph
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def test_vectorized_loop(self):
+        graphs = [
+            lambda: sum_loop_graph(1000),
+            lambda: sum_loop_graph(0),
+            lambda: self.expression_loop_graph(1000, "*"),
+            lambda: self.expression_loop_graph(1000, "-"),
+            # "**"不能向量化，退回到逐次执行
+            lambda: self.expression_loop_graph(10, "**"),
+        ]
+        for graph in graphs:
+            expected = []
+            app.execute_graph(graph(), expected.append)
+            events = []
+            app.execute_graph(graph(), events.append, vectorize_loops=True)
+            self.assertEqual(displayed_values(events), displayed_values(expected))
+
+        events = []
+        app.execute_graph(sum_loop_graph(10**6), events.append, vectorize_loops=True)
+        self.assertEqual(
+            displayed_values(events), [("display", str(sum(range(10**6))))]
+        )
+        self.assertLess(len(events), 20)
+
+    def test_compiled_graph_matches_interpreter(self):
+        graphs = [
+            lambda: sum_loop_graph(20),
+            lambda: self.expression_loop_graph(5, "/"),
+            lambda: self.parallel_for_each_graph(1),
+        ]
+        examples = os.path.join(os.path.dirname(__file__), "..", "examples")
+        for name in ("if.json", "while-loop-sum-1-to-4.json"):
+            with open(os.path.join(examples, name)) as f:
+                graphs.append(lambda data=f.read(): parse_graph_data(data))
+        for graph in graphs:
+            self.assertIsNotNone(
+                graph_compiler.get_compiled_function(
+                    CompiledGraph(app.node_defs, graph())
+                )
+            )
+            expected = []
+            app.execute_graph(graph(), expected.append)
+            events = []
+            app.execute_graph(graph(), events.append, use_compiler=True)
+            self.assertEqual(events, expected)
+
+    def test_compiled_graph_cache_and_fallback(self):
+        # 只有固定输入的值不同的图共用编译结果
+        self.assertEqual(
+            graph_compiler.workflow_hash(
+                CompiledGraph(app.node_defs, sum_loop_graph(5))
+            ),
+            graph_compiler.workflow_hash(
+                CompiledGraph(app.node_defs, sum_loop_graph(6))
+            ),
+        )
+        events = []
+        app.execute_graph(sum_loop_graph(6), events.append, use_compiler=True)
+        self.assertEqual(displayed_values(events), [("display", "15")])
+
+        # 路由有环的图由解释器执行
+        graph = build_graph(
+            nodes=[
+                ("start", "StartNode", "TRIGGERED", {}),
+                ("if", "IfNode", "TRIGGERED", {"condition": False}),
+                (
+                    "display",
+                    "DisplayAsTextNode",
+                    "TRIGGERED",
+                    {"value": 1, "append": False},
+                ),
+            ],
+            edges=[],
+            route_edges=[
+                ("start", "_", "if"),
+                ("if", "if", "if"),
+                ("if", "else", "display"),
+            ],
+        )
+        self.assertIsNone(
+            graph_compiler.get_compiled_function(CompiledGraph(app.node_defs, graph))
+        )
+        events = []
+        app.execute_graph(graph, events.append, use_compiler=True)
+        self.assertEqual(displayed_values(events), [("display", "1")])
+
+    def checkpoint_graph(self):
+        """sum = 0; for i in range(4): sum += expensive(i); fail_once(); display(sum)"""
+        graph = sum_loop_graph(4)
+        extra = build_graph(
+            nodes=[
+                ("expensive", "Test.ExpensiveNode", "DATA", {}),
+                ("fail", "Test.FailOnceNode", "TRIGGERED", {}),
+            ],
+            edges=[
+                ("loop", "item", "expensive", "value"),
+                ("expensive", "value", "add", "a"),
+            ],
+            route_edges=[("loop", "_", "fail"), ("fail", "_", "display")],
+        )
+        graph.nodes += extra.nodes
+        graph.edges = [edge for edge in graph.edges if edge.target_pin != "a"]
+        graph.edges += extra.edges
+        graph.route_edges = [
+            edge
+            for edge in graph.route_edges
+            if (edge.source_id, edge.source_pin) != ("loop", "_")
+        ] + extra.route_edges
+        return graph
+
+    def test_checkpoint_resume(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for store, use_compiler in (
+                (MemoryCheckpointStore(), False),
+                (FileCheckpointStore(directory), True),
+            ):
+                ExpensiveNode.calls = 0
+                FailOnceNode.failed = False
+                failed_events = []
+                with self.assertRaises(TimeoutError):
+                    app.execute_graph(
+                        self.checkpoint_graph(),
+                        failed_events.append,
+                        use_compiler=use_compiler,
+                        checkpoint=Checkpoint(store, "run", save_interval=2),
+                    )
+                self.assertEqual(ExpensiveNode.calls, 4)
+                self.assertIsNotNone(store.load("run"))
+
+                events = []
+                checkpoint = Checkpoint(store, "run")
+                app.execute_graph(
+                    self.checkpoint_graph(),
+                    events.append,
+                    use_compiler=use_compiler,
+                    checkpoint=checkpoint,
+                )
+                # 恢复执行时不再调用已经记录的节点，但会重放它们发送的事件
+                self.assertEqual(ExpensiveNode.calls, 4)
+                self.assertEqual(checkpoint.replayed, 6)
+                self.assertEqual(
+                    displayed_values(events),
+                    displayed_values(failed_events) + [("display", "60")],
+                )
+                self.assertIsNone(store.load("run"))
+
+    def test_checkpoint_store_appends(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = FileCheckpointStore(directory)
+            checkpoint = Checkpoint(store, "run")
+            for occurrence in range(3):
+                checkpoint.record("node", occurrence, [([], occurrence)])
+            # 每次保存只追加新的记录，不重写整个检查点
+            with open(store._path("run"), "rb") as f:
+                records = []
+                while True:
+                    try:
+                        records.append(pickle.load(f))
+                    except EOFError:
+                        break
+            self.assertEqual(
+                [list(record) for record in records],
+                [
+                    [("node", 0)],
+                    [("node", 1)],
+                    [("node", 2)],
+                ],
+            )
+            # 追加过程中失败留下的不完整记录被忽略
+            with open(store._path("run"), "ab") as f:
+                f.write(pickle.dumps({("node", 3): b"x"})[:-3])
+            checkpoint = Checkpoint(store, "run")
+            self.assertEqual(
+                sorted(checkpoint.entries), [("node", i) for i in range(3)]
+            )
+            self.assertEqual(checkpoint.begin("node"), (0, [([], 0)]))
+
+        class ThreadStore(MemoryCheckpointStore):
+            def append(self, run_id, entries):
+                threads.append(threading.get_ident())
+                super().append(run_id, entries)
+
+        async def run():
+            threads.append(threading.get_ident())
+            await app.execute_graph_async(
+                build_graph(
+                    nodes=[
+                        ("start", "StartNode", "TRIGGERED", {}),
+                        ("sleep", "Test.AsyncSleepNode", "DATA_ONCE", {"value": 1}),
+                        (
+                            "display",
+                            "DisplayAsTextNode",
+                            "TRIGGERED",
+                            {"append": False},
+                        ),
+                    ],
+                    edges=[("sleep", "value", "display", "value")],
+                    route_edges=[("start", "_", "display")],
+                ),
+                lambda event: None,
+                checkpoint=Checkpoint(ThreadStore(), "run"),
+            )
+
+        # 异步节点的记录在线程池中保存，不阻塞事件循环
+        threads = []
+        asyncio.run(run())
+        self.assertEqual(len(threads), 2)
+        self.assertNotEqual(threads[0], threads[1])
+
+    def test_checkpoint_parallel_for_each(self):
+        # 并发的迭代按迭代下标分别记录，恢复时每次迭代重放自己的记录
+        graph = build_graph(
+            nodes=[
+                ("start", "StartNode", "TRIGGERED", {}),
+                (
+                    "loop",
+                    "ParallelForEachNode",
+                    "TRIGGERED",
+                    {"items": [3, 1, 2, 4], "max_concurrency": 4},
+                ),
+                ("expensive", "Test.ExpensiveNode", "DATA", {}),
+                ("fail", "Test.FailOnceNode", "TRIGGERED", {}),
+                ("display", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+            ],
+            edges=[
+                ("loop", "item", "expensive", "value"),
+                ("expensive", "value", "loop", "result"),
+                ("loop", "results", "display", "value"),
+            ],
+            route_edges=[
+                ("start", "_", "loop"),
+                ("loop", "_", "fail"),
+                ("fail", "_", "display"),
+            ],
+        )
+        store = MemoryCheckpointStore()
+        ExpensiveNode.calls = 0
+        FailOnceNode.failed = False
+        with self.assertRaises(TimeoutError):
+            app.execute_graph(
+                graph, lambda event: None, checkpoint=Checkpoint(store, "run")
+            )
+        self.assertEqual(ExpensiveNode.calls, 4)
+
+        events = []
+        checkpoint = Checkpoint(store, "run")
+        asyncio.run(
+            app.execute_graph_async(graph, events.append, checkpoint=checkpoint)
+        )
+        self.assertEqual(ExpensiveNode.calls, 4)
+        self.assertEqual(checkpoint.replayed, 4)
+        self.assertEqual(displayed_values(events)[-1], ("display", "[30, 10, 20, 40]"))
+
+    def test_result_cache(self):
+        graph = build_graph(
+            nodes=[
+                ("start", "StartNode", "TRIGGERED", {}),
+                ("loop", "ForEachNode", "TRIGGERED", {"items": [1, 2, 1, 2]}),
+                ("expensive", "Test.ExpensiveNode", "DATA", {}),
+                ("display", "DisplayAsTextNode", "TRIGGERED", {"append": True}),
+            ],
+            edges=[
+                ("loop", "item", "expensive", "value"),
+                ("expensive", "value", "display", "value"),
+            ],
+            route_edges=[("start", "_", "loop"), ("loop", "body", "display")],
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cache.db")
+            cases = [
+                (MemoryResultCache(), [2, 0]),
+                # 容量不够时被淘汰的条目需要重新计算
+                (MemoryResultCache(max_entries=1), [4, 4]),
+                # 每次运行使用新的连接，模拟跨进程共用
+                (lambda: SQLiteResultCache(path), [2, 0]),
+            ]
+            try:
+                for cache, expected_calls in cases:
+                    expected = None
+                    for calls in expected_calls:
+                        app.result_cache = cache() if callable(cache) else cache
+                        ExpensiveNode.calls = 0
+                        events = []
+                        app.execute_graph(graph, events.append)
+                        self.assertEqual(ExpensiveNode.calls, calls)
+                        if expected is None:
+                            expected = events
+                        self.assertEqual(events, expected)
+                        if isinstance(app.result_cache, SQLiteResultCache):
+                            app.result_cache.close()
+            finally:
+                app.result_cache = None
+
+            # 异步执行时在线程池中读写缓存，SQLite的I/O不阻塞事件循环
+            class ThreadCache(SQLiteResultCache):
+                def get(self, key):
+                    threads.add(threading.get_ident())
+                    return super().get(key)
+
+                def set(self, key, value):
+                    threads.add(threading.get_ident())
+                    super().set(key, value)
+
+            async def run_async():
+                threads.clear()
+                events = []
+                await app.execute_graph_async(graph, events.append)
+                return threading.get_ident(), events
+
+            threads = set()
+            app.result_cache = ThreadCache(os.path.join(directory, "async.db"))
+            try:
+                for calls in (2, 0):
+                    ExpensiveNode.calls = 0
+                    loop_thread, events = asyncio.run(run_async())
+                    self.assertEqual(ExpensiveNode.calls, calls)
+                    self.assertEqual(events, expected)
+                    self.assertTrue(threads)
+                    self.assertNotIn(loop_thread, threads)
+            finally:
+                app.result_cache.close()
+                app.result_cache = None
+
+        # ParallelForEach的每次迭代在独立的执行器中执行，同样使用结果缓存
+        graph = build_graph(
+            nodes=[
+                ("start", "StartNode", "TRIGGERED", {}),
+                (
+                    "loop",
+                    "ParallelForEachNode",
+                    "TRIGGERED",
+                    {"items": [1, 2, 1, 2], "max_concurrency": 1},
+                ),
+                ("expensive", "Test.ExpensiveNode", "DATA", {}),
+                ("display", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+            ],
+            edges=[
+                ("loop", "item", "expensive", "value"),
+                ("expensive", "value", "loop", "result"),
+                ("loop", "results", "display", "value"),
+            ],
+            route_edges=[("start", "_", "loop"), ("loop", "_", "display")],
+        )
+        app.result_cache = MemoryResultCache()
+        try:
+            for calls in (2, 0):
+                ExpensiveNode.calls = 0
+                events = []
+                app.execute_graph(graph, events.append)
+                self.assertEqual(ExpensiveNode.calls, calls)
+        finally:
+            app.result_cache = None
+
+    def test_profiler(self):
+        executor = GraphExecutor(app.node_defs, sum_loop_graph(5))
+        self.assertIsNone(executor.profiler)
+        self.assertNotIn("_create_outputs_iterator", executor.__dict__)
+
+        expected = []
+        app.execute_graph(sum_loop_graph(5), expected.append)
+        for use_compiler in (False, True):
+            events = []
+            summary = app.execute_graph(
+                sum_loop_graph(5),
+                events.append,
+                use_compiler=use_compiler,
+                profile=True,
+            )
+            self.assertEqual(events[:-1], expected[:-1])
+            self.assertEqual(events[-1], {"event": "finish", "profile": summary})
+            nodes = summary["nodes"]
+            self.assertEqual(nodes["loop"]["calls"], 1)
+            self.assertEqual(nodes["loop"]["yields"], 5)
+            self.assertEqual(nodes["add"]["calls"], 5)
+            self.assertEqual(summary["node_types"]["GetVariableNode"]["calls"], 6)
+            self.assertGreaterEqual(summary["total_time"], summary["node_time"])
+            if not use_compiler:
+                self.assertGreater(
+                    summary["scheduler"]["get_execution_order"]["calls"], 0
+                )
+            json.dumps(summary)
+
+    def test_release_outputs(self):
+        # 循环体中的输出在循环结束后释放，循环之后还要读取的输出保留
+        graph = build_graph(
+            nodes=[
+                ("start", "StartNode", "TRIGGERED", {}),
+                (
+                    "foreach",
+                    "ForEachNode",
+                    "TRIGGERED",
+                    {"items": ["a" * 10000, "b" * 10000, "c"]},
+                ),
+                ("body", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+                ("keep", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+                ("after", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+            ],
+            edges=[
+                ("foreach", "item", "body", "value"),
+                ("foreach", "item", "keep", "value"),
+                ("keep", "value", "after", "value"),
+            ],
+            route_edges=[
+                ("start", "_", "foreach"),
+                ("foreach", "body", "body"),
+                ("foreach", "body", "keep"),
+                ("foreach", "_", "after"),
+            ],
+        )
+        expected = []
+        app.execute_graph(graph, expected.append)
+        executor = GraphExecutor(app.node_defs, graph, release_outputs=True)
+        events = []
+        executor.execute(events.append)
+        self.assertEqual(events[:-1], expected[:-1])
+        self.assertEqual(displayed_values(events)[-1], ("after", "c"))
+        self.assertGreater(events[-1]["peak_retained_bytes"], 20000)
+        retained = [
+            executor.compiled.node_ids[node]
+            for node, node_instance in enumerate(executor.node_instances)
+            if node_instance is not None and node_instance.output_cache is not None
+        ]
+        self.assertEqual(retained, [])
+        self.assertLess(executor.retained_bytes, 1000)
+
+    def test_release_outputs_long_chain(self):
+        # 活跃性分析是线性的，很长的路由链和数据链也可以分析
+        length = 20000
+        nodes = [
+            ("start", "StartNode", "TRIGGERED", {}),
+            ("show0", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+            ("add0", "AddIntNode", "DATA", {"a": 0, "b": 1}),
+        ]
+        edges = [("add0", "result", "show0", "value")]
+        route_edges = [("start", "_", "show0")]
+        for i in range(1, length):
+            nodes.append(
+                (f"show{i}", "DisplayAsTextNode", "TRIGGERED", {"append": False})
+            )
+            nodes.append((f"add{i}", "AddIntNode", "DATA", {"b": 1}))
+            edges.append((f"add{i - 1}", "result", f"add{i}", "a"))
+            edges.append((f"show{i - 1}", "value", f"show{i}", "value"))
+            route_edges.append((f"show{i - 1}", "_", f"show{i}"))
+        edges[0] = (f"add{length - 1}", "result", "show0", "value")
+        graph = build_graph(nodes=nodes, edges=edges, route_edges=route_edges)
+        executor = GraphExecutor(app.node_defs, graph, release_outputs=True)
+        events = []
+        executor.execute(events.append)
+        self.assertEqual(
+            displayed_values(events)[-1], (f"show{length - 1}", str(length))
+        )
+        retained = [
+            executor.compiled.node_ids[node]
+            for node, node_instance in enumerate(executor.node_instances)
+            if node_instance is not None and node_instance.output_cache is not None
+        ]
+        # 纯数据节点的缓存会被复用，不释放
+        self.assertEqual([node for node in retained if not node.startswith("add")], [])
+
+        # 估计大小时只抽样容器的一部分元素
+        items = ["x" * 100] * 100000
+        size = estimate_size(items)
+        self.assertGreater(size, sys.getsizeof(items) + 100 * len(items))
+        self.assertGreater(estimate_size(PersistentList(items)), 100 * len(items))
+        self.assertGreater(
+            estimate_size(PersistentDict({i: "x" * 100 for i in range(1000)})), 100000
+        )
+
+    def test_persistent_collections(self):
+        empty = PersistentList()
+        a = empty.appended(1)
+        b = a.appended(2)
+        c = a.appended(3)  # 在旧版本上追加
+        self.assertEqual((empty, a, b, c), ([], [1], [1, 2], [1, 3]))
+        self.assertEqual(b.with_item(0, 0), [0, 2])
+        self.assertEqual(b, [1, 2])
+        self.assertEqual([0] + b + [3], [0, 1, 2, 3])
+        self.assertEqual(b[-1], 2)
+        self.assertEqual(str(b), "[1, 2]")
+        self.assertEqual(pickle.loads(pickle.dumps(c)), [1, 3])
+        with self.assertRaises(IndexError):
+            b.with_item(2, 0)
+        # 没有与list同名的修改方法，脚本误用时报错而不是静默地不修改
+        with self.assertRaises(AttributeError):
+            b.append(3)
+
+        # 在循环中替换元素时共享结构，每个版本都保持不变
+        versions = [PersistentList(range(1000))]
+        for i in range(1000):
+            versions.append(versions[-1].with_item(i, -i))
+        self.assertEqual(versions[0][999], 999)
+        self.assertEqual(versions[500][:3], [0, -1, -2])
+        self.assertEqual(versions[500][600], 600)
+        self.assertEqual(versions[-1][999], -999)
+
+        d0 = PersistentDict(x=1)
+        d1 = d0.with_item("y", 2)
+        d2 = d1.with_item("x", 3)
+        d3 = d1.with_item("z", 4)  # 在旧版本上修改
+        self.assertEqual(d0, {"x": 1})
+        self.assertEqual(d2, {"x": 3, "y": 2})
+        self.assertEqual(d3, {"x": 1, "y": 2, "z": 4})
+        self.assertEqual(d1, {"x": 1, "y": 2})
+        self.assertNotIn("z", d2)
+        self.assertEqual(d1.updated({"y": 5}), {"x": 1, "y": 5})
+        self.assertEqual(pickle.loads(pickle.dumps(d3)).to_dict(), d3.to_dict())
+        with self.assertRaises(AttributeError):
+            d1.update({"y": 5})
+
+        # 普通的list和dict输入直接修改，可以在循环中填充DATA_ONCE的空字典
+        graph = build_graph(
+            nodes=[
+                ("start", "StartNode", "TRIGGERED", {}),
+                ("loop", "ForLoopNode", "TRIGGERED", {"start": 0, "end": 3, "step": 1}),
+                ("empty", "EmptyDictNode", "DATA_ONCE", {}),
+                ("put", "PutToDictNode", "DATA", {}),
+                ("show", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+                ("set", "SetListItemNode", "DATA", {"list": [1, 2], "index": 0}),
+                ("show_list", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+            ],
+            edges=[
+                ("empty", "dict", "put", "dict"),
+                ("loop", "item", "put", "key"),
+                ("loop", "item", "put", "value"),
+                ("put", "dict", "show", "value"),
+                ("loop", "item", "set", "item"),
+                ("set", "list", "show_list", "value"),
+            ],
+            route_edges=[
+                ("start", "_", "loop"),
+                ("loop", "body", "show"),
+                ("loop", "_", "show_list"),
+            ],
+        )
+        events = []
+        app.execute_graph(graph, events.append)
+        self.assertEqual(
+            displayed_values(events),
+            [
+                ("show", "{0: 0}"),
+                ("show", "{0: 0, 1: 1}"),
+                ("show", "{0: 0, 1: 1, 2: 2}"),
+                ("show_list", "[2, 2]"),
+            ],
+        )
+
+        # 交给脚本和序列化成JSON时转换成普通的list/dict
+        graph = build_graph(
+            nodes=[
+                ("start", "StartNode", "TRIGGERED", {}),
+                ("list", "ListNode", "DATA", {"item_0": 1, "item_1": 2}),
+                (
+                    "eval",
+                    "PythonEvalNode",
+                    "DATA",
+                    {"expression": "isinstance(input, list) and input + [3]"},
+                ),
+                ("display", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+            ],
+            edges=[
+                ("list", "list", "eval", "input"),
+                ("eval", "result", "display", "value"),
+            ],
+            route_edges=[("start", "_", "display")],
+        )
+        events = []
+        app.execute_graph(graph, events.append)
+        self.assertEqual(displayed_values(events), [("display", "[1, 2, 3]")])
+        value = PersistentDict(a=PersistentList([1]))
+        self.assertEqual(json.dumps(value, default=json_default), '{"a": [1]}')
+        self.assertEqual(
+            plain_event({"event": "display", "data": {"value": value}})["data"],
+            {"value": {"a": [1]}},
+        )
+
+        # items = []; for i in range(5): items = items + [i]
+        graph = build_graph(
+            nodes=[
+                ("start", "StartNode", "TRIGGERED", {}),
+                ("loop", "ForLoopNode", "TRIGGERED", {"start": 0, "end": 5, "step": 1}),
+                ("empty", "EmptyListNode", "DATA_ONCE", {}),
+                ("var", "DefineVariableNode", "DATA_ONCE", {}),
+                ("get", "GetVariableNode", "DATA", {}),
+                ("append", "AppendToListNode", "DATA", {}),
+                ("set", "SetVariableNode", "TRIGGERED", {}),
+                ("display", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+            ],
+            edges=[
+                ("empty", "list", "var", "initial_value"),
+                ("var", "variable", "get", "variable"),
+                ("get", "value", "append", "list"),
+                ("loop", "item", "append", "item"),
+                ("var", "variable", "set", "variable"),
+                ("append", "list", "set", "value"),
+                ("get", "value", "display", "value"),
+            ],
+            route_edges=[
+                ("start", "_", "loop"),
+                ("loop", "body", "set"),
+                ("loop", "_", "display"),
+            ],
+        )
+        events = []
+        app.execute_graph(graph, events.append)
+        self.assertEqual(displayed_values(events), [("display", "[0, 1, 2, 3, 4]")])
+
+    def test_stream_pins(self):
+        stream = Stream(iter(["a", "b"]))
+        self.assertEqual(list(stream), ["a", "b"])
+        self.assertEqual(list(stream), ["a", "b"])  # 第二次读取重放记录的段
+        restored = pickle.loads(pickle.dumps(Stream(iter([[1], [2]]), join=list)))
+        self.assertEqual(
+            (list(restored), restored.materialize()), ([[1], [2]], [[1], [2]])
+        )
+
+        def streaming_graph(node_type):
+            return build_graph(
+                nodes=[
+                    ("start", "StartNode", "TRIGGERED", {}),
+                    ("llm", node_type, "TRIGGERED", {"parts": "abc"}),
+                    ("live", "DisplayStreamNode", "TRIGGERED", {}),
+                    ("final", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+                ],
+                edges=[
+                    ("llm", "content", "live", "stream"),
+                    ("llm", "content", "final", "value"),
+                ],
+                route_edges=[
+                    ("start", "_", "llm"),
+                    ("llm", "on_stream", "live"),
+                    ("llm", "_", "final"),
+                ],
+            )
+
+        # 流式输入在上游输出时逐段读取，其它输入读到完整的值
+        expected = [("display", "")]
+        for part in "abc":
+            expected += [("produce", part), ("append", part)]
+        expected.append(("display", "abc"))
+
+        def stream_events(events):
+            return [
+                (event["event"], event["data"]["value"])
+                for event in events
+                if event["event"] in ("produce", "display", "append")
+            ]
+
+        for node_type in ("Test.StreamNode", "Test.AsyncStreamNode"):
+            for options in ({}, {"use_compiler": True}):
+                events = []
+                app.execute_graph(streaming_graph(node_type), events.append, **options)
+                self.assertEqual(stream_events(events), expected, (node_type, options))
+            events = []
+            asyncio.run(
+                app.execute_graph_async(streaming_graph(node_type), events.append)
+            )
+            self.assertEqual(stream_events(events), expected, node_type)
+
+    def test_run_pool(self):
+        async def run():
+            pool = RunPool(max_running=1, max_queued=1, max_queue_wait=0.1)
+            first = pool.reserve()
+            self.assertEqual(await first.acquire(), first.queue_wait)
+            second = pool.reserve()
+            with self.assertRaises(RunRejected) as rejected:
+                pool.reserve()
+            self.assertEqual(rejected.exception.status_code, 429)
+            self.assertGreaterEqual(rejected.exception.retry_after, 1)
+
+            waiting = asyncio.create_task(second.acquire())
+            await asyncio.sleep(0.02)
+            self.assertFalse(waiting.done())
+            first.release()
+            self.assertGreater(await waiting, 0.01)
+            self.assertEqual((pool.running, pool.queued), (1, 0))
+
+            # 排队超时
+            third = pool.reserve()
+            with self.assertRaises(RunRejected) as rejected:
+                await third.acquire()
+            self.assertEqual(rejected.exception.status_code, 503)
+            # 已经开始发送SSE时排队超时作为事件发送，任何verbosity都不丢弃
+            pipeline = ProgressPipeline("none")
+            pipeline.put(
+                {
+                    "event": "run_rejected",
+                    "status_code": rejected.exception.status_code,
+                    "retry_after": rejected.exception.retry_after,
+                }
+            )
+            self.assertEqual(pipeline.drain()[0]["status_code"], 503)
+            second.release()
+            third.release()
+            self.assertEqual((pool.running, pool.queued, len(pool.waiters)), (0, 0, 0))
+
+        asyncio.run(run())
+
+    def test_run_connection(self):
+        sleep_graph = graph_json(
+            nodes=[
+                ("start", "StartNode", "TRIGGERED", {}),
+                ("sleep", "Test.AsyncSleepNode", "DATA", {"value": 1}),
+                ("display", "DisplayAsTextNode", "TRIGGERED", {"append": False}),
+            ],
+            edges=[("sleep", "value", "display", "value")],
+            route_edges=[("start", "_", "display")],
+        )
+
+        async def run():
+            frames = []
+
+            async def send_text(text):
+                frames.append(json.loads(text))
+
+            registry = RunRegistry(app, RunPool(max_running=2, max_queued=0))
+            connection = RunConnection(registry, send_text)
+            start = {"op": "start", "graph": sleep_graph, "verbosity": "summary"}
+            await connection.handle({**start, "ref": 1, "credits": 1})
+            await connection.handle({**start, "ref": 2})
+            await connection.handle({**start, "ref": 3})
+            await connection.handle({"op": "bad"})
+            await connection.handle({"op": "credit", "run": "x", "n": "abc"})
+            await connection.handle({"op": "credit", "run": "x", "n": 0})
+            await connection.handle({"op": "cancel", "run": []})
+            runs = {frame["ref"]: frame.get("run") for frame in frames}
+            await connection.handle({"op": "cancel", "run": runs[2]})
+            await asyncio.sleep(0.4)
+            # credit用完后事件留在管道中，直到客户端发送credit
+            self.assertNotIn({"run": runs[1], "done": "succeeded"}, frames)
+            await connection.handle({"op": "credit", "run": runs[1], "n": 10})
+            while connection.subscriptions:
+                await asyncio.sleep(0.01)
+            return frames, runs, registry
+
+        frames, runs, registry = asyncio.run(run())
+        self.assertEqual(
+            [frame for frame in frames if frame.get("op") == "error"],
+            [
+                {
+                    "op": "error",
+                    "ref": 3,
+                    "status": 429,
+                    "detail": "too many queued graph runs",
+                    # 两个运行在排队，平均耗时为初始的1秒，ceil(1 * 3 / 2)
+                    "retry_after": 2,
+                },
+                {"op": "error", "ref": None, "status": 400, "detail": "unknown op bad"},
+                {
+                    "op": "error",
+                    "ref": None,
+                    "status": 400,
+                    "detail": "n must be an integer",
+                },
+                {
+                    "op": "error",
+                    "ref": None,
+                    "status": 400,
+                    "detail": "n must be positive",
+                },
+                {
+                    "op": "error",
+                    "ref": None,
+                    "status": 400,
+                    "detail": "run must be a string",
+                },
+            ],
+        )
+        events = [
+            event["event"]
+            for frame in frames
+            if frame.get("run") == runs[1] and "e" in frame
+            for event in frame["e"]
+        ]
+        self.assertEqual(events, ["run_admitted", "display", "finish"])
+        self.assertIn({"run": runs[1], "done": "succeeded"}, frames)
+        self.assertIn({"run": runs[2], "done": "cancelled"}, frames)
+        self.assertEqual((registry.runs, registry.run_pool.running), ({}, 0))
+
+        async def cancel_immediately():
+            frames = []
+
+            async def send_text(text):
+                frames.append(json.loads(text))
+
+            registry = RunRegistry(app, RunPool(max_running=1, max_queued=0))
+            connection = RunConnection(registry, send_text)
+            await connection.handle({"op": "start", "graph": sleep_graph})
+            # 运行的任务还没有开始执行就被取消
+            self.assertTrue(registry.cancel(frames[0]["run"]))
+            while connection.subscriptions:
+                await asyncio.sleep(0.01)
+            self.assertEqual(frames[-1], {"run": frames[0]["run"], "done": "cancelled"})
+            return registry
+
+        registry = asyncio.run(cancel_immediately())
+        self.assertEqual(registry.runs, {})
+        self.assertEqual((registry.run_pool.running, registry.run_pool.queued), (0, 0))
+
+        async def done_without_credit():
+            frames = []
+
+            async def send_text(text):
+                frames.append(json.loads(text))
+                if "done" in frames[-1]:
+                    raise ConnectionError("closed")
+
+            registry = RunRegistry(app, RunPool())
+            connection = RunConnection(registry, send_text)
+            start = {"op": "start", "graph": sleep_graph, "verbosity": "none"}
+            await connection.handle({**start, "credits": 0})
+            await connection.handle({**start, "credits": 1})
+            run = frames[-1]["run"]
+            task = connection.subscriptions[run].task
+            await asyncio.sleep(0.2)
+            # run_admitted用掉了唯一的credit，取消后没有剩余事件，仍然收到done
+            registry.cancel(run)
+            await task
+            return frames, run
+
+        frames, run = asyncio.run(done_without_credit())
+        self.assertEqual(frames[0]["detail"], "credits must be positive")
+        self.assertEqual(
+            [frame["e"][0]["event"] for frame in frames if "e" in frame],
+            ["run_admitted"],
+        )
+        self.assertEqual(frames[-1], {"run": run, "done": "cancelled"})
+
+    def test_run_registry_retains_results(self):
+        graph = sum_loop_graph(3)
+
+        async def run(store):
+            registry = RunRegistry(app, RunPool(), store, max_events=5)
+            first = registry.start(graph)
+            followed = [batch async for batch in registry.follow(first.id, since=0)]
+            second = registry.start(graph)
+            await second.task
+            return registry, first.id, second.id, followed
+
+        registry, first, second, followed = asyncio.run(run(MemoryRunStore(1)))
+        status = registry.status(second)
+        self.assertEqual(status["status"], "succeeded")
+        self.assertEqual(status["outputs"], {"display": {"value": "3"}})
+        # 只保留最后5个事件，序号不变
+        result = registry.events(second, since=0)
+        self.assertGreater(result["first"], 0)
+        self.assertEqual(result["first"], status["first_event"])
+        self.assertEqual(len(result["events"]), 5)
+        self.assertEqual(result["next"], status["event_count"])
+        self.assertEqual(result["events"][-1]["event"], "finish")
+        self.assertEqual(registry.events(second, since=result["next"])["events"], [])
+        # 只保存一个运行，第一个已经被淘汰
+        self.assertIsNone(registry.status(first))
+        events = [event for _, batch in followed for event in batch]
+        self.assertEqual(events[0]["event"], "run_admitted")
+        self.assertEqual(events[-1]["event"], "finish")
+
+        with tempfile.TemporaryDirectory() as directory:
+            store = SQLiteRunStore(os.path.join(directory, "runs.db"), max_runs=1)
+            registry, first, second, _ = asyncio.run(run(store))
+            self.assertIsNone(registry.status(first))
+            self.assertEqual(registry.status(second)["outputs"], status["outputs"])
+            self.assertEqual(registry.events(second, 0)["events"], result["events"])
+            store.close()
+
+    def test_progress_pipeline(self):
+        events = []
+        app.execute_graph(sum_loop_graph(3), events.append)
+        appends = [
+            {"event": "append", "node_id": node_id, "data": {"value": value}}
+            for node_id, value in [("a", "x"), ("b", "1"), ("a", "y"), ("a", "z")]
+        ]
+
+        pipeline = ProgressPipeline("full")
+        for event in appends + events:
+            pipeline.put(event)
+        self.assertEqual(
+            pipeline.drain(),
+            [
+                {"event": "append", "node_id": "a", "data": {"value": "xyz"}},
+                {"event": "append", "node_id": "b", "data": {"value": "1"}},
+            ]
+            + events,
+        )
+        self.assertEqual(appends[0]["data"], {"value": "x"})
+
+        pipeline = ProgressPipeline("node")
+        for event in events:
+            pipeline.put(event)
+        executed = [
+            event["node_id"]
+            for event in pipeline.drain()
+            if event["event"] == "execute_node"
+        ]
+        self.assertEqual(len(executed), len(set(executed)))
+
+        pipeline = ProgressPipeline("summary", max_pending=2)
+        for event in events + [{"event": "display", "node_id": "a", "data": {}}]:
+            pipeline.put(event)
+        self.assertEqual(
+            pipeline.drain(),
+            [
+                {"event": "events_dropped", "count": 1},
+                {"event": "finish"},
+                {"event": "display", "node_id": "a", "data": {}},
+            ],
+        )
+
+        async def stream():
+            pipeline = ProgressPipeline("none")
+
+            async def execute():
+                await app.execute_graph_async(sum_loop_graph(3), pipeline.put)
+                pipeline.close()
+
+            task = asyncio.create_task(execute())
+            batches = [events async for events in pipeline.batches()]
+            await task
+            return batches
+
+        self.assertEqual(asyncio.run(stream()), [[{"event": "finish"}]])
+
+    def test_event_bridge(self):
+        async def run():
+            loop = asyncio.get_running_loop()
+            received = []
+            bridge = EventBridge(received.append, max_buffered=4)
+            # 其它线程中密集的事件一次交给事件循环，顺序不变
+            await loop.run_in_executor(None, lambda: [bridge(i) for i in range(3)])
+            bridge(3)
+            await asyncio.sleep(0)
+            self.assertEqual(received, [0, 1, 2, 3])
+
+            # 暂停时缓冲区满了，产生事件的线程等待
+            bridge.pause()
+            producer = loop.run_in_executor(
+                None, lambda: [bridge(i) for i in range(10)]
+            )
+            await asyncio.sleep(0.05)
+            self.assertFalse(producer.done())
+            self.assertEqual(len(bridge.buffer), 4)
+            bridge.resume()
+            await producer
+            bridge.close()
+            self.assertEqual(received[4:], list(range(10)))
+
+            # 管道积压时暂停其它线程，发送后继续
+            pipeline = ProgressPipeline("full", max_pending=2)
+            put = pipeline.bridge()
+            event = {"event": "display", "node_id": "a", "data": {}}
+            producer = loop.run_in_executor(
+                None, lambda: [put(event) for _ in range(5)]
+            )
+            await asyncio.sleep(0.05)
+            self.assertFalse(producer.done())
+            sent = pipeline.drain()
+            while not producer.done() or put.buffer:
+                await asyncio.sleep(0.01)
+                sent += pipeline.drain()
+            self.assertEqual(sent, [event] * 5)
+
+        asyncio.run(run())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,251 @@
+"""把循环体只包含纯数值数据节点的循环转换为NumPy数组运算
+
+支持的模式（如examples/for-loop-sum-0-to-4.json）：ForLoopNode的body路由只连到一个
+SetVariableNode，并且它设置的值是"读取同一个变量的GetVariableNode"与"一个表达式"的和（或积）。
+表达式由声明了"pure"并实现了get_data_vectorized的DATA节点组成，只依赖循环的item、
+常量和DATA_ONCE节点。这样的循环等价于对range(start, end, step)做一次数组运算再依次累加，
+不需要逐次经过执行器。
+
+数组使用object类型，元素仍然是Python的int/float，运算结果、整数精度和异常都和逐次执行相同。
+NumPy是可选依赖，没有安装时不做这个优化。
+"""
+
+from dataclasses import dataclass, field
+import functools
+import math
+import operator
+from graph import CompiledGraph, GraphExecutor, NodeExecutionType, NodeInstance
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+LOOP_NODE_TYPE = "ForLoopNode"
+SET_VARIABLE_NODE_TYPE = "SetVariableNode"
+GET_VARIABLE_NODE_TYPE = "GetVariableNode"
+
+# 可以作为累加节点的节点类型 -> 根据固定输入得到运算符
+REDUCTION_NODE_TYPES = {
+    "AddIntNode": lambda inputs: "+",
+    "MathOperationNode": lambda inputs: inputs.get("operator"),
+}
+REDUCTION_OPERATORS = {"+": operator.add, "*": operator.mul}
+
+
+@dataclass
+class Constant:
+    value: any
+
+
+@dataclass
+class LoopPlan:
+    loop: int  # 循环节点
+    set_node: int  # 循环体中的SetVariableNode
+    variable: tuple[int, str]  # 变量的来源(节点, 引脚)
+    reduction: str  # 累加的运算符
+    operand: tuple[int, str] | Constant  # 每次迭代累加的表达式
+    leaves: list[int] = field(default_factory=list)  # 变量和表达式依赖的DATA_ONCE节点
+
+
+class NotVectorizable(Exception):
+    """运行时发现无法向量化，退回到逐次执行"""
+
+
+def get_loop_plan(compiled: CompiledGraph, loop: int) -> LoopPlan | None:
+    """分析循环节点是否可以向量化，结果缓存在CompiledGraph中"""
+    if loop not in compiled.loop_plans:
+        try:
+            compiled.loop_plans[loop] = _analyze_loop(compiled, loop)
+        except RecursionError:
+            # 表达式太深，逐次执行
+            compiled.loop_plans[loop] = None
+    return compiled.loop_plans[loop]
+
+
+def _analyze_loop(compiled: CompiledGraph, loop: int) -> LoopPlan | None:
+    if np is None or compiled.node_datas[loop].node_type != LOOP_NODE_TYPE:
+        return None
+    targets = compiled.routes[loop].get("body", ())
+    if len(targets) != 1:
+        return None
+    set_node = targets[0]
+    if (
+        compiled.node_datas[set_node].node_type != SET_VARIABLE_NODE_TYPE
+        or compiled.execution_types[set_node] != NodeExecutionType.TRIGGERED
+        or compiled.routes[set_node]
+    ):
+        return None
+    variable = compiled.data_inputs[set_node].get("variable")
+    value = compiled.data_inputs[set_node].get("value")
+    if variable is None or value is None:
+        return None
+    if compiled.execution_types[variable[0]] != NodeExecutionType.DATA_ONCE:
+        return None
+
+    accumulate = value[0]
+    accumulate_data = compiled.node_datas[accumulate]
+    get_reduction = REDUCTION_NODE_TYPES.get(accumulate_data.node_type)
+    accumulate_inputs = compiled.data_inputs[accumulate]
+    if (
+        get_reduction is None
+        or compiled.execution_types[accumulate] != NodeExecutionType.DATA
+        or "operator" in accumulate_inputs
+    ):
+        return None
+    reduction = get_reduction(accumulate_data.inputs or {})
+    if reduction not in REDUCTION_OPERATORS:
+        return None
+
+    operand_pin = None
+    for pin, other_pin in (("a", "b"), ("b", "a")):
+        source = accumulate_inputs.get(pin)
+        if (
+            source is not None
+            and compiled.node_datas[source[0]].node_type == GET_VARIABLE_NODE_TYPE
+            and compiled.execution_types[source[0]] == NodeExecutionType.DATA
+            and compiled.data_inputs[source[0]].get("variable") == variable
+        ):
+            operand_pin = other_pin
+            break
+    if operand_pin is None:
+        return None
+
+    leaves = [variable[0]]
+    operand = _get_operand(compiled, accumulate, operand_pin)
+    if operand is None or not _check_expression(compiled, loop, operand, leaves):
+        return None
+    return LoopPlan(
+        loop=loop,
+        set_node=set_node,
+        variable=variable,
+        reduction=reduction,
+        operand=operand,
+        leaves=leaves,
+    )
+
+
+def _get_operand(
+    compiled: CompiledGraph, node: int, pin: str
+) -> tuple[int, str] | Constant | None:
+    source = compiled.data_inputs[node].get(pin)
+    if source is not None:
+        return source
+    inputs = compiled.node_datas[node].inputs or {}
+    if pin in inputs:
+        return Constant(inputs[pin])
+    return None
+
+
+def _check_expression(
+    compiled: CompiledGraph,
+    loop: int,
+    operand: tuple[int, str] | Constant,
+    leaves: list[int],
+) -> bool:
+    """检查表达式只由可向量化的纯数据节点、循环的item、常量和DATA_ONCE节点组成"""
+    if isinstance(operand, Constant):
+        return True
+    node, pin = operand
+    if node == loop:
+        return pin == "item"
+    execution_type = compiled.execution_types[node]
+    if execution_type == NodeExecutionType.DATA_ONCE:
+        if node not in leaves:
+            leaves.append(node)
+        return True
+    node_spec = compiled.node_specs[node]
+    if (
+        execution_type != NodeExecutionType.DATA
+        or not node_spec.pure
+        or not hasattr(compiled.node_classes[node], "get_data_vectorized")
+    ):
+        return False
+    if node_spec.lazy_inputs:
+        return False
+    for name in node_spec.input_names:
+        input_operand = _get_operand(compiled, node, name)
+        if input_operand is None or not _check_expression(
+            compiled, loop, input_operand, leaves
+        ):
+            return False
+    return True
+
+
+def run_loop_plan(
+    executor: GraphExecutor,
+    loop_instance: NodeInstance,
+    plan: LoopPlan,
+    inputs: dict[str, any],
+) -> bool:
+    """用数组运算执行整个循环，无法向量化时返回False，由执行器逐次执行
+
+    调用前plan.leaves中的节点都已经执行过
+    """
+    start = inputs.get("start")
+    end = inputs.get("end")
+    step = inputs.get("step")
+    if not all(type(value) is int for value in (start, end, step)) or step == 0:
+        return False
+    variable_source, variable_pin = plan.variable
+    variable = executor._get_node_instance(variable_source).output_cache[variable_pin]
+    items = np.arange(start, end, step).astype(object)
+    try:
+        values = _evaluate(executor, plan, plan.operand, items)
+        if not isinstance(values, np.ndarray):
+            values = np.full(len(items), values, dtype=object)
+        # 和逐次执行一样从当前值开始依次累加，浮点数的结果也完全相同
+        result = functools.reduce(
+            REDUCTION_OPERATORS[plan.reduction], values, variable.value
+        )
+    except Exception:
+        # 包括节点本身的异常（如除以0），逐次执行时会在对应的迭代中正常报错
+        return False
+    if not all(_is_finite_number(value) for value in values) or not (
+        _is_finite_number(variable.value) and _is_finite_number(result)
+    ):
+        return False
+
+    executor.progress_callback(
+        {"event": "execute_node", "node_id": loop_instance.node_data.id}
+    )
+    if len(items) == 0:
+        return True
+    variable.value = result
+    executor._set_output(loop_instance, {"item": items[-1]})
+    set_instance = executor._get_node_instance(plan.set_node)
+    executor.progress_callback(
+        {"event": "execute_node", "node_id": set_instance.node_data.id}
+    )
+    executor._set_output(set_instance, {"variable": variable})
+    return True
+
+
+def _evaluate(
+    executor: GraphExecutor,
+    plan: LoopPlan,
+    operand: tuple[int, str] | Constant,
+    items: "np.ndarray",
+):
+    if isinstance(operand, Constant):
+        return operand.value
+    node, pin = operand
+    if node == plan.loop:
+        return items
+    compiled = executor.compiled
+    if compiled.execution_types[node] == NodeExecutionType.DATA_ONCE:
+        return executor._get_node_instance(node).output_cache[pin]
+    inputs = {}
+    for name in compiled.node_specs[node].input_names:
+        inputs[name] = _evaluate(
+            executor, plan, _get_operand(compiled, node, name), items
+        )
+    outputs = compiled.node_classes[node].get_data_vectorized(np, **inputs)
+    if outputs is None:
+        raise NotVectorizable()
+    return outputs[pin]
+
+
+def _is_finite_number(value) -> bool:
+    return type(value) is int or (type(value) is float and math.isfinite(value))